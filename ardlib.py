@@ -23,11 +23,22 @@ class Serial:
 	def println(text: str, format: Format=None):
 		pass
 
+	@staticmethod
+	def write(value: int):
+		# writes a raw byte, unformatted
+		pass
+
+	@staticmethod
+	def send(*values):
+		# sends the values as one binary frame, see telemetry.py
+		pass
+
 	@staticmethod
 	def read() -> int:
 		pass
 
 INPUT = Mode('INPUT')
+INPUT_PULLUP = Mode('INPUT_PULLUP')
 OUTPUT = Mode('OUTPUT')
 
 DEC = Format('DEC')
@@ -46,7 +57,7 @@ def pinMode(x: int, mode: Mode):
 def digitalWrite(x: int, level: bool):
 	pass
 
-def digitalRead() -> int:
+def digitalRead(x: int) -> int:
 	pass
 
 # analog IO
@@ -57,6 +68,24 @@ def analogRead(pin: int) -> int:
 def analogWrite(pin: int, value: int):
 	pass
 
+# batched analog sampling
+
+def analogBuffer(size: int):
+	# a static buffer of size samples, only at module level
+	return [0] * size
+
+def analogReadBlock(buffer, pins, rate: int=0, prescaler: int=128) -> int:
+	# fills the buffer with samples from the pins (interleaved) at rate Hz,
+	# rate=0 lets the ADC run freely at clock / prescaler / 13 Hz
+	pass
+
+def analogStartBlock(buffer, pins, rate: int=0, prescaler: int=128):
+	# like analogReadBlock but returns right away
+	pass
+
+def analogBlockDone() -> bool:
+	pass
+
 # TIME
 
 def millis() -> int:
@@ -66,4 +95,39 @@ def micros() -> int:
 	pass
 
 def delay(x: int):
-	pass
\ No newline at end of file
+	pass
+
+# TASKS
+
+def every(ms: int):
+	# marks a function as a periodic task, run from loop() every ms milliseconds
+	def task(func):
+		return func
+	return task
+
+async def sleep(ms: int):
+	# lets other coroutines run for ms milliseconds
+	pass
+
+async def until(condition: bool):
+	# lets other coroutines run until the condition is true
+	pass
+
+# INTERRUPTS
+
+def on_change(pin: int, debounce: int=0):
+	# marks a function as an interrupt handler for any change on the pin,
+	# debounced handlers run once the pin has been stable for debounce ms
+	def handler(func):
+		return func
+	return handler
+
+def on_rising(pin: int, debounce: int=0):
+	def handler(func):
+		return func
+	return handler
+
+def on_falling(pin: int, debounce: int=0):
+	def handler(func):
+		return func
+	return handler
@@ -0,0 +1,319 @@
+import ast, copy, json, os, random, sys, time, tracemalloc
+from argparse import ArgumentParser
+from warnings import simplefilter
+
+import compiler
+
+# benchmarks the translator on synthetic sketches of a given size and shape.
+# translate() is timed phase by phase (parse, deepcopy, to_arduino,
+# postprocess, the rest as other) and its peak memory is measured in
+# a separate run, as tracemalloc slows everything down. times are
+# compared in units of a calibration loop timed in the same run, so
+# a baseline saved on another machine or a busier moment still holds.
+# results are compared with a baseline saved by an earlier run:
+#
+#   python benchmark.py --save    # record benchmark_baseline.json
+#   python benchmark.py           # exits with 1 on a regression
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'benchmark_baseline.json')
+
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_REPEAT = 10
+# iterations of the calibration loop, a few ms worth
+CALIBRATION_SIZE = 20000
+
+PHASES = ('parse', 'deepcopy', 'to_arduino', 'postprocess', 'other')
+
+# sketch shapes: number of functions, statements per function,
+# nesting depth of ifs and whiles, chance of a statement calling
+# another function and number of list/tuple literals per function
+SUITE = {
+    'small': {'functions': 4, 'statements': 8, 'depth': 1,
+                'call_density': 0.2, 'containers': 0},
+    'wide': {'functions': 60, 'statements': 10, 'depth': 1,
+                'call_density': 0.2, 'containers': 0},
+    'long': {'functions': 4, 'statements': 150, 'depth': 1,
+                'call_density': 0.1, 'containers': 0},
+    'deep': {'functions': 8, 'statements': 10, 'depth': 6,
+                'call_density': 0.1, 'containers': 0},
+    'calls': {'functions': 30, 'statements': 12, 'depth': 2,
+                'call_density': 0.8, 'containers': 0},
+    # list and tuple literals don't translate yet,
+    # the case shows up as failing until they do
+    'containers': {'functions': 10, 'statements': 10, 'depth': 1,
+                'call_density': 0.1, 'containers': 4}
+}
+
+class SketchGenerator:
+    '''Writes random but translatable sketches. Functions only call
+    the ones defined before them, as the translator needs to know
+    the type of a function by the time it's called.'''
+
+    def __init__(self, functions=10, statements=10, depth=1,
+        call_density=0.2, containers=0, seed=0):
+        self.functions = functions
+        self.statements = statements
+        self.depth = depth
+        self.call_density = call_density
+        self.containers = containers
+        self.random = random.Random(seed)
+
+    def expression(self, names, caller):
+        if caller > 0 and self.random.random() < self.call_density:
+            callee = self.random.randrange(caller)
+            return 'f{}({})'.format(callee, self.random.choice(names))
+        op = self.random.choice(('+', '-', '*', '%'))
+        right = self.random.choice(names + [str(self.random.randint(1, 9))])
+        return '({} {} {})'.format(self.random.choice(names), op, right)
+
+    def block(self, names, caller, count, level, indent):
+        lines = []
+        while count > 0:
+            kind = self.random.random()
+            if level < self.depth and kind < 0.3 and count > 2:
+                # an if or a while with part of the statements inside
+                inner = self.random.randint(1, max(1, count // 2))
+                test = '{} > {}'.format(self.random.choice(names),
+                    self.random.randint(0, 9))
+                if kind < 0.2:
+                    lines.append('{}if {}:'.format(indent, test))
+                    lines += self.block(names, caller, inner, level + 1,
+                        indent + '    ')
+                    lines.append('{}else:'.format(indent))
+                    lines += self.block(names, caller, 1, level + 1,
+                        indent + '    ')
+                else:
+                    lines.append('{}while {}:'.format(indent, test))
+                    lines += self.block(names, caller, inner, level + 1,
+                        indent + '    ')
+                    lines.append('{}    {} = {} - 1'.format(indent,
+                        names[0], names[0]))
+                count -= inner + 1
+            else:
+                target = self.random.choice(names)
+                if kind < 0.5:
+                    lines.append('{}{} += {}'.format(indent, target,
+                        self.random.randint(1, 9)))
+                else:
+                    lines.append('{}{} = {}'.format(indent, target,
+                        self.expression(names, caller)))
+                count -= 1
+        return lines
+
+    def function(self, n):
+        lines = ['def f{}(x: int) -> int:'.format(n)]
+        names = ['x', 'a{}'.format(n), 'b{}'.format(n)]
+        for name in names[1:]:
+            lines.append('    {} = {}'.format(name, self.random.randint(0, 9)))
+        for c in range(self.containers):
+            values = [self.random.randint(0, 99)
+                        for i in range(self.random.randint(2, 8))]
+            if c % 2:
+                lines.append('    t{}_{} = {}'.format(n, c, tuple(values)))
+            else:
+                lines.append('    l{}_{} = {}'.format(n, c, values))
+        lines += self.block(names, n, self.statements, 0, '    ')
+        lines.append('    return {}'.format(names[1]))
+        return '\n'.join(lines)
+
+    def sketch(self):
+        functions = [self.function(n) for n in range(self.functions)]
+        main = '''def setup():
+    Serial.begin(9600)
+
+def loop():
+    value = analogRead(0)
+    Serial.println(f{}(value))
+    delay(10)'''.format(self.functions - 1)
+        return '\n\n'.join(functions + [main]) + '\n'
+
+class PhaseTimer:
+    '''Times the phases of translate() by wrapping the functions
+    the translator calls for them while in use'''
+
+    def __init__(self):
+        self.times = dict((phase, 0.0) for phase in PHASES)
+
+    def timed(self, module, name, phase):
+        original = getattr(module, name)
+
+        def wrapper(*args, **kwargs):
+            # nested calls go straight to the original,
+            # so only the outermost one is timed
+            setattr(module, name, original)
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.times[phase] += time.perf_counter() - start
+                setattr(module, name, wrapper)
+
+        setattr(module, name, wrapper)
+        return original
+
+    def __enter__(self):
+        self.originals = [
+            (ast, 'parse', self.timed(ast, 'parse', 'parse')),
+            (copy, 'deepcopy', self.timed(copy, 'deepcopy', 'deepcopy')),
+            (compiler, 'to_arduino', self.timed(compiler, 'to_arduino',
+                'to_arduino')),
+            (compiler, 'postprocess', self.timed(compiler, 'postprocess',
+                'postprocess'))
+        ]
+        return self
+
+    def __exit__(self, *exc):
+        for module, name, original in self.originals:
+            setattr(module, name, original)
+
+def time_translation(code, repeat=DEFAULT_REPEAT):
+    '''The fastest of repeat translations, phase by phase, in seconds'''
+    best = None
+    for n in range(repeat):
+        with PhaseTimer() as timer:
+            start = time.perf_counter()
+            compiler.translate(code)
+            total = time.perf_counter() - start
+        timer.times['other'] = max(total - sum(timer.times.values()), 0.0)
+        timer.times['total'] = total
+        # every phase on its own, a pause of the machine
+        # in one phase doesn't throw the others out
+        if best is None:
+            best = timer.times
+        else:
+            best = dict((measure, min(best[measure], time))
+                        for measure, time in timer.times.items())
+    return best
+
+def calibration_loop(size=CALIBRATION_SIZE):
+    '''Plain dict, string and int work, like the translator does'''
+    table = {}
+    for n in range(size):
+        key = 'v{}'.format(n % 97)
+        table[key] = table.get(key, 0) + n * 3 % 7
+    return table
+
+def calibrate(repeat=DEFAULT_REPEAT):
+    '''The fastest of repeat runs of the calibration loop, in seconds'''
+    best = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        calibration_loop()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def peak_memory(code):
+    '''Peak bytes allocated while translating'''
+    tracemalloc.start()
+    try:
+        compiler.translate(code)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_case(shape, repeat=DEFAULT_REPEAT, seed=0):
+    '''Timings and peak memory of translating a generated sketch,
+    or the error if the sketch doesn't translate'''
+    code = SketchGenerator(seed=seed, **shape).sketch()
+    try:
+        result = time_translation(code, repeat)
+    except Exception as error:
+        return {'lines': code.count('\n'),
+                'error': '{}: {}'.format(type(error).__name__, error)}
+    result['peak_memory'] = peak_memory(code)
+    result['lines'] = code.count('\n')
+    return result
+
+def run_suite(suite=SUITE, repeat=DEFAULT_REPEAT, seed=0):
+    '''The results of every case and the calibration time of the run'''
+    cases = {}
+    calibrations = []
+    for name, shape in suite.items():
+        # interleaved with the cases, the fastest of them all counts
+        calibrations.append(calibrate(repeat))
+        cases[name] = run_case(shape, repeat, seed)
+    return {'calibration': min(calibrations), 'cases': cases}
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    '''Returns the (case, measure, baseline, now) of everything that got
+    slower or bigger by more than the threshold. the baseline times are
+    scaled by the calibration times of both runs'''
+    scale = results['calibration'] / baseline['calibration']
+    regressions = []
+    for case, measures in results['cases'].items():
+        before_measures = baseline['cases'].get(case)
+        if before_measures is None or 'error' in before_measures:
+            continue
+        if 'error' in measures:
+            regressions.append((case, 'error', 0, 0))
+            continue
+        for measure in ('total', 'peak_memory') + PHASES:
+            before = before_measures.get(measure)
+            if before and measure != 'peak_memory':
+                before *= scale
+            now = measures.get(measure)
+            if before and now > before * (1 + threshold):
+                regressions.append((case, measure, before, now))
+    return regressions
+
+def format_report(results):
+    lines = ['calibration loop {:.2f} ms'.format(
+        results['calibration'] * 1000)]
+    lines += ['{:<12} {:>6} {:>9} {:>9} {:>9} {:>11} {:>11} {:>9} {:>10}'.format(
+        'case', 'lines', 'total ms', 'parse', 'deepcopy', 'to_arduino',
+        'postprocess', 'other', 'peak KiB')]
+    for case, measures in results['cases'].items():
+        if 'error' in measures:
+            lines.append('{:<12} {:>6}  fails: {}'.format(case,
+                measures['lines'], measures['error']))
+            continue
+        lines.append('{:<12} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>11.2f} {:>11.2f}'
+            ' {:>9.2f} {:>10.1f}'.format(case, measures['lines'],
+            *[measures[measure] * 1000 for measure in ('total',) + PHASES],
+            measures['peak_memory'] / 1024))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    argp = ArgumentParser(description='benchmarks the translator')
+    argp.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+        help='translations per case, the fastest one counts')
+    argp.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='slowdown (0.25 is 25%%) counted as a regression')
+    argp.add_argument('--baseline', default=BASELINE_PATH)
+    argp.add_argument('--save', action='store_true', default=False,
+        help='save the results as the new baseline')
+    argp.add_argument('--print-sketch', metavar='CASE', default=None,
+        help='print the sketch generated for a case and exit')
+    args = argp.parse_args()
+
+    if args.print_sketch is not None:
+        print(SketchGenerator(**SUITE[args.print_sketch]).sketch())
+        sys.exit(0)
+
+    # the translator warns about things like missing annotations
+    simplefilter('ignore')
+
+    results = run_suite(repeat=args.repeat)
+    print(format_report(results))
+
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print('saved the baseline to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        regressions = compare(results, json.load(open(args.baseline)),
+            args.threshold)
+        for case, measure, before, now in regressions:
+            if measure == 'error':
+                print('regression: {} no longer translates'.format(case))
+            else:
+                # the baseline as it would be on this machine
+                print('regression: {} {} went from {:.4g} to {:.4g}'.format(
+                    case, measure, before, now))
+        if regressions:
+            sys.exit(1)
+        print('no regressions against {}'.format(args.baseline))
+    else:
+        print('no baseline yet, save one with --save')
@@ -0,0 +1,43 @@
+import json, os
+from functools import lru_cache
+
+# per-board tables live next to boards.json,
+# keyed by the user-friendly board name
+
+BOARDINFO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def table_path(filename):
+    return os.path.join(BOARDINFO_DIR, filename)
+
+@lru_cache(maxsize=None)
+def load_table(filename):
+    '''A whole per-board table. Every table is read once,
+    the entries are shared and must not be changed.'''
+    return json.load(open(table_path(filename)))
+
+def short_name(board):
+    '''Converts a full board name (e.g. arduino:avr:uno)
+    to its user-friendly name if it is known'''
+    boards = load_table('boards.json')
+    if board in boards:
+        return board
+
+    for name in boards:
+        if boards[name] == board:
+            return name
+
+    return board
+
+def full_name(board):
+    '''Converts a user-friendly board name to its proper name'''
+    boards = load_table('boards.json')
+    return boards.get(board, board)
+
+def load(filename, board):
+    '''Returns the entry for a board from one of the per-board tables
+    or None if the board isn't in there'''
+    if board is None:
+        return None
+
+    table = load_table(filename)
+    return table.get(short_name(board))
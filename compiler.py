@@ -1,8 +1,10 @@
-import ast, copy
+import ast, copy, threading
 from inspect import signature
+from types import MappingProxyType
 from warnings import warn, simplefilter
 
-import ardlib
+import ardlib, portio, fixedpoint, scheduler, coroutines, interrupts, sampling, telemetry
+import instrument, flashstrings, peephole
 
 MESSAGE = '''/* 
  * This code has been auto-generated by pyduino from a Python-like source.
@@ -11,7 +13,9 @@ MESSAGE = '''/*
  */'''
 
 VAR_NEW_UNASSIGNED = '{indent}{type} {name}'
+ARRAY_NEW_UNASSIGNED = '{indent}{type} {name}[{size}]'
 VAR_NEW_ASSIGNED = '{indent}{name} = {value}'
+VAR_NEW_INITIALISED = '{indent}{type} {name} = {value}'
 LIST = '{indent}{type} {name}'
 TUPLE = '{indent}{type} {name}({elts})'
 
@@ -24,6 +28,20 @@ CMPOP = '{left} {cmpop} {comparator}'
 IF = '{indent}if ({test})'
 WHILE = '{indent}while ({test})'
 
+# imported modules, see modules.py
+INCLUDE = '#include "{module}.hpp"'
+MODULE_HEADER = '''#ifndef {guard}
+#define {guard}
+
+{includes}
+namespace {module} {{
+
+{code}
+}} // namespace {module}
+
+#endif // {guard}
+'''
+
 types = {
     'int': 'int',
     'float': 'float',
@@ -31,7 +49,9 @@ types = {
     'bool': 'boolean',
     'None': 'void',
     'NoneType': 'void',
-    '_empty': 'void'
+    '_empty': 'void',
+    # floats in fixed-point mode, see fixedpoint.py
+    'fixed_t': 'fixed_t'
 }
 
 # supported container types
@@ -40,14 +60,10 @@ container_types = (tuple, list)
 # python constants
 py_consts = {'True': 'boolean', 'False': 'boolean'}
 
-funcs = {}
-
-result_template = {
-            'variables': {'global': {}},
-            'funcs': funcs,
-            'cur_scope': 'global',
-            'code': ''
-}
+# types of the library functions and constants, shared
+# by all the translations and never changed after loading
+builtin_funcs = {}
+builtin_variables = {}
 
 # add in types for library functions and constants
 for attr in dir(ardlib):
@@ -56,7 +72,7 @@ for attr in dir(ardlib):
     if type(live_attr).__name__ == 'function':
         func_name = attr
         func_type = signature(live_attr).return_annotation.__name__
-        funcs[func_name] = types[func_type]
+        builtin_funcs[func_name] = types[func_type]
 
     # if it's a class
     elif type(live_attr).__name__ == 'type':
@@ -66,7 +82,7 @@ for attr in dir(ardlib):
                 not class_attr.startswith('__')):
                 func_name = attr + '.' + class_attr
                 func_type = signature(live_class_attr).return_annotation.__name__
-                funcs[func_name] = types[func_type]
+                builtin_funcs[func_name] = types[func_type]
     else:
         # hack for library constants
         if not attr.startswith('__'):
@@ -74,7 +90,82 @@ for attr in dir(ardlib):
                 const_type = types[type(live_attr).__name__]
             except KeyError:
                 continue
-            result_template['variables']['global'][attr] = const_type
+            builtin_variables[attr] = const_type
+
+builtin_funcs = MappingProxyType(builtin_funcs)
+builtin_variables = MappingProxyType(builtin_variables)
+
+class ThreadState(threading.local):
+    '''The translator of the translation running on this thread,
+    see Translator, and the hook of the thread, see set_hook'''
+    translator = None
+    hook = None
+
+local = ThreadState()
+
+def current():
+    '''The translator of the translation running on this thread'''
+    if local.translator is None:
+        local.translator = Translator()
+    return local.translator
+
+class CurrentOptions:
+    '''The options of the translation running on this thread'''
+
+    def __getitem__(self, key):
+        return current().options[key]
+
+    def __setitem__(self, key, value):
+        current().options[key] = value
+
+options = CurrentOptions()
+
+# functions a hook sees the calls of, see set_hook
+HOOKED = (
+    'to_arduino',
+    'infer_func_return',
+    'process_container',
+    'get_arduino_type',
+    'get_variable_type',
+    'get_func_name',
+    'get_container_elts_type',
+    'get_binop_type',
+    'get_unaryop_type',
+    'get_subscript_type',
+    'entry_points_code',
+    'postprocess'
+)
+
+hooks_lock = threading.Lock()
+hooks_active = 0
+unhooked = {}
+
+def hooked(name, func):
+    def call(*args, **kwargs):
+        hook = local.hook
+        if hook is None:
+            return func(*args, **kwargs)
+        return hook.call(name, func, args, kwargs)
+    return call
+
+def set_hook(hook):
+    '''Passes the calls of the HOOKED functions made on this thread
+    (recursive ones included) to hook.call(name, func, args, kwargs),
+    or stops with None. translations on other threads aren't seen and
+    with no hook on any thread the functions aren't wrapped at all'''
+    global hooks_active
+    with hooks_lock:
+        if hook is not None and local.hook is None:
+            if not hooks_active:
+                for name in HOOKED:
+                    unhooked[name] = globals()[name]
+                    globals()[name] = hooked(name, unhooked[name])
+            hooks_active += 1
+        elif hook is None and local.hook is not None:
+            hooks_active -= 1
+            if not hooks_active:
+                globals().update(unhooked)
+        local.hook = hook
 
 class CompilationError(Exception):
     def __init__(self, message, line):
@@ -152,12 +243,12 @@ def get_variable_type(name_obj, result):
 
 def infer_func_return(func_name, result):
 
-    func_objs = filter(lambda x: isinstance(x, ast.FunctionDef), parsed.body)
+    func_objs = filter(lambda x: isinstance(x, ast.FunctionDef),
+                        current().parsed.body)
     try:
         func_obj = list(
             filter(lambda func: func.name == func_name, func_objs))[0]
     except IndexError:
-        print(result['funcs'])
         raise UndeclaredFunctionError(
             'function {} has not been declared'.format(func_name), -1)
 
@@ -232,8 +323,8 @@ def get_binop_type(binop, result):
                 return var_type
         # function calls involved
         if isinstance(side, ast.Call):
-            func_name = side.func.id
-            if result[funcs][func_name] == 'float':
+            func_name = get_func_name(side.func, result)
+            if result['funcs'][func_name] == 'float':
                 return 'float'
         # if it's a float, the whole thing's a float
         if isinstance(side, ast.Num):
@@ -261,6 +352,19 @@ def get_unaryop_type(unaryop, result):
         return get_arduino_type(unaryop.operand.n)
 
 
+def get_subscript_type(subscript, result):
+    '''Returns the element type of a subscripted container or array'''
+    if not isinstance(subscript.value, ast.Name):
+        return 'int'
+
+    container_type = get_variable_type(subscript.value, result)
+    if container_type.endswith(']'):
+        container_type = container_type[:container_type.index('[')]
+        return container_type.replace('volatile ', '')
+    if container_type.startswith(('List<', 'Tuple<')):
+        return container_type[container_type.index('<') + 1:-1]
+    return 'int'
+
 def get_boolop(op):
     if isinstance(op, ast.And):
         return '&&'
@@ -373,7 +477,7 @@ def process_container(obj, varname, result):
 
 def to_arduino(obj, result=None, newline=True):
     if result is None:
-        result = result_template.copy()
+        result = current().result_template.copy()
 
     if obj == [] or obj is None:
         return result
@@ -389,12 +493,17 @@ def to_arduino(obj, result=None, newline=True):
     elif isinstance(obj, ast.Num):
         return {'code': obj.n}
 
+    elif isinstance(obj, ast.NameConstant):
+        # True and False get lowercased in postprocess
+        return {'code': str(obj.value)}
+
     elif isinstance(obj, ast.Module):
         result = to_arduino(obj.body, result, newline=newline)
 
-    elif isinstance(obj, ast.FunctionDef):
+    elif isinstance(obj, (ast.FunctionDef, ast.AsyncFunctionDef)):
         func_name = obj.name
         func_args = {}
+        is_coroutine = isinstance(obj, ast.AsyncFunctionDef)
 
         result['cur_scope'] = func_name
         result['variables'][func_name] = {}
@@ -428,9 +537,20 @@ def to_arduino(obj, result=None, newline=True):
         to_arduino(obj.body, temp_result, newline=newline)
         body_code = temp_result['code']
 
+        # periodic tasks get started at the end of setup()
+        # and run from the top of loop() along with the coroutines
+        if func_name == 'setup':
+            body_code += setup_epilogue(indent)
+        elif func_name == 'loop':
+            body_code = loop_prologue(indent) + body_code
+        elif is_coroutine:
+            body_code = coroutines.wrap_body(func_name, body_code, indent)
+
         # get function type
         # strong preference given to annotations
-        if obj.returns is None:
+        if is_coroutine:
+            func_type = coroutines.COROUTINE_TYPE
+        elif obj.returns is None:
             try:
                 func_type = temp_result['funcs'][func_name]
             except KeyError:
@@ -447,11 +567,21 @@ def to_arduino(obj, result=None, newline=True):
 
             var_type = temp_result['variables'][func_name][var_name]
 
+            # locals of coroutines have to survive between calls
+            if is_coroutine:
+                var_type = 'static ' + var_type
+
             var_declaration = VAR_NEW_UNASSIGNED.format(
                 indent=indent, type=var_type, name=var_name)
 
             body_code = var_declaration + '\n' + body_code
 
+        # profiling probes, see instrument.py
+        if options['instrument'] is not None:
+            body_code = instrument.wrap_body(func_name, body_code, indent,
+                options['instrument'], options['probes'], options['handlers'],
+                options['begins_serial'])
+
         declaration_code = FUNC_DEF.format(type=func_type, name=func_name,
                                 args=args_code)
 
@@ -474,6 +604,14 @@ def to_arduino(obj, result=None, newline=True):
             processed = process_container(obj.value, var_name, result)
             var_type = processed['type']
             code = processed['code']
+        elif (isinstance(obj.value, ast.Call)
+            and isinstance(obj.value.func, ast.Name)
+            and obj.value.func.id == 'analogBuffer'):
+            # a static array, declared along with the other globals
+            cur_scope = result['cur_scope']
+            var_type = sampling.buffer_type(obj.value, options['constants'],
+                cur_scope)
+            code = ''
         else:
             var_value = to_arduino(obj.value, newline=False)['code']
 
@@ -486,6 +624,10 @@ def to_arduino(obj, result=None, newline=True):
                 var_type = get_binop_type(obj.value, result)
             elif isinstance(obj.value, ast.UnaryOp):
                 var_type = get_unaryop_type(obj.value, result)
+            elif isinstance(obj.value, ast.Subscript):
+                var_type = get_subscript_type(obj.value, result)
+            elif isinstance(obj.value, ast.NameConstant):
+                var_type = py_consts.get(str(obj.value.value), 'void')
             else:
                 var_type = get_arduino_type(var_value)
 
@@ -496,6 +638,16 @@ def to_arduino(obj, result=None, newline=True):
             code = VAR_NEW_ASSIGNED.format(indent=calc_indent(obj), name=var_name,
              value=var_value)
 
+            # statements can't go at file scope in C++,
+            # so module-level assignments initialise the global
+            if cur_scope == 'global':
+                if var_name in options['global_values']:
+                    raise UnsupportedSyntaxError('global {} is assigned more '
+                        'than once at module level'.format(var_name),
+                        obj.lineno)
+                options['global_values'][var_name] = var_value
+                code = ''
+
         # check if it's used as a local or as a global
         try:
             if var_name in result['variables'][cur_scope]['DECLARED_GLOBALS']:
@@ -549,24 +701,47 @@ def to_arduino(obj, result=None, newline=True):
             and func_name != result['cur_scope']):
             infer_func_return(func_name, result)
 
-        # parse the arguments
-        if obj.args != []:
-            if isinstance(obj.args[0], ast.Call):
-                args_code = to_arduino(obj.args, newline=False)['code'].lstrip()
+        # batched ADC sampling into a static buffer
+        # (the pins can be a tuple, which is no expression of its own)
+        if func_name in sampling.funcs:
+            code = calc_indent(obj) + sampling.call_code(func_name, obj,
+                result['variables']['global'], options['pinmap'],
+                options['constants'], options['board'])
+            result['code'] += code
+            return result
 
-            else:
-                args_code = ''
-                for n, arg in enumerate(obj.args):
-                    if n + 1 < len(obj.args):
-                        args_code += str(to_arduino(arg,
-                                         newline=False)['code']).lstrip() + ', '
-                    else:
-                        args_code += str(to_arduino(arg,
-                                         newline=False)['code']).lstrip()
-        else:
-            args_code = ''
+        # parse the arguments
+        # (each one separately, nested calls would otherwise
+        # swallow the arguments after them)
+        args_codes = [str(to_arduino(arg, newline=False)['code']).lstrip()
+                        for arg in obj.args]
+
+        # printed string literals stay in flash
+        if (func_name in flashstrings.PRINT_FUNCS
+            and options['flash_strings'] is not None):
+            for n, arg in enumerate(obj.args):
+                if flashstrings.is_flash_literal(arg):
+                    args_codes[n] = flashstrings.flash_arg(arg.s,
+                        options['flash_strings'])
+
+        args_code = ', '.join(args_codes)
+
+        code = FUNC_CALL.format(indent=calc_indent(obj),
+            name=module_member(func_name), args=args_code)
+
+        # digital IO on a constant pin goes straight to the port registers
+        if func_name in portio.direct_funcs and options['pinmap'] is not None:
+            direct_code = portio.direct_io(func_name, obj.args, args_codes,
+                options['pinmap'], options['constants'])
+            if direct_code is not None:
+                code = calc_indent(obj) + direct_code
+
+        # Serial.send becomes a binary frame
+        if func_name == 'Serial.send':
+            arch = 'avr' if options['pinmap'] is None else options['pinmap']['arch']
+            code = calc_indent(obj) + telemetry.send_code(obj, args_codes,
+                result, options['telemetry'], arch, options['fixed_point'])
 
-        code = FUNC_CALL.format(indent=calc_indent(obj), name=func_name, args=args_code)
         result['code'] += code
 
     elif isinstance(obj, ast.Attribute):
@@ -574,15 +749,25 @@ def to_arduino(obj, result=None, newline=True):
          newline=False)['code'].lstrip()
         attribute_name = obj.attr
 
-        code = '{}.{}'.format(class_name, attribute_name)
+        code = module_member('{}.{}'.format(class_name, attribute_name))
 
         return {'code': code} 
 
+    elif isinstance(obj, ast.Subscript):
+        value = to_arduino(obj.value, newline=False)['code'].lstrip()
+        # python < 3.9 wraps the index
+        index = obj.slice.value if isinstance(obj.slice, ast.Index) else obj.slice
+        if not isinstance(index, (ast.Name, ast.Num, ast.BinOp, ast.Call)):
+            unsupported_syntax('Only single indices are supported', obj.lineno)
+        index = str(to_arduino(index, newline=False)['code']).lstrip()
+
+        return {'code': '{}[{}]'.format(value, index)}
+
     elif isinstance(obj, ast.Str):
         if len(obj.s) is 1:
-            code = "'{}'".format(obj.s)
+            code = flashstrings.c_char(obj.s)
         else:
-            code = '"{}"'.format(obj.s)
+            code = flashstrings.c_literal(obj.s)
         return {'code': code}
 
     elif isinstance(obj, ast.If):
@@ -590,10 +775,10 @@ def to_arduino(obj, result=None, newline=True):
         temp_result = result.copy()
         temp_result['code'] = ''
         body_code = to_arduino(obj.body, temp_result)['code']
-        try:
-            orelse_code = to_arduino(obj.orelse[0])['code']
-        except IndexError:
-            orelse_code = to_arduino(obj.orelse)['code']
+        # the whole else block, not only its first statement
+        temp_result = result.copy()
+        temp_result['code'] = ''
+        orelse_code = to_arduino(list(obj.orelse), temp_result)['code']
 
         if_code = (IF.format(indent=calc_indent(obj), test=test_code)
             + ' {\n' + body_code + 
@@ -611,7 +796,10 @@ def to_arduino(obj, result=None, newline=True):
 
     elif isinstance(obj, ast.While):
         test_code = to_arduino(obj.test, newline=False)['code'].lstrip()
-        body_code = to_arduino(obj.body)['code']
+        # keep the scope for the variables assigned in the body
+        temp_result = result.copy()
+        temp_result['code'] = ''
+        body_code = to_arduino(obj.body, temp_result)['code']
         try:
             orelse_code = to_arduino(obj.orelse[0])['code']
 
@@ -636,13 +824,15 @@ def to_arduino(obj, result=None, newline=True):
             ret_type = get_variable_type(obj.value, result)
         elif isinstance(obj.value, ast.Num):
             ret_type = get_arduino_type(obj.value.n)
+        elif isinstance(obj.value, ast.NameConstant):
+            ret_type = py_consts.get(str(obj.value.value), 'void')
         elif isinstance(obj.value, ast.Str):
             if len(obj.value.s) > 1:
                 ret_type = 'char *'
             else:
                 ret_type = 'char'
         elif isinstance(obj.value, ast.Call):
-            ret_type = result['funcs'][obj.value.func.id]
+            ret_type = result['funcs'][get_func_name(obj.value.func, result)]
         elif isinstance(obj.value, ast.BinOp):
             ret_type = get_binop_type(obj.value, result)
         else:
@@ -725,13 +915,14 @@ def to_arduino(obj, result=None, newline=True):
 
         modules = obj.names
 
+        # the modules get translated on their own by modules.py,
+        # postprocess only includes their headers
         for module in modules:
-            filename = module.name + '.py'
-            translated = translate(open(filename).read())
-            write_translation(translated['code'], module.name, 'hpp')
-
-        result['code'] = ('#include ' + module.name + '.hpp' + 
-                            '\n' + result['code'])
+            if module.asname is not None:
+                unsupported_syntax('import ... as is currently not supported',
+                    obj.lineno)
+            if module.name not in options['includes']:
+                options['includes'].append(module.name)
 
     elif isinstance(obj, ast.Global):
         newline = False
@@ -760,6 +951,53 @@ def to_arduino(obj, result=None, newline=True):
 
     return result
 
+def module_member(name):
+    '''module.name of an imported module is module::name in C++'''
+    module, _, member = name.rpartition('.')
+    if module in options['modules']:
+        return '{}::{}'.format(module, member)
+    return name
+
+def setup_epilogue(indent):
+    '''Code run at the end of setup()'''
+    return (scheduler.start_code(options['tasks'], indent)
+            + interrupts.attach_code(options['handlers'], options['pinmap'],
+                indent))
+
+def loop_prologue(indent):
+    '''Code run at the top of loop(): due tasks, coroutines
+    and debounced interrupt handlers'''
+    return (scheduler.dispatch_code(options['tasks'], indent)
+            + coroutines.poll_code(options['coroutines'], indent)
+            + interrupts.poll_code(options['handlers'], options['pinmap'],
+                indent))
+
+def entry_points_code(parsed):
+    '''Generates setup() and loop() if the sketch
+    only has tasks, coroutines or interrupt handlers'''
+    defined = set(func.name for func in parsed.body
+                    if isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)))
+
+    code = ''
+    # the profiling probes print over Serial, which has to be started
+    starts_serial = (options['instrument'] is not None
+                        and not options['begins_serial'])
+    if 'setup' not in defined and (options['tasks'] or options['handlers']
+                                    or starts_serial):
+        epilogue = setup_epilogue(' ' * 4)
+        if starts_serial:
+            epilogue = instrument.begin_code(' ' * 4, False) + epilogue
+        code += (FUNC_DEF.format(type='void', name='setup', args='')
+                    + ' {\n' + epilogue + '}\n')
+    if 'loop' not in defined and (options['tasks'] or options['coroutines']
+                                    or options['handlers']):
+        prologue = loop_prologue(' ' * 4)
+        if options['instrument'] is not None:
+            prologue = instrument.dump_code(' ' * 4) + prologue
+        code += (FUNC_DEF.format(type='void', name='loop', args='')
+                    + ' {\n' + prologue + '}\n')
+    return code
+
 def postprocess(result):
     code = result['code']
 
@@ -774,8 +1012,18 @@ def postprocess(result):
         if (global_var not in dir(ardlib)
             and global_var not in py_consts):
             var_type = result['variables']['global'][global_var]
-            var_declaration = VAR_NEW_UNASSIGNED.format(
-                indent='', type=var_type, name=global_var)
+            if var_type.endswith(']'):
+                # static arrays, e.g. uint16_t[256]
+                var_declaration = ARRAY_NEW_UNASSIGNED.format(indent='',
+                    type=var_type[:var_type.index('[')], name=global_var,
+                    size=var_type[var_type.index('[') + 1:-1])
+            elif global_var in options['global_values']:
+                var_declaration = VAR_NEW_INITIALISED.format(indent='',
+                    type=var_type, name=global_var,
+                    value=options['global_values'][global_var])
+            else:
+                var_declaration = VAR_NEW_UNASSIGNED.format(
+                    indent='', type=var_type, name=global_var)
             global_declarations += var_declaration + '\n'
     code = global_declarations + code
 
@@ -787,6 +1035,7 @@ def postprocess(result):
     for n, line in enumerate(code):
         if (not (line.endswith('{') or line.endswith('}'))
             and not line.endswith(';') and not line.endswith('*/')
+            and not line.endswith(':')
             and len(line) > 0):
             line += ';\n'
         elif line.endswith('}'):
@@ -797,22 +1046,186 @@ def postprocess(result):
 
     code = ''.join(code)
 
+    if options['coroutines']:
+        code = coroutines.prelude() + '\n' + code
+
+    if options['sampling']:
+        code = sampling.prelude(options['pinmap']) + '\n' + code
+
+    if options['telemetry']:
+        code = telemetry.prelude(options['telemetry']) + '\n' + code
+
+    if options['fixed_point'] is not None:
+        code = fixedpoint.prelude(options['fixed_point']) + '\n' + code
+
+    if options['instrument'] is not None:
+        code = instrument.prelude(options['probes']) + '\n' + code
+
+    if options['flash_strings']:
+        code = flashstrings.prelude(options['flash_strings']) + '\n' + code
+
+    includes = ''.join(INCLUDE.format(module=module) + '\n'
+                        for module in options['includes'])
+    if options['module'] is not None:
+        code = MODULE_HEADER.format(module=options['module'],
+            guard='PYDUINO_{}_HPP'.format(options['module'].upper()),
+            includes=includes, code=code)
+    elif includes:
+        code = includes + '\n' + code
+
     code = MESSAGE + '\n\n' + code
 
     return code
 
-def translate(code):
-    # reluctantly making this a global variable
-    global parsed
-    parsed = ast.parse(code)
-
-    result = result_template.copy()
+class Translator:
+    '''Translates sketches with symbol tables and options of its own,
+    starting from copies of the builtin types every time. Translators
+    on different threads don't see each other's state, a translator
+    itself runs one translation at a time.'''
+
+    def __init__(self):
+        self.options = {}
+        self.result_template = None
+        self.parsed = None
+
+    def translate(self, code, board=None, fixed_point=None, instrument=None,
+        module=None, modules=None):
+        previous = getattr(local, 'translator', None)
+        local.translator = self
+        try:
+            return self.run(code, board, fixed_point, instrument, module,
+                modules)
+        finally:
+            local.translator = previous
+
+    def run(self, code, board, fixed_point, probe_mode, module, modules):
+        options = self.options = {}
+        self.result_template = {
+            'variables': {'global': dict(builtin_variables)},
+            'funcs': dict(builtin_funcs),
+            'cur_scope': 'global',
+            'code': ''
+        }
+        parsed = self.parsed = ast.parse(code)
+
+        # board-specific code generation needs a pin map
+        options['board'] = board
+        options['pinmap'] = portio.load_pinmap(board)
+        options['constants'] = portio.find_constants(parsed)
+
+        # floats become scaled integers in fixed-point mode (e.g. Q16.16)
+        options['fixed_point'] = fixed_point
+        if fixed_point is not None:
+            parsed = self.parsed = fixedpoint.transform(parsed, fixed_point)
+
+        # functions decorated with @every(ms)
+        options['tasks'] = scheduler.find_tasks(parsed)
+
+        # async def functions become resumable state machines
+        options['coroutines'] = coroutines.find_coroutines(parsed)
+        if options['coroutines']:
+            parsed = self.parsed = coroutines.transform(parsed)
+
+        # runs of constant Serial prints become one print
+        parsed, options['peephole'] = peephole.transform(parsed)
+        self.parsed = parsed
+
+        # initial values of the globals assigned at module level
+        options['global_values'] = {}
+
+        # schemas of the Serial.send frames, filled in during translation
+        options['telemetry'] = []
+
+        # profiling probes in 'functions' or also in 'loop',
+        # the names of the probed functions are filled in during translation
+        options['instrument'] = probe_mode
+        options['probes'] = []
+        # and they're printed at the sketch's own baud rate if it has one
+        options['begins_serial'], options['probe_baud_rate'] = (
+            instrument.serial_baud_rate(parsed, options['constants'])
+            if probe_mode is not None else (False, None))
+
+        # printed string literals, AVR only
+        options['flash_strings'] = ({} if flashstrings.uses_flash(options['pinmap'])
+                                    else None)
+
+        # translating an imported module (its code goes into a header
+        # and a namespace), and the exports of the modules imported here
+        options['module'] = module
+        options['modules'] = modules or {}
+        options['includes'] = []
+
+        # analogReadBlock and friends
+        options['sampling'] = sampling.uses_sampling(parsed)
+
+        # functions decorated with @on_change/@on_rising/@on_falling(pin)
+        options['handlers'] = interrupts.find_handlers(parsed, options['pinmap'],
+            options['constants'])
+
+        result = self.result_template.copy()
+        result['fixed_point'] = fixed_point
+        if fixed_point is not None:
+            result['funcs'].update(fixedpoint.helper_types)
+        result['variables']['global'].update(
+            scheduler.task_variables(options['tasks']))
+        result['variables']['global'].update(
+            coroutines.coroutine_variables(options['coroutines']))
+        for name in options['coroutines']:
+            result['funcs'][name] = coroutines.COROUTINE_TYPE
+        for macro in coroutines.macros:
+            result['funcs'][macro] = 'void'
+        for name, module_exports in options['modules'].items():
+            for func_name, func_type in module_exports['funcs'].items():
+                result['funcs'][name + '.' + func_name] = func_type
+        result['variables']['global'].update(
+            interrupts.handler_variables(options['handlers']))
     
-    # add python constants to the global variables
-    result['variables']['global'].update(py_consts)
-    # pass the copy of the parsed object to the compiler
-    # otherwise its contents will be mutated
-    to_arduino(copy.deepcopy(parsed), result)
-
-    result['code'] = postprocess(result)
-    return result
\ No newline at end of file
+        # add python constants to the global variables
+        result['variables']['global'].update(py_consts)
+        # pass the copy of the parsed object to the compiler
+        # otherwise its contents will be mutated
+        to_arduino(copy.deepcopy(parsed), result)
+
+        result['code'] += entry_points_code(parsed)
+
+        if options['handlers']:
+            result['code'] = (interrupts.prototypes(options['handlers'])
+                                + result['code']
+                                + interrupts.isr_code(options['handlers'],
+                                    options['pinmap']))
+            # globals an interrupt can change under the main program's feet
+            global_vars = result['variables']['global']
+            for name in interrupts.shared_globals(parsed, options['handlers'],
+                global_vars, options['constants']):
+                if not global_vars[name].startswith('volatile '):
+                    global_vars[name] = 'volatile ' + global_vars[name]
+
+        result['code'] = postprocess(result)
+        result['telemetry'] = options['telemetry']
+        result['probes'] = options['probes']
+        result['probe_baud_rate'] = options['probe_baud_rate']
+        result['flash_strings'] = list(options['flash_strings'] or [])
+        result['flash_uses'] = (len(flashstrings.printed_literals(parsed))
+                                if options['flash_strings'] else 0)
+        result['peephole'] = options['peephole']
+        result['includes'] = options['includes']
+        result['exports'] = exports(parsed, result)
+        return result
+
+def translate(code, board=None, fixed_point=None, instrument=None,
+    module=None, modules=None):
+    return Translator().translate(code, board, fixed_point, instrument,
+        module, modules)
+
+def exports(parsed, result):
+    '''The functions and global variables a module defines
+    with their types, for translating the modules importing it'''
+    funcs = dict((node.name, result['funcs'][node.name]) for node in parsed.body
+                if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+                and node.name in result['funcs'])
+    names = set(target.id for node in parsed.body if isinstance(node, ast.Assign)
+                for target in node.targets if isinstance(target, ast.Name))
+    variables = dict((name, result['variables']['global'][name])
+                    for name in sorted(names)
+                    if name in result['variables']['global'])
+    return {'funcs': funcs, 'variables': variables}
\ No newline at end of file
@@ -1 +1,8 @@
 arduino_path = '/Applications/Arduino.app/Contents/MacOS/JavaApplicationStub'
+
+# direct builds with the toolchain (pyduino.py --direct), see toolchain.py.
+# the hardware directory of the Arduino IDE holds the core sources,
+# the compilers are looked up in toolchain_path or else on the PATH
+arduino_hardware_path = '/Applications/Arduino.app/Contents/Java/hardware'
+toolchain_path = ''
+build_cache_path = '~/.cache/pyduino'
@@ -0,0 +1,122 @@
+import ast
+from warnings import warn
+
+import compiler, scheduler
+
+# async def functions become resumable state machines (protothreads).
+# every await is a case label in a switch on the coroutine's state,
+# locals are static so they survive between calls, and loop() polls
+# every coroutine until it's done. nothing ever blocks.
+
+PRELUDE = '''// coroutines: every await is a case label to resume from
+#define CO_SLEEP(co, n, ms) do {{ _##co##_since = millis(); _##co##_state = n; case n: if (millis() - _##co##_since < (unsigned long)(ms)) return true; }} while (0)
+#define CO_UNTIL(co, n, cond) do {{ _##co##_state = n; case n: if (!(cond)) return true; }} while (0)
+#define CO_END(co) do {{ _##co##_state = {done}; return false; }} while (0)
+'''
+
+SWITCH = '{indent}switch (_{name}_state) {{\n{indent}case 0:\n'
+SWITCH_END = '{indent}}}\n{indent}_{name}_state = {done}\n{indent}return false\n'
+POLL = '{indent}{name}()\n'
+
+# state of a finished coroutine
+DONE = -1
+
+# coroutines return whether they're still running
+COROUTINE_TYPE = 'boolean'
+
+awaitables = {'sleep': 'CO_SLEEP', 'until': 'CO_UNTIL'}
+
+macros = ('CO_SLEEP', 'CO_UNTIL', 'CO_END')
+
+def find_coroutines(parsed):
+    return [node.name for node in parsed.body
+            if isinstance(node, ast.AsyncFunctionDef)]
+
+def prelude():
+    return PRELUDE.format(done=DONE)
+
+def coroutine_variables(coroutines):
+    '''Global state of the coroutines and its types'''
+    variables = {}
+    for name in coroutines:
+        variables['_{}_state'.format(name)] = 'int'
+        variables['_{}_since'.format(name)] = 'unsigned long'
+    return variables
+
+def call(name, args, like):
+    node = ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args,
+        keywords=[])
+    return ast.copy_location(node, like)
+
+class CoroutineTransformer(ast.NodeTransformer):
+    '''Numbers the awaits in a coroutine and turns them
+    into calls to the resuming macros'''
+
+    def __init__(self, name):
+        self.name = name
+        self.resume_points = 0
+
+    def visit_Expr(self, node):
+        if not isinstance(node.value, ast.Await):
+            return self.generic_visit(node)
+
+        awaited = node.value.value
+        if not (isinstance(awaited, ast.Call)
+            and isinstance(awaited.func, ast.Name)
+            and awaited.func.id in awaitables
+            and len(awaited.args) == 1):
+            raise compiler.UnsupportedSyntaxError(
+                'only await sleep(ms) and await until(condition) are supported',
+                node.lineno)
+
+        self.resume_points += 1
+        co_name = ast.copy_location(ast.Name(id=self.name, ctx=ast.Load()), node)
+        resume_point = ast.copy_location(ast.Num(n=self.resume_points), node)
+        macro = call(awaitables[awaited.func.id],
+            [co_name, resume_point, awaited.args[0]], awaited)
+        # keep the statement's indentation
+        macro.col_offset = node.col_offset
+        return ast.copy_location(ast.Expr(value=macro), node)
+
+    def visit_Await(self, node):
+        raise compiler.UnsupportedSyntaxError(
+            'await can only be used as a statement', node.lineno)
+
+    def visit_Return(self, node):
+        if node.value is not None:
+            raise compiler.UnsupportedSyntaxError(
+                'coroutines cannot return a value', node.lineno)
+        co_name = ast.copy_location(ast.Name(id=self.name, ctx=ast.Load()), node)
+        end = call('CO_END', [co_name], node)
+        return ast.copy_location(ast.Expr(value=end), node)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name) and node.func.id == 'delay':
+            warn('delay() in coroutine {} (line {}) blocks everything else, '
+                'use await sleep(ms)'.format(self.name, node.lineno),
+                scheduler.BlockingTaskWarning)
+        return self.generic_visit(node)
+
+def transform(parsed):
+    '''Rewrites the awaits of every coroutine in a parsed program'''
+    for func in parsed.body:
+        if not isinstance(func, ast.AsyncFunctionDef):
+            continue
+
+        if func.args.args:
+            raise compiler.UnsupportedSyntaxError(
+                'coroutine {} cannot take arguments'.format(func.name),
+                func.lineno)
+
+        CoroutineTransformer(func.name).visit(func)
+
+    return ast.fix_missing_locations(parsed)
+
+def wrap_body(name, body_code, indent):
+    '''Puts the body of a coroutine in the switch it resumes from'''
+    return (SWITCH.format(indent=indent, name=name) + body_code
+            + SWITCH_END.format(indent=indent, name=name, done=DONE))
+
+def poll_code(coroutines, indent):
+    return ''.join(POLL.format(indent=indent, name=name)
+                    for name in coroutines)
@@ -0,0 +1,429 @@
+import ast, re
+
+import compiler
+
+# fixed-point mode: float values are kept as scaled integers
+# so that AVR boards don't need the software floating point library.
+# the program is rewritten before translation so that every
+# float operation becomes a call to one of the helpers in PRELUDE,
+# which are all typed fixed_t for the translator.
+# python nativebuild.py --fixed-point [FORMAT] checks the helpers
+# against floats, built with the host compiler
+
+SERIAL_PRINTS = {'Serial.print': 'fix_print', 'Serial.println': 'fix_println'}
+
+# Serial.print prints floats with 2 decimals by default
+DEFAULT_DIGITS = 2
+
+PRELUDE = '''// fixed-point arithmetic, Q{int_bits}.{frac_bits}
+typedef {fixed_type} fixed_t;
+typedef {wide_type} fix_wide_t;
+#define FIX_FRAC_BITS {frac_bits}
+#define FIX_ONE ((fix_wide_t)1 << FIX_FRAC_BITS)
+
+// shift a product back down, rounding half away from zero
+static inline fixed_t fix_round(fix_wide_t x) {{
+    return x >= 0 ? (fixed_t)((x + FIX_ONE / 2) >> FIX_FRAC_BITS)
+                  : -(fixed_t)((-x + FIX_ONE / 2) >> FIX_FRAC_BITS);
+}}
+
+// divide, rounding half away from zero
+static inline fixed_t fix_round_div(fix_wide_t n, fix_wide_t d) {{
+    fix_wide_t half = (d < 0 ? -d : d) / 2;
+    return (fixed_t)((n < 0 ? n - half : n + half) / d);
+}}
+
+static inline fixed_t fix_from_int(long x) {{ return (fixed_t)(x * FIX_ONE); }}
+static inline long fix_to_int(fixed_t x) {{ return fix_round(x); }}
+static inline fixed_t fix_add(fixed_t a, fixed_t b) {{ return a + b; }}
+static inline fixed_t fix_sub(fixed_t a, fixed_t b) {{ return a - b; }}
+static inline fixed_t fix_neg(fixed_t a) {{ return -a; }}
+static inline fixed_t fix_mod(fixed_t a, fixed_t b) {{ return a % b; }}
+static inline fixed_t fix_mul(fixed_t a, fixed_t b) {{ return fix_round((fix_wide_t)a * b); }}
+static inline fixed_t fix_mul_int(fixed_t a, long b) {{ return a * b; }}
+static inline fixed_t fix_div(fixed_t a, fixed_t b) {{ return fix_round_div((fix_wide_t)a * FIX_ONE, b); }}
+static inline fixed_t fix_div_int(fixed_t a, long b) {{ return fix_round_div(a, b); }}
+
+void fix_print(fixed_t x, int digits) {{
+    fix_wide_t value = x;
+    if (value < 0) {{
+        Serial.print('-');
+        value = -value;
+    }}
+    unsigned long scale = 1;
+    for (int i = 0; i < digits; ++i)
+        scale *= 10;
+    // round to the number of digits printed
+    fix_wide_t scaled = (value * scale + FIX_ONE / 2) >> FIX_FRAC_BITS;
+    Serial.print((unsigned long)(scaled / scale));
+    if (digits > 0) {{
+        unsigned long frac = scaled % scale;
+        Serial.print('.');
+        for (unsigned long place = scale / 10; place > 1 && frac < place; place /= 10)
+            Serial.print('0');
+        Serial.print(frac);
+    }}
+}}
+
+void fix_println(fixed_t x, int digits) {{
+    fix_print(x, digits);
+    Serial.println();
+}}
+'''
+
+# return types of the helpers for the translator
+helper_types = {
+    'fixed_t': 'fixed_t',
+    'fix_from_int': 'fixed_t',
+    'fix_to_int': 'long',
+    'fix_add': 'fixed_t',
+    'fix_sub': 'fixed_t',
+    'fix_neg': 'fixed_t',
+    'fix_mod': 'fixed_t',
+    'fix_mul': 'fixed_t',
+    'fix_mul_int': 'fixed_t',
+    'fix_div': 'fixed_t',
+    'fix_div_int': 'fixed_t',
+    'fix_print': 'void',
+    'fix_println': 'void'
+}
+
+binops = {ast.Add: 'fix_add', ast.Sub: 'fix_sub', ast.Mod: 'fix_mod'}
+
+def parse_format(fmt):
+    '''Parses a format like Q16.16 into the number of integer bits
+    (including the sign) and fractional bits'''
+    match = re.match(r'^[Qq]?(\d+)\.(\d+)$', fmt)
+    if match is None:
+        raise ValueError('Fixed-point format {} should look like Q16.16'.format(
+            fmt))
+
+    int_bits, frac_bits = int(match.group(1)), int(match.group(2))
+    if int_bits + frac_bits not in (16, 32) or int_bits < 1:
+        raise ValueError('Fixed-point format {} should be 16 or 32 bits wide'.format(
+            fmt))
+
+    return int_bits, frac_bits
+
+def prelude(fmt):
+    int_bits, frac_bits = parse_format(fmt)
+    width = int_bits + frac_bits
+    return PRELUDE.format(int_bits=int_bits, frac_bits=frac_bits,
+        fixed_type='int{}_t'.format(width),
+        wide_type='int{}_t'.format(width * 2))
+
+def to_raw(value, frac_bits):
+    '''Converts a number to its scaled integer, rounding half away from zero'''
+    scaled = abs(value) * (1 << frac_bits)
+    raw = int(scaled + 0.5)
+    return raw if value >= 0 else -raw
+
+def const_value(node):
+    '''Returns the value of a constant numeric expression, or None'''
+    if isinstance(node, ast.Num):
+        return node.n
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        operand = const_value(node.operand)
+        if operand is None:
+            return None
+        return -operand if isinstance(node.op, ast.USub) else operand
+    if isinstance(node, ast.BinOp):
+        left, right = const_value(node.left), const_value(node.right)
+        if left is None or right is None:
+            return None
+        try:
+            if isinstance(node.op, ast.Add):
+                return left + right
+            if isinstance(node.op, ast.Sub):
+                return left - right
+            if isinstance(node.op, ast.Mult):
+                return left * right
+            if isinstance(node.op, ast.Div):
+                return left / right
+        except ZeroDivisionError:
+            return None
+    return None
+
+def call(name, args, like):
+    node = ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args,
+        keywords=[])
+    return ast.copy_location(node, like)
+
+def call_name(node):
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    if (isinstance(node.func, ast.Attribute)
+        and isinstance(node.func.value, ast.Name)):
+        return '{}.{}'.format(node.func.value.id, node.func.attr)
+    return None
+
+def is_float_annotation(annotation):
+    return isinstance(annotation, ast.Name) and annotation.id == 'float'
+
+class FixedPointTransformer(ast.NodeTransformer):
+    '''Rewrites float values and operations into fixed-point helper calls.
+    Variable types are inferred up front: a variable which is ever
+    assigned a float is a fixed-point variable everywhere.'''
+
+    def __init__(self, parsed, frac_bits):
+        self.frac_bits = frac_bits
+        self.scope = 'global'
+        self.func_objs = dict((node.name, node) for node in parsed.body
+                            if isinstance(node, ast.FunctionDef))
+
+        self.locals = {'global': set()}
+        self.declared_globals = {'global': set()}
+        for name, func in self.func_objs.items():
+            self.locals[name] = set(arg.arg for arg in func.args.args)
+            self.declared_globals[name] = set()
+            for node in ast.walk(func):
+                if isinstance(node, ast.Global):
+                    self.declared_globals[name].update(node.names)
+                elif isinstance(node, ast.Assign):
+                    self.locals[name].update(target.id for target in node.targets
+                                            if isinstance(target, ast.Name))
+                elif isinstance(node, ast.AugAssign):
+                    self.locals[name].add(node.target.id)
+            self.locals[name] -= self.declared_globals[name]
+
+        self.float_vars = dict((scope, set()) for scope in self.locals)
+        self.float_funcs = set(name for name, func in self.func_objs.items()
+                                if is_float_annotation(func.returns))
+        for name, func in self.func_objs.items():
+            self.float_vars[name].update(arg.arg for arg in func.args.args
+                                        if is_float_annotation(arg.annotation))
+
+        self.infer_types(parsed)
+
+    def var_scope(self, name, scope):
+        if scope != 'global' and name in self.locals[scope]:
+            return scope
+        return 'global'
+
+    def is_float(self, node, scope):
+        if isinstance(node, ast.Num):
+            return type(node.n) is float
+        if isinstance(node, ast.Name):
+            return node.id in self.float_vars[self.var_scope(node.id, scope)]
+        if isinstance(node, ast.BinOp):
+            # division always results in a float
+            return (isinstance(node.op, ast.Div)
+                    or self.is_float(node.left, scope)
+                    or self.is_float(node.right, scope))
+        if isinstance(node, ast.UnaryOp):
+            return self.is_float(node.operand, scope)
+        if isinstance(node, ast.Call):
+            return call_name(node) in self.float_funcs
+        return False
+
+    def infer_types(self, parsed):
+        # repeat until nothing changes, a float can make its way
+        # through several assignments and function returns
+        changed = True
+        while changed:
+            changed = False
+            scoped_bodies = [('global', parsed.body)]
+            scoped_bodies += [(name, func.body)
+                                for name, func in self.func_objs.items()]
+
+            for scope, body in scoped_bodies:
+                for stmt in body:
+                    for node in ast.walk(stmt):
+                        if scope == 'global' and isinstance(node, ast.FunctionDef):
+                            break
+                        if isinstance(node, ast.Assign):
+                            names = [target.id for target in node.targets
+                                        if isinstance(target, ast.Name)]
+                            is_float = self.is_float(node.value, scope)
+                        elif isinstance(node, ast.AugAssign):
+                            names = [node.target.id]
+                            is_float = (isinstance(node.op, ast.Div)
+                                        or self.is_float(node.value, scope))
+                        elif (isinstance(node, ast.Return) and scope != 'global'
+                            and self.func_objs[scope].returns is None):
+                            if (scope not in self.float_funcs
+                                and self.is_float(node.value, scope)):
+                                self.float_funcs.add(scope)
+                                changed = True
+                            continue
+                        else:
+                            continue
+
+                        if not is_float:
+                            continue
+                        for name in names:
+                            var_scope = self.var_scope(name, scope)
+                            if name not in self.float_vars[var_scope]:
+                                self.float_vars[var_scope].add(name)
+                                changed = True
+
+    # expressions
+
+    def literal(self, value, like):
+        raw = to_raw(value, self.frac_bits)
+        return call('fixed_t', [ast.copy_location(ast.Num(n=raw), like)], like)
+
+    def to_fixed(self, node, is_fixed):
+        if is_fixed:
+            return node
+        value = const_value(node)
+        if value is not None:
+            return self.literal(value, node)
+        return call('fix_from_int', [node], node)
+
+    def convert(self, node, want_fixed):
+        new_node, is_fixed = self.expr(node)
+        if want_fixed:
+            return self.to_fixed(new_node, is_fixed)
+        if is_fixed:
+            return call('fix_to_int', [new_node], node)
+        return new_node
+
+    def expr(self, node):
+        '''Returns the rewritten expression and whether it's fixed-point'''
+        if isinstance(node, ast.Num):
+            if type(node.n) is float:
+                return self.literal(node.n, node), True
+            return node, False
+
+        if isinstance(node, ast.Name):
+            return node, self.is_float(node, self.scope)
+
+        if isinstance(node, (ast.BinOp, ast.UnaryOp)) and self.is_float(node, self.scope):
+            # constant expressions like 5.0 / 1023.0 are folded here
+            value = const_value(node)
+            if value is not None:
+                return self.literal(value, node), True
+
+        if isinstance(node, ast.BinOp):
+            left, left_fixed = self.expr(node.left)
+            right, right_fixed = self.expr(node.right)
+
+            if isinstance(node.op, ast.Div):
+                if right_fixed:
+                    return call('fix_div', [self.to_fixed(left, left_fixed),
+                                right], node), True
+                return call('fix_div_int', [self.to_fixed(left, left_fixed),
+                            right], node), True
+
+            if not (left_fixed or right_fixed):
+                node.left, node.right = left, right
+                return node, False
+
+            if isinstance(node.op, ast.Mult):
+                if left_fixed and right_fixed:
+                    return call('fix_mul', [left, right], node), True
+                # scaling by an integer needs no shifting
+                if left_fixed:
+                    return call('fix_mul_int', [left, right], node), True
+                return call('fix_mul_int', [right, left], node), True
+
+            if type(node.op) in binops:
+                return call(binops[type(node.op)],
+                    [self.to_fixed(left, left_fixed),
+                     self.to_fixed(right, right_fixed)], node), True
+
+            raise compiler.UnsupportedSyntaxError(
+                '{} is not supported in fixed-point mode'.format(
+                    type(node.op).__name__), node.lineno)
+
+        if isinstance(node, ast.UnaryOp):
+            operand, is_fixed = self.expr(node.operand)
+            if is_fixed and isinstance(node.op, ast.USub):
+                return call('fix_neg', [operand], node), True
+            node.operand = operand
+            return node, is_fixed
+
+        if isinstance(node, ast.Call):
+            is_fixed = call_name(node) in self.float_funcs
+            return self.visit(node), is_fixed
+
+        return self.visit(node), False
+
+    # statements
+
+    def visit_FunctionDef(self, node):
+        self.scope = node.name
+        for arg in node.args.args:
+            if is_float_annotation(arg.annotation):
+                arg.annotation = ast.copy_location(
+                    ast.Name(id='fixed_t', ctx=ast.Load()), arg.annotation)
+        if is_float_annotation(node.returns):
+            node.returns = ast.copy_location(
+                ast.Name(id='fixed_t', ctx=ast.Load()), node.returns)
+
+        node.body = [self.visit(stmt) for stmt in node.body]
+        self.scope = 'global'
+        return node
+
+    def target_is_float(self, name):
+        return name in self.float_vars[self.var_scope(name, self.scope)]
+
+    def visit_Assign(self, node):
+        target = node.targets[0]
+        if isinstance(target, ast.Name):
+            node.value = self.convert(node.value,
+                self.target_is_float(target.id))
+        else:
+            node.value = self.visit(node.value)
+        return node
+
+    def visit_AugAssign(self, node):
+        if self.target_is_float(node.target.id):
+            # x /= y becomes x = fix_div(x, y) and so on
+            value = ast.copy_location(ast.BinOp(
+                left=ast.copy_location(ast.Name(id=node.target.id,
+                    ctx=ast.Load()), node.target),
+                op=node.op, right=node.value), node)
+            target = ast.copy_location(ast.Name(id=node.target.id,
+                ctx=ast.Store()), node.target)
+            assign = ast.copy_location(ast.Assign(targets=[target],
+                value=value), node)
+            return self.visit_Assign(assign)
+
+        node.value = self.convert(node.value, False)
+        return node
+
+    def visit_Return(self, node):
+        if node.value is not None:
+            node.value = self.convert(node.value, self.scope in self.float_funcs)
+        return node
+
+    def visit_Compare(self, node):
+        operands = [node.left] + node.comparators
+        if any(self.is_float(operand, self.scope) for operand in operands):
+            operands = [self.convert(operand, True) for operand in operands]
+        else:
+            operands = [self.convert(operand, False) for operand in operands]
+        node.left, node.comparators = operands[0], operands[1:]
+        return node
+
+    def visit_Call(self, node):
+        name = call_name(node)
+
+        if (name in SERIAL_PRINTS and node.args
+            and self.is_float(node.args[0], self.scope)):
+            digits = DEFAULT_DIGITS
+            if len(node.args) > 1 and isinstance(node.args[1], ast.Num):
+                digits = node.args[1].n
+            return call(SERIAL_PRINTS[name], [self.convert(node.args[0], True),
+                ast.copy_location(ast.Num(n=digits), node)], node)
+
+        if name in self.func_objs:
+            params = self.func_objs[name].args.args
+            node.args = [self.convert(arg, n < len(params)
+                                and (is_float_annotation(params[n].annotation)
+                                    or params[n].arg in self.float_vars[name]))
+                            for n, arg in enumerate(node.args)]
+        else:
+            # library functions take integers
+            node.args = [self.convert(arg, False) for arg in node.args]
+
+        return node
+
+def transform(parsed, fmt):
+    '''Rewrites a parsed program to use fixed-point arithmetic
+    in the given format (e.g. Q16.16)'''
+    int_bits, frac_bits = parse_format(fmt)
+    transformer = FixedPointTransformer(parsed, frac_bits)
+    return ast.fix_missing_locations(transformer.visit(parsed))
@@ -0,0 +1,74 @@
+import ast
+
+# string literals printed with Serial.print/println stay in flash on AVR.
+# a plain "..." literal is copied into SRAM at boot, which on an Uno
+# quickly eats most of the 2 KB. every distinct literal becomes one
+# PROGMEM array instead and all the calls printing it share it
+# (F("...") would put a copy of the literal in flash for every call).
+# single characters stay char constants. on ARM constant strings
+# are read from flash anyway, so nothing changes there.
+
+PRINT_FUNCS = ('Serial.print', 'Serial.println')
+
+DECLARATION = 'const char {name}[] PROGMEM = {literal};\n'
+FLASH_ARG = 'reinterpret_cast<const __FlashStringHelper *>({name})'
+
+escapes = {'\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r', '\t': '\\t'}
+
+def uses_flash(pinmap):
+    return pinmap is not None and pinmap['arch'] == 'avr'
+
+def c_literal(text):
+    '''A C string literal with the same bytes as text'''
+    code = ''
+    for char in text:
+        if char in escapes:
+            code += escapes[char]
+        elif ' ' <= char <= '~':
+            code += char
+        else:
+            code += ''.join('\\{:03o}'.format(byte)
+                            for byte in char.encode('utf-8'))
+    return '"{}"'.format(code)
+
+def c_char(char):
+    '''A C char literal of a one-byte character'''
+    if char == "'":
+        return "'\\''"
+    return "'{}'".format(escapes.get(char, char))
+
+def is_flash_literal(node):
+    return isinstance(node, ast.Str) and len(node.s) != 1
+
+def flash_arg(text, strings):
+    '''The argument printing a literal from flash, the literal
+    gets added to strings (literal -> array name) if it's new'''
+    if text not in strings:
+        strings[text] = '_str{}'.format(len(strings))
+    return FLASH_ARG.format(name=strings[text])
+
+def printed_literals(parsed):
+    '''The string literal nodes which get printed from flash'''
+    nodes = []
+    for node in ast.walk(parsed):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name)
+            and '{}.{}'.format(node.func.value.id, node.func.attr) in PRINT_FUNCS):
+            nodes += [arg for arg in node.args if is_flash_literal(arg)]
+    return nodes
+
+def sram_saved(strings):
+    '''SRAM the literals would have taken, identical ones
+    get merged by the compiler either way'''
+    return sum(len(text.encode('utf-8')) + 1 for text in strings)
+
+def prelude(strings):
+    code = '// string literals printed straight from flash\n'
+    for text, name in strings.items():
+        code += DECLARATION.format(name=name, literal=c_literal(text))
+    return code
+
+def format_report(strings, uses):
+    return ('{} string literals printed from flash ({} calls), '
+            '{} bytes of SRAM freed'.format(len(strings), uses,
+                sram_saved(strings)))
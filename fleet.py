@@ -0,0 +1,216 @@
+import asyncio, glob, os, shlex, signal, sys, time
+from argparse import ArgumentParser
+
+import toolchain
+
+# uploads one firmware image to many boards at once. every port gets
+# its own uploader process (avrdude, bossac, ... from toolchains.json
+# or any command given), at most so many at a time. an upload that
+# fails or takes too long is tried again a few times before the port
+# is given up on. progress is shown as the uploads finish.
+#
+#   python fleet.py blink.hex '/dev/ttyACM*' --board uno -n 8
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RETRIES = 2
+DEFAULT_TIMEOUT = 60
+RETRY_DELAY = 1.0
+
+# lines of uploader output kept for the summary of a failed port
+OUTPUT_LINES = 5
+
+class FleetError(Exception):
+    pass
+
+def expand_ports(specs):
+    '''Ports from a list of names, comma-separated names and globs'''
+    if isinstance(specs, str):
+        specs = [specs]
+
+    ports = []
+    for spec in specs:
+        for pattern in spec.split(','):
+            pattern = pattern.strip()
+            if not pattern:
+                continue
+            if glob.has_magic(pattern):
+                matches = sorted(glob.glob(pattern))
+                if not matches:
+                    raise FleetError('No ports match {}'.format(pattern))
+            else:
+                matches = [pattern]
+            ports += [port for port in matches if port not in ports]
+    return ports
+
+def upload_command(image, port, board=None, command=None):
+    '''The uploader arguments for a port, from a command template
+    with {port} and {image} in it or else from the board's toolchain'''
+    if command is not None:
+        template = shlex.split(command)
+    elif board is not None:
+        template = toolchain.Toolchain(board).settings['upload']
+    else:
+        raise FleetError('Give a board or an upload command')
+    return [arg.format(port=port, image=image) for arg in template]
+
+class Progress:
+    '''Counts the uploads and shows the running totals,
+    on one line on a terminal and a line per upload otherwise'''
+
+    def __init__(self, total, stream=sys.stdout):
+        self.total = total
+        self.stream = stream
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.retries = 0
+        self.start = time.perf_counter()
+        self.live = stream.isatty()
+
+    def show(self, message=None):
+        status = '[{}/{}] {} ok, {} failed, {} running, {} retries, {:.0f} s'.format(
+            self.done + self.failed, self.total, self.done, self.failed,
+            self.running, self.retries, time.perf_counter() - self.start)
+        if self.live:
+            if message:
+                self.stream.write('\r\033[K' + message + '\n')
+            self.stream.write('\r\033[K' + status)
+        elif message:
+            self.stream.write('{}  {}\n'.format(status, message))
+        self.stream.flush()
+
+    def started(self):
+        self.running += 1
+        self.show()
+
+    def stopped(self):
+        self.running -= 1
+
+    def retrying(self, port, reason):
+        self.retries += 1
+        self.show('{}: {}, trying again'.format(port, reason))
+
+    def finished(self, result):
+        if result['status'] == 'ok':
+            self.done += 1
+        else:
+            self.failed += 1
+        self.show('{port}: {status} after {attempts} attempt(s)'.format(**result))
+
+    def close(self):
+        if self.live:
+            self.stream.write('\n')
+            self.stream.flush()
+
+async def run_uploader(args, timeout):
+    '''Runs one upload, returns its exit code (None on a timeout)
+    and its output'''
+    # in a session of its own, so a hung uploader
+    # can be killed together with anything it started
+    process = await asyncio.create_subprocess_exec(*args,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+        start_new_session=True)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        output, _ = await process.communicate()
+        return None, output.decode('utf-8', 'replace')
+    return process.returncode, output.decode('utf-8', 'replace')
+
+async def upload_port(port, args, limit, retries, timeout, progress):
+    start = None
+    attempts = 0
+    while True:
+        attempts += 1
+        # a slot per attempt, a port waiting to try again doesn't hold one
+        async with limit:
+            if start is None:
+                start = time.perf_counter()
+            progress.started()
+            try:
+                returncode, output = await run_uploader(args, timeout)
+            except OSError as error:
+                returncode, output = -1, str(error)
+            finally:
+                progress.stopped()
+
+        if returncode == 0:
+            status = 'ok'
+            break
+        status = ('timed out' if returncode is None
+                    else 'failed ({})'.format(returncode))
+        if attempts > retries:
+            break
+        progress.retrying(port, status)
+        await asyncio.sleep(RETRY_DELAY * attempts)
+
+    result = {
+        'port': port,
+        'status': status,
+        'attempts': attempts,
+        'seconds': time.perf_counter() - start,
+        'output': '\n'.join(output.strip().splitlines()[-OUTPUT_LINES:])
+    }
+    progress.finished(result)
+    return result
+
+async def upload_all(image, ports, board=None, command=None,
+    concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES,
+    timeout=DEFAULT_TIMEOUT, stream=sys.stdout):
+    limit = asyncio.Semaphore(concurrency)
+    progress = Progress(len(ports), stream)
+    try:
+        return await asyncio.gather(*[upload_port(port,
+            upload_command(image, port, board, command), limit, retries,
+            timeout, progress) for port in ports])
+    finally:
+        progress.close()
+
+def upload_fleet(image, ports, board=None, command=None,
+    concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES,
+    timeout=DEFAULT_TIMEOUT, stream=sys.stdout):
+    '''Uploads an image to every port, returns a result per port
+    in the order of the ports'''
+    if not os.path.exists(image):
+        raise FleetError('No image at {}'.format(image))
+    return asyncio.run(upload_all(image, expand_ports(ports), board, command,
+        concurrency, retries, timeout, stream))
+
+def format_table(results):
+    lines = ['{:<28} {:<12} {:>8} {:>8}'.format('port', 'status', 'attempts',
+        'seconds')]
+    for result in results:
+        lines.append('{port:<28} {status:<12} {attempts:>8} '
+            '{seconds:>8.1f}'.format(**result))
+        if result['status'] != 'ok' and result['output']:
+            lines += ['    ' + line for line in result['output'].splitlines()]
+
+    failed = sum(1 for result in results if result['status'] != 'ok')
+    lines.append('{} of {} uploads succeeded'.format(len(results) - failed,
+        len(results)))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    argp = ArgumentParser(description='uploads a firmware image to many boards')
+    argp.add_argument('image', help='the .hex or .bin to upload')
+    argp.add_argument('ports', nargs='+', help='serial ports, comma-separated '
+        'lists or globs like /dev/ttyACM*')
+    argp.add_argument('-b', '--board', default=None,
+        help='board whose uploader to use (see toolchains.json)')
+    argp.add_argument('--command', default=None, help='uploader command '
+        'with {port} and {image} in it instead of the board\'s')
+    argp.add_argument('-n', '--concurrency', type=int,
+        default=DEFAULT_CONCURRENCY, help='uploads at the same time')
+    argp.add_argument('--retries', type=int, default=DEFAULT_RETRIES)
+    argp.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+        help='seconds an upload may take')
+    args = argp.parse_args()
+
+    results = upload_fleet(args.image, args.ports, args.board, args.command,
+        args.concurrency, args.retries, args.timeout)
+    print(format_table(results))
+    sys.exit(0 if all(result['status'] == 'ok' for result in results) else 1)
@@ -0,0 +1,258 @@
+import errno, json, os, sys, time
+
+import numpy as np
+
+import telemetry
+
+# host-side decoder for the binary frames sent with Serial.send
+# (see telemetry.py for the frame layout). frames are found, checked
+# and unpacked with whole-array operations, so a byte stream from a file,
+# a pipe or a serial port/pty decodes into NumPy structured arrays,
+# one per schema, at well over 10 MB/s.
+
+HEADER_SIZE = telemetry.HEADER_SIZE
+CHECKSUM_SIZE = telemetry.CHECKSUM_SIZE
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+def load_schemas(schemas):
+    '''Returns the dtype of every schema number, from the schema file
+    written next to the sketch, its contents or the parsed JSON'''
+    if isinstance(schemas, str):
+        if os.path.exists(schemas):
+            schemas = open(schemas).read()
+        schemas = json.loads(schemas)
+
+    return dict((schema['id'], np.dtype([tuple(field)
+                                for field in schema['fields']]))
+                for schema in schemas['schemas'])
+
+def encode(schema_id, dtype, values):
+    '''Packs one frame the way the sketch does, for tests and simulations'''
+    payload = np.array([tuple(values)], dtype=dtype).tobytes()
+    header = bytes(telemetry.SYNC) + bytes([schema_id, len(payload)])
+    checksum = (schema_id + len(payload) + sum(payload)) & 0xFF
+    return header + payload + bytes([checksum])
+
+class Decoder:
+    '''Decodes a byte stream fed in chunks of any size.
+    Bytes of a frame cut off at the end of a chunk are kept
+    until the rest of it comes in.'''
+
+    def __init__(self, schemas):
+        self.dtypes = load_schemas(schemas)
+        self.pending = b''
+        self.frames = dict((schema_id, 0) for schema_id in self.dtypes)
+        self.bad_checksums = 0
+        self.skipped = 0
+
+        # payload length of every schema number, -1 for unknown ones
+        self.lengths = np.full(256, -1, dtype=np.int32)
+        for schema_id, dtype in self.dtypes.items():
+            self.lengths[schema_id] = dtype.itemsize
+        self.max_frame = HEADER_SIZE + CHECKSUM_SIZE + max(
+            [dtype.itemsize for dtype in self.dtypes.values()] or [0])
+
+    def find_frames(self, buf):
+        '''Returns the start, schema number and frame length of every
+        complete frame with a good checksum, in the order they came in'''
+        sync0, sync1 = telemetry.SYNC
+        starts = np.flatnonzero((buf[:-1] == sync0) & (buf[1:] == sync1))
+        starts = starts[starts + HEADER_SIZE <= len(buf)]
+
+        schema_ids = buf[starts + 2]
+        lengths = buf[starts + 3].astype(np.int32)
+        known = self.lengths[schema_ids] == lengths
+        starts, schema_ids, lengths = starts[known], schema_ids[known], lengths[known]
+
+        found = []
+        for schema_id in np.unique(schema_ids):
+            frame_size = HEADER_SIZE + int(self.lengths[schema_id]) + CHECKSUM_SIZE
+            candidates = starts[schema_ids == schema_id]
+            candidates = candidates[candidates + frame_size <= len(buf)]
+            frames = buf[candidates[:, None] + np.arange(frame_size)]
+
+            checksums = frames[:, 2:-1].sum(axis=1, dtype=np.uint32) & 0xFF
+            good = checksums == frames[:, -1]
+            self.bad_checksums += int(np.count_nonzero(~good))
+            found.append((candidates[good], np.full(np.count_nonzero(good),
+                schema_id, dtype=np.uint8), frame_size))
+
+        if not found:
+            return (np.empty(0, dtype=np.intp), np.empty(0, dtype=np.uint8),
+                    np.empty(0, dtype=np.intp))
+
+        starts = np.concatenate([frame[0] for frame in found])
+        schema_ids = np.concatenate([frame[1] for frame in found])
+        sizes = np.concatenate([np.full(len(frame[0]), frame[2], dtype=np.intp)
+                                for frame in found])
+        order = np.argsort(starts, kind='stable')
+        starts, schema_ids, sizes = starts[order], schema_ids[order], sizes[order]
+
+        # a sync pattern inside a payload can pass the checksum by chance,
+        # the frame that starts first wins
+        if np.any(starts[1:] < starts[:-1] + sizes[:-1]):
+            keep = np.zeros(len(starts), dtype=bool)
+            end = 0
+            for n, start in enumerate(starts):
+                if start >= end:
+                    keep[n] = True
+                    end = start + sizes[n]
+            starts, schema_ids, sizes = starts[keep], schema_ids[keep], sizes[keep]
+
+        return starts, schema_ids, sizes
+
+    def feed(self, data):
+        '''Decodes a chunk of the stream and returns
+        the structured array of every schema found in it'''
+        buf = np.frombuffer(self.pending + bytes(data), dtype=np.uint8)
+        starts, schema_ids, sizes = self.find_frames(buf)
+
+        decoded = {}
+        for schema_id in np.unique(schema_ids):
+            dtype = self.dtypes[int(schema_id)]
+            payload_starts = starts[schema_ids == schema_id] + HEADER_SIZE
+            payloads = buf[payload_starts[:, None] + np.arange(dtype.itemsize)]
+            decoded[int(schema_id)] = np.ascontiguousarray(payloads).view(
+                dtype).reshape(-1)
+            self.frames[int(schema_id)] += len(payload_starts)
+
+        # whatever is left could be the beginning of a frame
+        end = int(starts[-1] + sizes[-1]) if len(starts) else 0
+        keep_from = max(end, len(buf) - self.max_frame + 1, 0)
+        self.skipped += keep_from - int(sizes.sum())
+        self.pending = buf[keep_from:].tobytes()
+
+        return decoded
+
+def read_chunks(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Yields chunks from a file name, a file object
+    or a file descriptor (e.g. a serial port or pty) until it ends'''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield bytes(source)
+        return
+
+    if isinstance(source, str):
+        with open(source, 'rb') as stream:
+            yield from read_chunks(stream, chunk_size)
+        return
+
+    if isinstance(source, int):
+        while True:
+            try:
+                chunk = os.read(source, chunk_size)
+            except OSError as error:
+                # the other side of a pty went away
+                if error.errno == errno.EIO:
+                    return
+                raise
+            if not chunk:
+                return
+            yield chunk
+
+    stream = getattr(source, 'buffer', source)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def decode(source, schemas, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Decodes a whole stream into one structured array per schema'''
+    decoder = Decoder(schemas)
+    parts = dict((schema_id, []) for schema_id in decoder.dtypes)
+
+    for chunk in read_chunks(source, chunk_size):
+        for schema_id, frames in decoder.feed(chunk).items():
+            parts[schema_id].append(frames)
+
+    return dict((schema_id, np.concatenate(parts[schema_id])
+                    if parts[schema_id]
+                    else np.empty(0, dtype=decoder.dtypes[schema_id]))
+                for schema_id in parts)
+
+def synthetic_stream(schemas, count, seed=0, noise=0.01):
+    '''Builds a stream of random frames with some garbage bytes
+    in between, along with the frames it contains'''
+    dtypes = load_schemas(schemas)
+    rng = np.random.default_rng(seed)
+    schema_ids = np.array(sorted(dtypes), dtype=np.uint8)
+    order = rng.choice(schema_ids, size=count)
+
+    expected = {}
+    pieces = {}
+    for schema_id in schema_ids:
+        dtype = dtypes[int(schema_id)]
+        frame_count = int(np.count_nonzero(order == schema_id))
+        raw = rng.integers(0, 256, size=(frame_count, dtype.itemsize),
+            dtype=np.uint8)
+        expected[int(schema_id)] = raw.copy().view(dtype).reshape(-1)
+
+        frames = np.empty((frame_count, HEADER_SIZE + dtype.itemsize
+                            + CHECKSUM_SIZE), dtype=np.uint8)
+        frames[:, :2] = telemetry.SYNC
+        frames[:, 2] = schema_id
+        frames[:, 3] = dtype.itemsize
+        frames[:, HEADER_SIZE:-1] = raw
+        frames[:, -1] = frames[:, 2:-1].sum(axis=1, dtype=np.uint32) & 0xFF
+        pieces[int(schema_id)] = list(frames)
+
+    stream = bytearray()
+    taken = dict((int(schema_id), 0) for schema_id in schema_ids)
+    for schema_id in order:
+        schema_id = int(schema_id)
+        stream += pieces[schema_id][taken[schema_id]].tobytes()
+        taken[schema_id] += 1
+        if rng.random() < noise:
+            stream += rng.integers(0, 256, size=rng.integers(1, 8),
+                dtype=np.uint8).tobytes()
+
+    return bytes(stream), expected
+
+def benchmark(schemas, count=200000, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Decodes a synthetic stream and returns the throughput in MB/s
+    and whether every frame came out right'''
+    stream, expected = synthetic_stream(schemas, count)
+
+    start = time.perf_counter()
+    decoded = decode(stream, schemas, chunk_size)
+    elapsed = time.perf_counter() - start
+
+    # random garbage can be mistaken for a frame once in a while,
+    # so it's enough for every frame sent to be among the decoded ones
+    correct = True
+    for schema_id, frames in expected.items():
+        raw = np.dtype(('V', frames.dtype.itemsize))
+        correct = correct and bool(np.isin(frames.view(raw),
+            decoded[schema_id].view(raw)).all())
+
+    return {
+        'bytes': len(stream),
+        'frames': count,
+        'seconds': elapsed,
+        'mb_per_s': len(stream) / elapsed / 1e6,
+        'correct': correct
+    }
+
+EXAMPLE_SCHEMAS = {'schemas': [
+    {'id': 0, 'fields': [['millis', '<u4'], ['x', '<i2'], ['y', '<i2'],
+                        ['z', '<i2']]},
+    {'id': 1, 'fields': [['temperature', '<f4'], ['ok', 'u1']]}
+]}
+
+if __name__ == '__main__':
+    # python frames.py SCHEMA_FILE [CAPTURE]: decodes a capture (or stdin)
+    # python frames.py: decoding throughput on a synthetic stream
+    if len(sys.argv) > 1:
+        source = sys.argv[2] if len(sys.argv) > 2 else sys.stdin.buffer
+        decoded = decode(source, sys.argv[1])
+        for schema_id, frames in sorted(decoded.items()):
+            print('schema {}: {} frames'.format(schema_id, len(frames)))
+            print(frames[:5])
+    else:
+        result = benchmark(EXAMPLE_SCHEMAS)
+        print('{frames} frames, {bytes} bytes in {seconds:.3f} s: '
+            '{mb_per_s:.1f} MB/s'.format(**result))
+        if not result['correct']:
+            print('decoded frames do not match')
+            sys.exit(1)
@@ -0,0 +1,190 @@
+import ast, json
+from warnings import warn
+
+# profiling probes for running sketches on the board. with --instrument
+# every user function starts with a probe object: its constructor reads
+# the clock and its destructor, which runs on every way out of the
+# function, adds the call to a static table of calls, total, self and
+# max microseconds per function. self time leaves out the time spent in
+# other probed functions. loop() prints the table every DUMP_PERIOD ms
+# as one line:
+#
+#   @P count,total,self,max count,total,self,max ...
+#
+# with the numbers in hex, one group per function in the order of the
+# names saved next to the sketch. probereport.py turns it into a profile.
+#
+# on AVR the clock is timer 0 read directly, the count millis() and
+# micros() work from, in steps of 4 us at 16 MHz. a probe costs two
+# reads of about 15 cycles and some 40 cycles of 32-bit bookkeeping,
+# around 5 us per call on an Uno (other boards call micros()). the first
+# dump times CALIBRATION_PROBES empty probes into an extra group at the
+# end of the line and probereport.py takes their mean off every call.
+# interrupt handlers aren't probed as they'd race the main program
+# for the table. the counters wrap after 2^32 us, about 71 minutes.
+#
+# a sketch that doesn't start Serial itself gets Serial.begin(BAUD_RATE)
+# at the top of setup(), the rate is saved along with the names.
+
+DUMP_PERIOD = 1000
+DUMP_PREFIX = '@P'
+BAUD_RATE = 9600
+CALIBRATION_PROBES = 64
+
+MODES = ('functions', 'loop')
+
+PRELUDE = '''// profiling probes: calls, total, self and max clock ticks per function,
+// the last entry times empty probes
+#if defined(__AVR__)
+// the overflows the core counts for millis() and the timer itself
+extern volatile unsigned long timer0_overflow_count;
+#define _PROBE_TICK_US (64 / clockCyclesPerMicrosecond())
+
+static inline uint32_t _probe_clock() {{
+    uint8_t sreg = SREG;
+    cli();
+    uint32_t overflows = timer0_overflow_count;
+    uint8_t ticks = TCNT0;
+    // an overflow whose interrupt hasn't run yet
+    if ((TIFR0 & _BV(TOV0)) && ticks < 255) overflows++;
+    SREG = sreg;
+    return (overflows << 8) | ticks;
+}}
+#else
+#define _PROBE_TICK_US 1
+
+static inline uint32_t _probe_clock() {{
+    return micros();
+}}
+#endif
+
+struct _ProbeStats {{
+    uint32_t count, total, self, max;
+}};
+_ProbeStats _probes[{count} + 1];
+uint32_t _probe_children = 0;
+unsigned long _probe_dumped = 0;
+boolean _probe_calibrated = false;
+
+struct _Probe {{
+    uint8_t id;
+    uint32_t start, saved;
+
+    _Probe(uint8_t id) : id(id), saved(_probe_children) {{
+        _probe_children = 0;
+        start = _probe_clock();
+    }}
+
+    ~_Probe() {{
+        uint32_t elapsed = _probe_clock() - start;
+        _ProbeStats &stats = _probes[id];
+        stats.count++;
+        stats.total += elapsed;
+        stats.self += elapsed - _probe_children;
+        if (elapsed > stats.max) stats.max = elapsed;
+        _probe_children = saved + elapsed;
+    }}
+}};
+
+void _probe_dump() {{
+    if (!_probe_calibrated) {{
+        for (uint8_t i = 0; i < {calibration}; i++) {{
+            _Probe probe({count});
+        }}
+        _probe_children = 0;
+        _probe_calibrated = true;
+    }}
+    if (millis() - _probe_dumped < {period}) return;
+    _probe_dumped = millis();
+    Serial.print(F("{prefix}"));
+    // in microseconds, wrapping around at 2^32 like the ticks do
+    for (uint8_t i = 0; i <= {count}; i++) {{
+        Serial.print(' ');
+        Serial.print(_probes[i].count, HEX);
+        Serial.print(',');
+        Serial.print(_probes[i].total * _PROBE_TICK_US, HEX);
+        Serial.print(',');
+        Serial.print(_probes[i].self * _PROBE_TICK_US, HEX);
+        Serial.print(',');
+        Serial.print(_probes[i].max * _PROBE_TICK_US, HEX);
+    }}
+    Serial.println();
+}}
+'''
+PROBE = '{indent}_Probe _probe({id})\n'
+DUMP = '{indent}_probe_dump()\n'
+BEGIN = '{indent}Serial.begin({baud})\n'
+
+# a probe id is a uint8_t
+MAX_PROBES = 256
+
+class InstrumentWarning(Warning):
+    pass
+
+def probe_id(name, probes):
+    '''The table index of a function, added if it's new
+    (functions can be translated more than once)'''
+    if name not in probes:
+        if len(probes) >= MAX_PROBES:
+            warn('only the first {} functions are probed, {} is not'.format(
+                MAX_PROBES, name), InstrumentWarning)
+            return None
+        probes.append(name)
+    return probes.index(name)
+
+def serial_baud_rate(parsed, constants):
+    '''Whether the sketch calls Serial.begin itself and the baud rate
+    the dump goes out at (None if it's only known at runtime)'''
+    for node in ast.walk(parsed):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name)
+            and node.func.value.id == 'Serial' and node.func.attr == 'begin'):
+            baud = node.args[0] if node.args else None
+            if isinstance(baud, ast.Num) and type(baud.n) is int:
+                return True, baud.n
+            if isinstance(baud, ast.Name) and baud.id in constants:
+                return True, constants[baud.id]
+            return True, None
+    return False, BAUD_RATE
+
+def begin_code(indent, begins_serial):
+    '''Starts Serial for the dump unless the sketch does'''
+    return '' if begins_serial else BEGIN.format(indent=indent, baud=BAUD_RATE)
+
+def wrap_body(func_name, body_code, indent, mode, probes, handlers,
+    begins_serial):
+    '''Adds the probe to a function body, loop() also gets the dump
+    (before its own probe, so that printing isn't counted) and setup()
+    starts Serial if the sketch doesn't'''
+    if func_name in [handler['name'] for handler in handlers]:
+        return body_code
+
+    if func_name == 'loop':
+        code = DUMP.format(indent=indent)
+        n = probe_id(func_name, probes) if mode == 'loop' else None
+        if n is not None:
+            code += PROBE.format(indent=indent, id=n)
+        return code + body_code
+
+    n = probe_id(func_name, probes)
+    if n is not None:
+        body_code = PROBE.format(indent=indent, id=n) + body_code
+    if func_name == 'setup':
+        body_code = begin_code(indent, begins_serial) + body_code
+    return body_code
+
+def dump_code(indent):
+    return DUMP.format(indent=indent)
+
+def prelude(probes):
+    return PRELUDE.format(count=len(probes), period=DUMP_PERIOD,
+        prefix=DUMP_PREFIX, calibration=CALIBRATION_PROBES)
+
+def probes_json(probes, baud_rate=BAUD_RATE):
+    '''The function names saved next to the sketch for probereport.py'''
+    return json.dumps({
+        'prefix': DUMP_PREFIX,
+        'period_ms': DUMP_PERIOD,
+        'baud_rate': baud_rate,
+        'functions': probes
+    }, indent=2)
@@ -0,0 +1,281 @@
+import ast
+from warnings import warn
+
+import compiler, portio
+
+# functions decorated with @on_change(pin), @on_rising(pin) or
+# @on_falling(pin) become interrupt handlers instead of being polled.
+# pins with an external interrupt use attachInterrupt, other AVR pins
+# get a pin change ISR per port which works out the edge itself.
+# debounced handlers only record the time of the last edge in the
+# interrupt, a 1 ms timer (timer 0 compare on AVR, loop() elsewhere)
+# runs them once the pin has been stable long enough
+
+decorators = {'on_change': 'CHANGE', 'on_rising': 'RISING', 'on_falling': 'FALLING'}
+
+# calls which block or rely on interrupts themselves
+disallowed_calls = ('delay', 'delayMicroseconds', 'pulseIn', 'analogRead')
+
+ATTACH = '{indent}attachInterrupt(digitalPinToInterrupt({pin}), {target}, {mode})\n'
+PIN_CHANGE_ENABLE = '''{indent}PCMSK{group} |= _BV({bit})
+{indent}PCICR |= _BV(PCIE{group})
+{indent}_pcint{group}_last = PIN{port}
+'''
+LEVEL_START = '{indent}_{name}_level = digitalRead({pin})\n'
+# timer 0 runs millis() and leaves its compare interrupt free,
+# it fires once every millisecond
+DEBOUNCE_TIMER_ENABLE = '''{indent}OCR0A = 0xAF
+{indent}TIMSK0 |= _BV(OCIE0A)
+'''
+
+PIN_CHANGE_ISR = '''ISR(PCINT{group}_vect) {{
+    uint8_t pins = PIN{port}
+    uint8_t changed = pins ^ _pcint{group}_last
+    _pcint{group}_last = pins
+{handlers}}}
+'''
+PIN_CHANGE_HANDLER = '''    if (changed & _BV({bit})) {{
+{trigger}    }}
+'''
+EDGE_CHECK = '''{indent}if ({test}) {{
+{indent}    {name}()
+{indent}}}
+'''
+DEBOUNCE_RECORD = '''{indent}_{name}_since = millis()
+{indent}_{name}_pending = true
+'''
+DEBOUNCE_STUB = '''void _{name}_isr() {{
+{record}}}
+'''
+DEBOUNCE_CONFIRM = '''{indent}if (_{name}_pending && millis() - _{name}_since >= {debounce}) {{
+{indent}    _{name}_pending = false
+{indent}    if (digitalRead({pin}) != _{name}_level) {{
+{indent}        _{name}_level = !_{name}_level
+{edge}{indent}    }}
+{indent}}}
+'''
+DEBOUNCE_TIMER_ISR = '''ISR(TIMER0_COMPA_vect) {{
+{confirms}}}
+'''
+STUB_PROTOTYPE = 'void _{name}_isr();\n'
+
+class InterruptSafetyWarning(Warning):
+    pass
+
+def find_handlers(parsed, pinmap, constants):
+    '''Returns a description of every interrupt handler in the program'''
+    handlers = []
+    for func in parsed.body:
+        if not isinstance(func, ast.FunctionDef):
+            continue
+
+        for decorator in func.decorator_list:
+            if not (isinstance(decorator, ast.Call)
+                and isinstance(decorator.func, ast.Name)
+                and decorator.func.id in decorators):
+                continue
+
+            if func.args.args:
+                raise compiler.UnsupportedSyntaxError(
+                    'interrupt handler {} cannot take arguments'.format(func.name),
+                    func.lineno)
+
+            pin = None
+            if decorator.args:
+                pin = portio.pin_number(decorator.args[0], pinmap, constants)
+            if pin is None:
+                raise compiler.UnsupportedSyntaxError(
+                    '@{} needs a constant pin'.format(decorator.func.id),
+                    decorator.lineno)
+
+            debounce = 0
+            debounce_args = decorator.args[1:2] + [keyword.value
+                for keyword in decorator.keywords if keyword.arg == 'debounce']
+            for arg in debounce_args:
+                if not isinstance(arg, ast.Num):
+                    raise compiler.UnsupportedSyntaxError(
+                        'debounce has to be a constant in milliseconds',
+                        decorator.lineno)
+                debounce = arg.n
+
+            handler = {'name': func.name, 'pin': pin,
+                        'mode': decorators[decorator.func.id],
+                        'debounce': debounce, 'kind': 'external'}
+
+            # without a pin map the core has to sort it out
+            if pinmap is not None:
+                if str(pin) not in pinmap['pins']:
+                    raise compiler.UnsupportedSyntaxError(
+                        'no pin {} on this board'.format(pin), decorator.lineno)
+                external = pinmap['external_interrupts']
+                port, bit = pinmap['pins'][str(pin)]
+                if external != 'all' and pin not in external:
+                    if port not in pinmap['pin_change_groups']:
+                        raise compiler.UnsupportedSyntaxError(
+                            'pin {} has no interrupt'.format(pin),
+                            decorator.lineno)
+                    handler.update(kind='pin_change', port=port, bit=bit,
+                        group=pinmap['pin_change_groups'][port])
+
+            check_body(func)
+            handlers.append(handler)
+
+    return handlers
+
+def check_body(func):
+    '''Warns about calls which don't belong in an interrupt'''
+    for node in ast.walk(func):
+        if not isinstance(node, ast.Call):
+            continue
+
+        if isinstance(node.func, ast.Name):
+            name = node.func.id
+        elif (isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name)):
+            name = node.func.value.id
+        else:
+            continue
+
+        if name in disallowed_calls or name == 'Serial':
+            warn('{} in interrupt handler {} (line {}) is not interrupt-safe'.format(
+                name, func.name, node.lineno), InterruptSafetyWarning)
+
+def shared_globals(parsed, handlers, global_vars, constants):
+    '''Globals used both in an interrupt handler and elsewhere,
+    which have to be volatile. Constants never change.'''
+    handler_names = set(handler['name'] for handler in handlers)
+    in_handlers = set()
+    elsewhere = set()
+
+    for func in parsed.body:
+        if not isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        # the decorators only name the pin
+        names = set(node.id for stmt in func.body for node in ast.walk(stmt)
+                    if isinstance(node, ast.Name) and node.id in global_vars
+                    and node.id not in constants)
+        if func.name in handler_names:
+            in_handlers |= names
+        else:
+            elsewhere |= names
+
+    return in_handlers & elsewhere
+
+def handler_variables(handlers):
+    '''Global state of the handlers and its types'''
+    variables = {}
+    for handler in handlers:
+        if handler['kind'] == 'pin_change':
+            variables['_pcint{}_last'.format(handler['group'])] = 'volatile uint8_t'
+        if handler['debounce']:
+            name = handler['name']
+            variables['_{}_pending'.format(name)] = 'volatile boolean'
+            variables['_{}_since'.format(name)] = 'volatile unsigned long'
+            variables['_{}_level'.format(name)] = 'volatile uint8_t'
+    return variables
+
+def uses_debounce_timer(handlers, pinmap):
+    return (pinmap is not None and pinmap['arch'] == 'avr'
+            and any(handler['debounce'] for handler in handlers))
+
+def attach_code(handlers, pinmap, indent):
+    '''Code enabling the interrupts, run at the end of setup()'''
+    code = ''
+    enabled_groups = set()
+
+    for handler in handlers:
+        name = handler['name']
+        if handler['debounce']:
+            code += LEVEL_START.format(indent=indent, name=name,
+                pin=handler['pin'])
+
+        if handler['kind'] == 'external':
+            if handler['debounce']:
+                # every edge restarts the debounce time
+                code += ATTACH.format(indent=indent, pin=handler['pin'],
+                    target='_{}_isr'.format(name), mode='CHANGE')
+            else:
+                code += ATTACH.format(indent=indent, pin=handler['pin'],
+                    target=name, mode=handler['mode'])
+
+        elif handler['group'] not in enabled_groups:
+            enabled_groups.add(handler['group'])
+            code += PIN_CHANGE_ENABLE.format(indent=indent,
+                group=handler['group'], port=handler['port'], bit=handler['bit'])
+        else:
+            code += '{indent}PCMSK{group} |= _BV({bit})\n'.format(
+                indent=indent, group=handler['group'], bit=handler['bit'])
+
+    if uses_debounce_timer(handlers, pinmap):
+        code += DEBOUNCE_TIMER_ENABLE.format(indent=indent)
+
+    return code
+
+def edge_code(handler, indent):
+    '''Calls a debounced handler if the new level matches its edge'''
+    if handler['mode'] == 'CHANGE':
+        return '{indent}{name}()\n'.format(indent=indent, name=handler['name'])
+    level = 'HIGH' if handler['mode'] == 'RISING' else 'LOW'
+    return EDGE_CHECK.format(indent=indent, name=handler['name'],
+        test='_{}_level == {}'.format(handler['name'], level))
+
+def confirm_code(handlers, indent):
+    return ''.join(DEBOUNCE_CONFIRM.format(indent=indent,
+                        name=handler['name'], pin=handler['pin'],
+                        debounce=handler['debounce'],
+                        edge=edge_code(handler, indent + ' ' * 8))
+                    for handler in handlers if handler['debounce'])
+
+def poll_code(handlers, pinmap, indent):
+    '''Debounced handlers are confirmed from loop()
+    on boards without the AVR timer'''
+    if uses_debounce_timer(handlers, pinmap):
+        return ''
+    return confirm_code(handlers, indent)
+
+def pin_change_trigger(handler, indent):
+    if handler['debounce']:
+        return DEBOUNCE_RECORD.format(indent=indent, name=handler['name'])
+    if handler['mode'] == 'CHANGE':
+        return '{indent}{name}()\n'.format(indent=indent, name=handler['name'])
+
+    test = 'pins & _BV({})'.format(handler['bit'])
+    if handler['mode'] == 'FALLING':
+        test = '!({})'.format(test)
+    return EDGE_CHECK.format(indent=indent, name=handler['name'], test=test)
+
+def isr_code(handlers, pinmap):
+    '''The interrupt service routines and debouncing stubs'''
+    code = ''
+
+    for handler in handlers:
+        if handler['kind'] == 'external' and handler['debounce']:
+            code += DEBOUNCE_STUB.format(name=handler['name'],
+                record=DEBOUNCE_RECORD.format(indent=' ' * 4,
+                    name=handler['name']))
+
+    groups = []
+    for handler in handlers:
+        if handler['kind'] == 'pin_change' and handler['group'] not in groups:
+            groups.append(handler['group'])
+
+    for group in groups:
+        group_handlers = [handler for handler in handlers
+                            if handler['kind'] == 'pin_change'
+                            and handler['group'] == group]
+        code += PIN_CHANGE_ISR.format(group=group,
+            port=group_handlers[0]['port'],
+            handlers=''.join(PIN_CHANGE_HANDLER.format(bit=handler['bit'],
+                                trigger=pin_change_trigger(handler, ' ' * 8))
+                            for handler in group_handlers))
+
+    if uses_debounce_timer(handlers, pinmap):
+        code += DEBOUNCE_TIMER_ISR.format(
+            confirms=confirm_code(handlers, ' ' * 4))
+
+    return code
+
+def prototypes(handlers):
+    return ''.join(STUB_PROTOTYPE.format(name=handler['name'])
+                    for handler in handlers
+                    if handler['kind'] == 'external' and handler['debounce'])
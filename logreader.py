@@ -0,0 +1,350 @@
+import os, sys, termios, tty
+from argparse import ArgumentParser
+
+import numpy as np
+
+import frames
+
+# host-side reader for the text a sketch prints with Serial.println,
+# e.g. samples/analogRead.py. every line holds one value per channel
+# (separated by commas, tabs or spaces). lines are parsed a whole chunk
+# at a time into fixed-size ring buffers, one per channel, so memory
+# stays bounded however long the capture runs. samples pushed out of
+# a ring buffer can be spilled to a .npy file which np.load can map.
+
+DEFAULT_CAPACITY = 1 << 16
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+# bytes a line of numbers can be made of, separators included
+NUMERIC_BYTES = b'0123456789.+-eE ,;\t\r'
+SEPARATORS = b',;\t\r'
+
+allowed = np.zeros(256, dtype=bool)
+allowed[list(NUMERIC_BYTES)] = True
+whitespace = np.zeros(256, dtype=bool)
+whitespace[list(b' ' + SEPARATORS)] = True
+separator_table = bytes.maketrans(SEPARATORS, b' ' * len(SEPARATORS))
+
+# width of the row count in the header of a spill file,
+# so it can be updated in place as the file grows
+SPILL_ROWS_WIDTH = 20
+
+def baudrate_const(baudrate):
+    try:
+        return getattr(termios, 'B{}'.format(baudrate))
+    except AttributeError:
+        raise ValueError('Unsupported baudrate {}'.format(baudrate))
+
+def open_serial(path, baudrate=9600):
+    '''Opens a serial device or a pty in raw mode (or a FIFO or
+    a capture file as it is) and returns its file descriptor'''
+    fd = os.open(path, os.O_RDONLY | os.O_NOCTTY)
+    if os.isatty(fd):
+        tty.setraw(fd)
+        attrs = termios.tcgetattr(fd)
+        attrs[4] = attrs[5] = baudrate_const(baudrate)
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    return fd
+
+def parse_lines(text, channels=None):
+    '''Parses complete lines of numbers into a (lines, channels) array.
+    Lines which aren't all numbers or don't have as many values
+    as the others are skipped. Returns the values, the number
+    of channels and the number of lines skipped.'''
+    buf = np.frombuffer(text, dtype=np.uint8)
+    if len(buf) == 0:
+        return np.empty((0, channels or 0)), channels, 0
+
+    line_ends = np.flatnonzero(buf == ord('\n'))
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+
+    # the bytes of a line are checked and its values counted in one go
+    # for all the lines: a value starts wherever a number follows
+    # a separator or the start of the line
+    is_bad = ~allowed[buf]
+    is_bad[line_ends] = False
+    is_space = whitespace[buf] | (buf == ord('\n'))
+    value_starts = ~is_space
+    value_starts[1:] &= is_space[:-1]
+
+    bad = np.add.reduceat(is_bad.astype(np.intp), line_starts)
+    values = np.add.reduceat(value_starts.astype(np.intp), line_starts)
+
+    good = (bad == 0) & (values > 0)
+    if channels is None:
+        if not good.any():
+            return np.empty((0, 0)), None, len(line_starts)
+        # the most common number of values per line
+        channels = int(np.bincount(values[good]).argmax())
+    good &= values == channels
+
+    # keep the bytes of the good lines only
+    line_numbers = np.cumsum(np.concatenate(([0], buf[:-1] == ord('\n'))))
+    kept = buf[good[line_numbers]].tobytes().translate(separator_table)
+
+    try:
+        parsed = np.array(kept.split(), dtype=np.float64).reshape(-1, channels)
+    except ValueError:
+        # something like 1-2 slipped through, sort it out line by line
+        parsed = parse_slowly(kept.splitlines(), channels)
+
+    skipped = len(line_starts) - len(parsed)
+    return parsed, channels, skipped
+
+def parse_slowly(lines, channels):
+    rows = []
+    for line in lines:
+        try:
+            rows.append([float(value) for value in line.split()])
+        except ValueError:
+            pass
+    return np.array(rows, dtype=np.float64).reshape(-1, channels)
+
+class SpillFile:
+    '''A .npy file that rows get appended to. The shape in the header
+    has a fixed width, so it's rewritten in place after every append.'''
+
+    def __init__(self, path, channels, dtype=np.float64):
+        self.path = path
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.file = open(path, 'wb')
+        self.write_header()
+
+    def header(self):
+        shape = '({:>{width}}, {})'.format(self.rows, self.channels,
+            width=SPILL_ROWS_WIDTH)
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(
+            self.dtype.str, shape)
+        # magic, version and header length come first,
+        # the data has to start on a multiple of 64 bytes
+        preamble = len(np.lib.format.magic(1, 0)) + 2
+        padding = -(preamble + len(header) + 1) % 64
+        header = header + ' ' * padding + '\n'
+        return (np.lib.format.magic(1, 0)
+                + len(header).to_bytes(2, 'little') + header.encode('latin1'))
+
+    def write_header(self):
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.seek(max(position, self.file.tell()))
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape(
+            -1, self.channels)
+        self.file.write(rows.tobytes())
+        self.rows += len(rows)
+        self.write_header()
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def load_spill(path):
+    '''Maps a spill file into memory without reading it'''
+    return np.load(path, mmap_mode='r')
+
+class RingBuffer:
+    '''Keeps the last capacity values of a channel along with
+    running statistics of every value that has come through'''
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, dtype=np.float64):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.start = 0
+        self.length = 0
+
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def __len__(self):
+        return self.length
+
+    def update_totals(self, values):
+        # merging the chunk's mean and variance in (Chan et al.)
+        count = len(values)
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        delta = mean - self.mean
+        total = self.count + count
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def extend(self, values):
+        '''Adds values and returns the ones pushed out'''
+        values = np.asarray(values, dtype=self.data.dtype)
+        if len(values) == 0:
+            return values
+        self.update_totals(values)
+
+        overflow = max(self.length + len(values) - self.capacity, 0)
+        pushed_out = self.values()[:overflow]
+        if overflow > self.length:
+            # even some of the new values don't fit
+            pushed_out = np.concatenate((pushed_out,
+                values[:overflow - self.length]))
+        values = values[-self.capacity:]
+
+        end = (self.start + self.length) % self.capacity
+        first = min(len(values), self.capacity - end)
+        self.data[end:end + first] = values[:first]
+        self.data[:len(values) - first] = values[first:]
+
+        self.length = min(self.length + len(values), self.capacity)
+        self.start = (end + len(values) - self.length) % self.capacity
+        return pushed_out
+
+    def values(self):
+        '''The values in the order they came in'''
+        end = self.start + self.length
+        if end <= self.capacity:
+            return self.data[self.start:end].copy()
+        return np.concatenate((self.data[self.start:],
+                                self.data[:end - self.capacity]))
+
+    def stats(self, window=None):
+        '''Statistics of the last window values (all of the buffer
+        by default) and of everything so far'''
+        values = self.values()
+        if window is not None:
+            values = values[-window:]
+
+        rolling = {'count': len(values)}
+        if len(values):
+            rolling.update(mean=float(values.mean()), std=float(values.std()),
+                min=float(values.min()), max=float(values.max()))
+
+        return {
+            'rolling': rolling,
+            'total': {
+                'count': self.count,
+                'mean': float(self.mean),
+                'std': float((self.m2 / self.count) ** 0.5) if self.count else 0.0,
+                'min': float(self.min),
+                'max': float(self.max)
+            }
+        }
+
+class LogReader:
+    '''Reads println output into a ring buffer per channel.
+    The number of channels is worked out from the first lines
+    unless it's given.'''
+
+    def __init__(self, channels=None, capacity=DEFAULT_CAPACITY, spill=None):
+        self.channels = channels
+        self.capacity = capacity
+        self.spill_path = spill
+        self.spill = None
+        self.buffers = []
+        self.pending = b''
+        self.lines = 0
+        self.skipped = 0
+
+    def setup(self, channels):
+        self.channels = channels
+        self.buffers = [RingBuffer(self.capacity) for n in range(channels)]
+        if self.spill_path is not None:
+            self.spill = SpillFile(self.spill_path, channels)
+
+    def feed(self, data):
+        '''Parses the complete lines in a chunk of output
+        and returns them as a (lines, channels) array'''
+        data = self.pending + bytes(data)
+        cut = data.rfind(b'\n') + 1
+        self.pending = data[cut:]
+
+        rows, channels, skipped = parse_lines(data[:cut], self.channels)
+        self.skipped += skipped
+        if channels is None:
+            return rows
+        if not self.buffers:
+            self.setup(channels)
+
+        self.lines += len(rows)
+        pushed_out = [buffer.extend(rows[:, n])
+                        for n, buffer in enumerate(self.buffers)]
+        if self.spill is not None and len(pushed_out[0]):
+            self.spill.append(np.column_stack(pushed_out))
+        return rows
+
+    def read(self, source, chunk_size=DEFAULT_CHUNK_SIZE, every=None,
+        callback=None):
+        '''Reads a file name, file object or file descriptor until it ends,
+        calling callback(reader) after every chunk or every N lines'''
+        reported = 0
+        for chunk in frames.read_chunks(source, chunk_size):
+            self.feed(chunk)
+            if callback is not None and (every is None
+                or self.lines - reported >= every):
+                reported = self.lines
+                callback(self)
+        self.close()
+
+    def values(self):
+        '''The buffered values as a (lines, channels) array'''
+        return np.column_stack([buffer.values() for buffer in self.buffers])
+
+    def stats(self, window=None):
+        return [buffer.stats(window) for buffer in self.buffers]
+
+    def close(self):
+        '''Spills whatever is still buffered, so that
+        the spill file holds the whole capture'''
+        if self.spill is not None and self.buffers:
+            self.spill.append(self.values())
+            self.spill.close()
+            self.spill = None
+
+def print_stats(reader, window=None):
+    print('{} lines, {} skipped'.format(reader.lines, reader.skipped))
+    for n, stats in enumerate(reader.stats(window)):
+        rolling, total = stats['rolling'], stats['total']
+        if not rolling['count']:
+            continue
+        print('  channel {}: last {} mean {:.4g} std {:.4g} min {:.4g} max {:.4g}'
+            ' | all {} mean {:.4g} std {:.4g}'.format(n, rolling['count'],
+                rolling['mean'], rolling['std'], rolling['min'], rolling['max'],
+                total['count'], total['mean'], total['std']))
+
+if __name__ == '__main__':
+    argp = ArgumentParser(description='reads the numbers a sketch prints')
+    argp.add_argument('source', help='serial device, pty or capture file '
+        '(- for stdin)')
+    argp.add_argument('-b', '--baudrate', type=int, default=9600)
+    argp.add_argument('--channels', type=int, default=None,
+        help='values per line (worked out from the first lines by default)')
+    argp.add_argument('--capacity', type=int, default=DEFAULT_CAPACITY,
+        help='values kept in memory per channel')
+    argp.add_argument('--window', type=int, default=None,
+        help='number of values for the rolling statistics')
+    argp.add_argument('--spill', default=None, metavar='FILE.npy',
+        help='save every value to a .npy file')
+    argp.add_argument('--every', type=int, default=None, metavar='LINES',
+        help='print the statistics every so many lines')
+    args = argp.parse_args()
+
+    if args.source == '-':
+        source = sys.stdin.buffer
+    elif os.path.exists(args.source) and not os.path.isfile(args.source):
+        source = open_serial(args.source, args.baudrate)
+    else:
+        source = args.source
+
+    reader = LogReader(args.channels, args.capacity, args.spill)
+    callback = None
+    if args.every is not None:
+        callback = lambda reader: print_stats(reader, args.window)
+
+    try:
+        reader.read(source, every=args.every, callback=callback)
+    except KeyboardInterrupt:
+        reader.close()
+    print_stats(reader, args.window)
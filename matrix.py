@@ -0,0 +1,120 @@
+import os, shutil, time
+from concurrent.futures import ThreadPoolExecutor
+
+from compiler import translate
+import boardinfo, modules, portio, toolchain
+
+# builds one sketch for many boards at once. the sketch is translated
+# once for every distinct pin map (boards with the same pin map, or
+# none, get the same code), then the boards are compiled concurrently
+# with the toolchain backend in a bounded pool. every board gets its
+# own output directory with the translation and the firmware image.
+# the modules the sketch imports are translated along with it.
+
+class MatrixError(Exception):
+    pass
+
+def resolve_boards(spec):
+    '''Turns a comma-separated list of boards or all into
+    (user-friendly name, full name) pairs, reading boards.json once'''
+    boards = boardinfo.load_table('boards.json')
+    if spec == 'all':
+        return sorted(boards.items())
+
+    resolved = []
+    full_names = dict((full, short) for short, full in boards.items())
+    for board in spec.split(','):
+        board = board.strip()
+        if board in boards:
+            resolved.append((board, boards[board]))
+        elif board in full_names:
+            resolved.append((full_names[board], board))
+        else:
+            raise MatrixError('Unknown board {}'.format(board))
+    return resolved
+
+def translate_for_boards(code, boards, fixed_point=None, directory='.'):
+    '''Translated code and module headers ({filename: text}) per board,
+    translating once per pin map'''
+    translations = {}
+    code_by_key = {}
+    for board, full_name in boards:
+        key = portio.translation_key(board)
+        if key not in code_by_key:
+            module_headers, imported = modules.translate_modules(code,
+                directory, board, fixed_point)
+            headers = dict((name + '.hpp', module['code'])
+                            for name, module in module_headers.items())
+            code_by_key[key] = translate(code, board=board,
+                fixed_point=fixed_point, modules=imported)['code'], headers
+        translations[board] = code_by_key[key]
+    return translations
+
+def image_size(path):
+    '''Bytes of firmware in an Intel hex or a binary image'''
+    if not path.endswith('.hex'):
+        return os.path.getsize(path)
+
+    size = 0
+    for line in open(path):
+        line = line.strip()
+        # data records only
+        if line.startswith(':') and line[7:9] == '00':
+            size += int(line[1:3], 16)
+    return size
+
+def build_board(board, code, headers, sketchname, output_dir, jobs=None):
+    result = {'board': board, 'output': os.path.join(output_dir, board)}
+    start = time.perf_counter()
+    try:
+        os.makedirs(result['output'], exist_ok=True)
+        toolchain.write_if_changed(os.path.join(result['output'],
+            sketchname + '.ino'), code)
+        for filename, text in headers.items():
+            toolchain.write_if_changed(os.path.join(result['output'],
+                filename), text)
+
+        build = toolchain.Toolchain(board, jobs=jobs).build(code, sketchname,
+            headers)
+        image = os.path.join(result['output'], os.path.basename(build['image']))
+        shutil.copyfile(build['image'], image)
+        result.update(status='ok', image=image, size=image_size(image),
+            cached_core=not build['core_built'])
+    except (toolchain.ToolchainError, OSError) as error:
+        result.update(status='failed', error=str(error))
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def build_matrix(code, sketchname, boards, output_dir=None, workers=None,
+    fixed_point=None, directory='.'):
+    '''Builds a sketch for every board, returns a result per board
+    in the order the boards were given. imported modules are
+    looked for in directory'''
+    boards = resolve_boards(boards) if isinstance(boards, str) else boards
+    if output_dir is None:
+        output_dir = sketchname
+    translations = translate_for_boards(code, boards, fixed_point, directory)
+
+    workers = max(1, min(workers or os.cpu_count(), len(boards)))
+    # the core of each board is compiled in parallel too,
+    # share the processors out between the boards
+    jobs = max(1, os.cpu_count() // workers)
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(build_board, board, *translations[board],
+                    sketchname=sketchname, output_dir=output_dir, jobs=jobs)
+                    for board, full_name in boards]
+        return [future.result() for future in futures]
+
+def format_table(results):
+    lines = ['{:<10} {:<7} {:>8} {:>10}  {}'.format('board', 'status',
+        'seconds', 'size', 'output')]
+    for result in results:
+        if result['status'] == 'ok':
+            lines.append('{board:<10} {status:<7} {seconds:>8.2f} '
+                '{size:>10}  {image}'.format(**result))
+        else:
+            error = (result['error'].strip().splitlines() or [''])[0]
+            lines.append('{board:<10} {status:<7} {seconds:>8.2f} {:>10}  '
+                '{}'.format('-', error, **result))
+    return '\n'.join(lines)
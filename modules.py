@@ -0,0 +1,145 @@
+import ast, glob, hashlib, json, os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from compiler import translate, CompilationError
+import config, portio, toolchain
+
+# translates the modules a sketch imports. the imports are followed
+# from the sketch into a graph of modules (found next to the sketch),
+# every module is translated once per build into <module>.hpp with an
+# include guard and a namespace of its own, so module.func() works and
+# a module imported from several places is still only defined once.
+#
+# a module is translated after the modules it imports, since it needs
+# their function types, the modules that don't depend on each other
+# are translated in parallel. the header and the exported functions
+# and globals of every module are cached by a hash of its source, the
+# exports of its imports and the translator's own sources, so only the
+# changed modules (and the ones importing them) get translated again.
+
+CACHE_DIR = 'modules'
+
+class ModuleError(CompilationError):
+    pass
+
+def find_imports(parsed):
+    '''(module name, line) of every import of a module'''
+    return [(alias.name, node.lineno) for node in ast.walk(parsed)
+            if isinstance(node, ast.Import) for alias in node.names]
+
+@lru_cache(maxsize=None)
+def translator_version():
+    '''Changes along with the translator, part of every cache key'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for path in sorted(glob.glob(os.path.join(here, '*.py'))
+                        + glob.glob(os.path.join(here, '*.json'))):
+        digest.update(open(path, 'rb').read())
+    return digest.hexdigest()
+
+class ModuleGraph:
+    '''The modules a sketch imports, directly or not'''
+
+    def __init__(self, code, directory='.'):
+        self.directory = directory
+        # name -> {'source', 'hash', 'imports'}
+        self.modules = {}
+
+        pending = find_imports(ast.parse(code))
+        while pending:
+            name, line = pending.pop()
+            if name in self.modules:
+                continue
+            path = os.path.join(directory, name + '.py')
+            try:
+                source = open(path).read()
+            except OSError:
+                raise ModuleError('module {} not found in {}'.format(name,
+                    os.path.abspath(directory)), line)
+            imports = find_imports(ast.parse(source))
+            self.modules[name] = {
+                'source': source,
+                'hash': hashlib.sha1(source.encode()).hexdigest(),
+                'imports': sorted(set(imported for imported, _ in imports))
+            }
+            pending += imports
+
+    def levels(self):
+        '''The modules in groups which only import modules of the groups
+        before them, the modules of a group are independent of each other'''
+        levels = []
+        done = set()
+        remaining = set(self.modules)
+        while remaining:
+            level = sorted(name for name in remaining
+                            if set(self.modules[name]['imports']) <= done)
+            if not level:
+                raise ModuleError('circular import between {}'.format(
+                    ', '.join(sorted(remaining))), -1)
+            levels.append(level)
+            done.update(level)
+            remaining.difference_update(level)
+        return levels
+
+def translate_module(name, source, board, fixed_point, modules):
+    '''Runs in a worker process, returns the header and the exports'''
+    translated = translate(source, board=board, fixed_point=fixed_point,
+        module=name, modules=modules)
+    return {'code': translated['code'], 'exports': translated['exports']}
+
+class ModuleCache:
+    '''Translated modules on disk, keyed by their source and context'''
+
+    def __init__(self, cache_path=None):
+        self.directory = os.path.join(os.path.expanduser(cache_path
+            or config.build_cache_path), CACHE_DIR)
+
+    def key(self, module, board, fixed_point, imported):
+        key = json.dumps([module['hash'], portio.translation_key(board),
+            fixed_point, imported, translator_version()], sort_keys=True)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, key):
+        try:
+            return json.load(open(os.path.join(self.directory, key + '.json')))
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, translated):
+        os.makedirs(self.directory, exist_ok=True)
+        toolchain.write_if_changed(os.path.join(self.directory, key + '.json'),
+            json.dumps(translated))
+
+def translate_modules(code, directory='.', board=None, fixed_point=None,
+    workers=None, cache_path=None):
+    '''Translates every module the code imports, returns
+    {name: {'code', 'exports', 'cached'}} and the exports of the
+    modules the code imports itself (for translate(modules=...))'''
+    graph = ModuleGraph(code, directory)
+    cache = ModuleCache(cache_path)
+    translated = {}
+
+    with ProcessPoolExecutor(workers) as executor:
+        for level in graph.levels():
+            futures = {}
+            for name in level:
+                module = graph.modules[name]
+                imported = dict((imported, translated[imported]['exports'])
+                                for imported in module['imports'])
+                key = cache.key(module, board, fixed_point, imported)
+                cached = cache.get(key)
+                if cached is not None:
+                    translated[name] = dict(cached, cached=True)
+                else:
+                    futures[name] = key, executor.submit(translate_module,
+                        name, module['source'], board, fixed_point, imported)
+
+            for name, (key, future) in futures.items():
+                result = future.result()
+                cache.put(key, result)
+                translated[name] = dict(result, cached=False)
+
+    imported = dict((name, translated[name]['exports'])
+                    for name, _ in find_imports(ast.parse(code)))
+    return translated, imported
@@ -0,0 +1,652 @@
+import glob, hashlib, os, random, subprocess, sys, tempfile, time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from compiler import translate
+import fixedpoint, simulator
+
+# builds a translated sketch with the host C++ compiler against a mock
+# Arduino core and runs it natively. the mock core keeps the same virtual
+# time as simulator.py (every call costs the same number of microseconds),
+# reads its inputs from the same kind of traces and records its outputs
+# the same way, so a native run and a simulated run of a sketch can be
+# compared event by event.
+#
+# sketches are translated without a board: the generated code then only
+# uses the Arduino API and none of the AVR/SAM registers, and int is
+# 32 bits wide like on the host.
+#
+#   python nativebuild.py samples/*.py
+#
+# the fixed-point helpers (see fixedpoint.py) are checked the same way,
+# on random operands against the exact results, which they have to
+# round correctly:
+#
+#   python nativebuild.py --fixed-point Q16.16
+
+DEFAULT_COMPILER = 'g++'
+DEFAULT_FLAGS = ['-O2', '-std=c++11', '-w']
+DEFAULT_ITERATIONS = 10000
+DEFAULT_OPERANDS = 20000
+# passes over the operands when timing the helpers
+DEFAULT_REPEAT = 50
+
+LIBS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libs')
+
+MOCK_CORE = '''// mock Arduino core for running sketches on the host
+#ifndef ARDUINO_H
+#define ARDUINO_H
+
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include <string>
+#include <vector>
+
+typedef bool boolean;
+typedef uint8_t byte;
+
+#define HIGH 1
+#define LOW 0
+#define INPUT 0
+#define OUTPUT 1
+#define INPUT_PULLUP 2
+#define DEC 10
+#define HEX 16
+#define OCT 8
+#define BIN 2
+#define CHANGE 1
+#define FALLING 2
+#define RISING 3
+
+{aliases}
+static const int _analog_pins[] = {{{analog_pins}}};
+static const int _analog_count = {analog_count};
+
+// microseconds spent in every call, the same as in the simulator
+{costs}
+#define _MAX_PINS 256
+
+struct _Trace {{
+    bool set;
+    unsigned long rate;
+    std::vector<long> values;
+}};
+
+struct _Event {{
+    char kind;
+    unsigned long long time;
+    int pin;
+    long value;
+    std::string text;
+}};
+
+struct _Handler {{
+    int pin;
+    int mode;
+    void (*func)();
+}};
+
+static unsigned long long _now_us = 0;
+static unsigned long _baudrate = 9600;
+static _Trace _analog[_MAX_PINS], _digital[_MAX_PINS];
+static int _modes[_MAX_PINS], _levels[_MAX_PINS];
+static bool _written[_MAX_PINS];
+static std::vector<_Event> _events;
+static std::vector<_Handler> _handlers;
+static std::vector<uint8_t> _serial_input;
+static size_t _serial_read = 0;
+
+static size_t _index(const _Trace &trace, unsigned long long time_us) {{
+    unsigned long long n = time_us * trace.rate / 1000000;
+    return n < trace.values.size() ? n : trace.values.size() - 1;
+}}
+
+static void _advance(unsigned long long us) {{
+    unsigned long long start = _now_us;
+    _now_us += us;
+    if (_handlers.empty() || _now_us == start) return;
+
+    // handlers run for every edge on a digital input in between
+    for (size_t h = 0; h < _handlers.size(); h++) {{
+        const _Trace &trace = _digital[_handlers[h].pin];
+        if (!trace.set) continue;
+        size_t first = _index(trace, start), last = _index(trace, _now_us);
+        for (size_t i = first; i < last; i++) {{
+            bool before = trace.values[i] != 0, after = trace.values[i + 1] != 0;
+            if (before == after) continue;
+            int mode = _handlers[h].mode;
+            if (mode == CHANGE || (mode == RISING && after) || (mode == FALLING && !after))
+                _handlers[h].func();
+        }}
+    }}
+}}
+
+static void _record(char kind, int pin, long value, const std::string &text = "") {{
+    _Event event = {{kind, _now_us, pin, value, text}};
+    _events.push_back(event);
+}}
+
+inline void pinMode(int pin, int mode) {{
+    _modes[pin] = mode;
+    _advance(_COST_pinMode);
+}}
+
+inline void digitalWrite(int pin, int level) {{
+    level = level != 0;
+    _levels[pin] = level;
+    _written[pin] = true;
+    _record('D', pin, level);
+    _advance(_COST_digitalWrite);
+}}
+
+inline int digitalRead(int pin) {{
+    _advance(_COST_digitalRead);
+    if (_digital[pin].set) return _digital[pin].values[_index(_digital[pin], _now_us)] != 0;
+    if (_written[pin]) return _levels[pin];
+    return _modes[pin] == INPUT_PULLUP;
+}}
+
+inline int analogRead(int pin) {{
+    _advance(_COST_analogRead);
+    // analogRead(0) reads A0 as well
+    if (!_analog[pin].set && pin < _analog_count) pin = _analog_pins[pin];
+    if (!_analog[pin].set) return 0;
+    return _analog[pin].values[_index(_analog[pin], _now_us)];
+}}
+
+inline void analogWrite(int pin, int value) {{
+    _record('A', pin, value);
+    _advance(_COST_analogWrite);
+}}
+
+inline unsigned long millis() {{
+    _advance(_COST_millis);
+    return _now_us / 1000;
+}}
+
+inline unsigned long micros() {{
+    _advance(_COST_micros);
+    return _now_us;
+}}
+
+inline void delay(unsigned long ms) {{ _advance(ms * 1000ULL); }}
+inline void delayMicroseconds(unsigned int us) {{ _advance(us); }}
+
+inline int digitalPinToInterrupt(int pin) {{ return pin; }}
+inline void attachInterrupt(int pin, void (*func)(), int mode) {{
+    _Handler handler = {{pin, mode, func}};
+    _handlers.push_back(handler);
+}}
+inline void noInterrupts() {{}}
+inline void interrupts() {{}}
+
+class _SerialPort {{
+public:
+    void begin(unsigned long baudrate) {{
+        _baudrate = baudrate;
+        _advance(_COST_Serial);
+    }}
+
+    int available() {{
+        _advance(_COST_Serial);
+        return _serial_input.size() - _serial_read;
+    }}
+
+    int read() {{
+        _advance(_COST_Serial);
+        if (_serial_read >= _serial_input.size()) return -1;
+        return _serial_input[_serial_read++];
+    }}
+
+    void write(uint8_t value) {{ out(std::string(1, (char) value)); }}
+    void write(const uint8_t *buffer, size_t length) {{
+        out(std::string((const char *) buffer, length));
+    }}
+
+    void print(const char *text) {{ out(text); }}
+    void print(char c) {{ out(std::string(1, c)); }}
+    void print(int value, int base = DEC) {{ out(number(value, base)); }}
+    void print(unsigned int value, int base = DEC) {{ out(number(value, base)); }}
+    void print(long value, int base = DEC) {{ out(number(value, base)); }}
+    void print(unsigned long value, int base = DEC) {{ out(number(value, base)); }}
+    void print(double value, int digits = 2) {{ out(decimal(value, digits)); }}
+
+    void println() {{ out("\\r\\n"); }}
+    void println(const char *text) {{ out(std::string(text) + "\\r\\n"); }}
+    void println(char c) {{ out(std::string(1, c) + "\\r\\n"); }}
+    void println(int value, int base = DEC) {{ out(number(value, base) + "\\r\\n"); }}
+    void println(unsigned int value, int base = DEC) {{ out(number(value, base) + "\\r\\n"); }}
+    void println(long value, int base = DEC) {{ out(number(value, base) + "\\r\\n"); }}
+    void println(unsigned long value, int base = DEC) {{ out(number(value, base) + "\\r\\n"); }}
+    void println(double value, int digits = 2) {{ out(decimal(value, digits) + "\\r\\n"); }}
+
+private:
+    static std::string number(long long value, int base) {{
+        if (base == DEC) return std::to_string(value);
+        std::string digits;
+        unsigned long long n = value;
+        do {{
+            digits.insert(digits.begin(), "0123456789ABCDEF"[n % base]);
+            n /= base;
+        }} while (n);
+        return digits;
+    }}
+
+    static std::string decimal(double value, int digits) {{
+        char buffer[64];
+        snprintf(buffer, sizeof(buffer), "%.*f", digits, value);
+        return buffer;
+    }}
+
+    static void out(const std::string &text) {{
+        _record('S', 0, 0, text);
+        // ten bits on the wire for every character
+        _advance(_COST_Serial + text.size() * 10000000ULL / _baudrate);
+    }}
+}};
+
+static _SerialPort Serial;
+
+#endif
+'''
+
+MAIN = '''
+#include <chrono>
+
+static void _load_inputs(const char *path) {
+    FILE *file = fopen(path, "r");
+    char kind;
+    while (fscanf(file, " %c", &kind) == 1) {
+        unsigned long count;
+        if (kind == 's') {
+            fscanf(file, "%lu", &count);
+            for (unsigned long i = 0; i < count; i++) {
+                unsigned int value;
+                fscanf(file, "%u", &value);
+                _serial_input.push_back(value);
+            }
+            continue;
+        }
+        int pin;
+        unsigned long rate;
+        fscanf(file, "%d %lu %lu", &pin, &rate, &count);
+        _Trace &trace = kind == 'a' ? _analog[pin] : _digital[pin];
+        trace.set = true;
+        trace.rate = rate;
+        trace.values.resize(count);
+        for (unsigned long i = 0; i < count; i++) fscanf(file, "%ld", &trace.values[i]);
+    }
+    fclose(file);
+}
+
+int main(int argc, char **argv) {
+    // iterations and end time (-1 for no limit) and the inputs file
+    long long iterations = atoll(argv[1]), end_us = atoll(argv[2]), done = 0;
+    _load_inputs(argv[3]);
+
+    std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+    setup();
+    while ((iterations < 0 || done < iterations) && (end_us < 0 || (long long) _now_us < end_us)) {
+        loop();
+        _advance(_COST_loop);
+        done++;
+    }
+    long long elapsed = std::chrono::duration_cast<std::chrono::nanoseconds>(
+        std::chrono::steady_clock::now() - start).count();
+
+    for (size_t i = 0; i < _events.size(); i++) {
+        const _Event &event = _events[i];
+        if (event.kind == 'S') {
+            printf("S %llu ", event.time);
+            for (size_t c = 0; c < event.text.size(); c++) printf("%02x", (uint8_t) event.text[c]);
+            printf("\\n");
+        } else {
+            printf("%c %llu %d %ld\\n", event.kind, event.time, event.pin, event.value);
+        }
+    }
+    printf("T %lld %llu %lld\\n", done, _now_us, elapsed);
+    return 0;
+}
+'''
+
+SKETCH = '''#include "Arduino.h"
+#include "containers.hpp"
+
+{code}
+{main}'''
+
+# prints add, mul and div of every pair of raw operands and the first
+# one as fix_println prints it, one line per pair, then the host time
+# of the same operations on fixed_t and on float in ns, one line each
+FIXED_POINT_CHECK = '''#include <chrono>
+{prelude}
+static const fixed_t _a[] = {{{a}}};
+static const fixed_t _b[] = {{{b}}};
+static float _fa[{count}], _fb[{count}];
+
+// the volatile sink keeps the compiler from dropping the operations
+#define TIME_OP(label, type, expr) {{ \\
+    volatile type _sink; \\
+    std::chrono::steady_clock::time_point _start = std::chrono::steady_clock::now(); \\
+    for (int r = 0; r < {repeat}; r++) \\
+        for (long i = 0; i < {count}; i++) \\
+            _sink = (expr); \\
+    Serial.print("time " label " "); \\
+    Serial.println((unsigned long)std::chrono::duration_cast<std::chrono::nanoseconds>( \\
+        std::chrono::steady_clock::now() - _start).count()); \\
+}}
+
+void setup() {{
+    for (long i = 0; i < {count}; i++) {{
+        Serial.print((long)fix_add(_a[i], _b[i]));
+        Serial.print(' ');
+        Serial.print((long)fix_mul(_a[i], _b[i]));
+        Serial.print(' ');
+        Serial.print((long)fix_div(_a[i], _b[i]));
+        Serial.print(' ');
+        fix_println(_a[i], {digits});
+    }}
+
+    for (long i = 0; i < {count}; i++) {{
+        _fa[i] = (float)_a[i] / FIX_ONE;
+        _fb[i] = (float)_b[i] / FIX_ONE;
+    }}
+    TIME_OP("fixed add", fixed_t, fix_add(_a[i], _b[i]));
+    TIME_OP("float add", float, _fa[i] + _fb[i]);
+    TIME_OP("fixed mul", fixed_t, fix_mul(_a[i], _b[i]));
+    TIME_OP("float mul", float, _fa[i] * _fb[i]);
+    TIME_OP("fixed div", fixed_t, fix_div(_a[i], _b[i]));
+    TIME_OP("float div", float, _fa[i] / _fb[i]);
+}}
+
+void loop() {{
+}}
+'''
+
+class NativeBuildError(Exception):
+    pass
+
+def mock_core(board=None, costs=None):
+    '''The mock Arduino.h, with the pin aliases and call costs
+    of the simulated board'''
+    aliases = simulator.Board(board).aliases
+    all_costs = dict(simulator.DEFAULT_COSTS)
+    all_costs.update(costs or {})
+    analog_pins = [aliases['A{}'.format(n)] for n in range(len(aliases))
+                    if 'A{}'.format(n) in aliases]
+
+    return MOCK_CORE.format(
+        aliases='\n'.join('#define {} {}'.format(name, pin)
+                    for name, pin in sorted(aliases.items())),
+        analog_pins=', '.join(str(pin) for pin in analog_pins),
+        analog_count=len(analog_pins),
+        costs='\n'.join('#define _COST_{} {}'.format(name, us)
+                    for name, us in sorted(all_costs.items())))
+
+def build(code, build_dir=None, board=None, costs=None,
+    compiler=DEFAULT_COMPILER, flags=DEFAULT_FLAGS):
+    '''Compiles translated code into a host executable and returns its path.
+    Builds of the same code and settings are reused.'''
+    if build_dir is None:
+        build_dir = os.path.join(tempfile.gettempdir(), 'pyduino-native')
+    os.makedirs(build_dir, exist_ok=True)
+
+    header = mock_core(board, costs)
+    source = SKETCH.format(code=code, main=MAIN)
+    key = hashlib.sha1('\0'.join([header, source, compiler] + list(flags))
+                        .encode()).hexdigest()[:16]
+
+    binary = os.path.join(build_dir, key)
+    if os.path.exists(binary):
+        return binary
+
+    sketch_dir = os.path.join(build_dir, key + '-src')
+    os.makedirs(sketch_dir, exist_ok=True)
+    with open(os.path.join(sketch_dir, 'Arduino.h'), 'w') as header_file:
+        header_file.write(header)
+    source_path = os.path.join(sketch_dir, 'sketch.cpp')
+    with open(source_path, 'w') as source_file:
+        source_file.write(source)
+
+    process = subprocess.run([compiler] + list(flags) + ['-I', sketch_dir,
+        '-I', LIBS_PATH, source_path, '-o', binary],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+    if process.returncode != 0:
+        raise NativeBuildError(process.stdout)
+    return binary
+
+def write_inputs(path, board, analog=None, digital=None,
+    trace_rate=simulator.DEFAULT_TRACE_RATE, serial_input=b''):
+    '''Writes the input traces in the format the native main() reads'''
+    pins = simulator.Board(board)
+    with open(path, 'w') as inputs:
+        for kind, traces in (('a', analog or {}), ('d', digital or {})):
+            for pin, values in traces.items():
+                values = np.asarray(values).astype(np.int64)
+                inputs.write('{} {} {} {} '.format(kind, pins.pin(pin),
+                    trace_rate, len(values)))
+                inputs.write(' '.join(map(str, values.tolist())) + '\n')
+        inputs.write('s {} {}\n'.format(len(serial_input),
+            ' '.join(map(str, bytes(serial_input)))))
+
+def parse_output(output, board=None):
+    '''Turns the events printed by a native run into a recording
+    like the simulator's, along with the host nanoseconds it took'''
+    recorded = simulator.Board(board)
+    elapsed_ns = None
+    for line in output.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        kind = fields[0]
+        if kind == 'D':
+            recorded.digital_writes.add(*map(int, fields[1:4]))
+        elif kind == 'A':
+            recorded.analog_writes.add(*map(int, fields[1:4]))
+        elif kind == 'S':
+            recorded.serial_times.append(int(fields[1]))
+            text = bytes.fromhex(fields[2]) if len(fields) > 2 else b''
+            recorded.serial_texts.append(text.decode('latin1'))
+        elif kind == 'T':
+            recorded.iterations, recorded.time_us, elapsed_ns = map(int,
+                fields[1:4])
+    return simulator.Recording(recorded), elapsed_ns
+
+def end_time_us(iterations, duration_ms, analog, digital, trace_rate):
+    '''When a run stops, the same way as Simulator.run'''
+    if duration_ms is not None:
+        return duration_ms * 1000
+    if iterations is not None:
+        return -1
+    lengths = [len(values) for values in
+                list((analog or {}).values()) + list((digital or {}).values())]
+    if not lengths:
+        raise simulator.SimulationError('give a number of iterations '
+            'or a duration without input traces')
+    return max(lengths) * 1000000 // trace_rate
+
+def run_native(binary, iterations=None, duration_ms=None, board=None,
+    analog=None, digital=None, trace_rate=simulator.DEFAULT_TRACE_RATE,
+    serial_input=b''):
+    '''Runs a native build and returns its recording
+    and the host nanoseconds per loop() iteration'''
+    end_us = end_time_us(iterations, duration_ms, analog, digital, trace_rate)
+    with tempfile.NamedTemporaryFile('w', suffix='.inputs') as inputs:
+        write_inputs(inputs.name, board, analog, digital, trace_rate,
+            serial_input)
+        process = subprocess.run([binary, str(-1 if iterations is None
+            else iterations), str(end_us), inputs.name],
+            stdout=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise NativeBuildError('{} exited with {}'.format(binary,
+            process.returncode))
+
+    recording, elapsed_ns = parse_output(process.stdout, board)
+    return recording, elapsed_ns / max(recording.iterations, 1)
+
+def compare(expected, actual):
+    '''Differences between two recordings, as a list of messages'''
+    differences = []
+
+    def first_difference(name, a, b):
+        if len(a) != len(b):
+            differences.append('{}: {} events instead of {}'.format(name,
+                len(b), len(a)))
+        common = min(len(a), len(b))
+        mismatched = np.flatnonzero(np.asarray(a[:common]) != np.asarray(
+            b[:common]))
+        if len(mismatched):
+            n = mismatched[0]
+            differences.append('{} event {}: {!r} instead of {!r}'.format(
+                name, n, b[n], a[n]))
+
+    for name in ('digital', 'analog'):
+        for column, a, b in zip(('time', 'pin', 'value'),
+            getattr(expected, name), getattr(actual, name)):
+            first_difference('{} {}'.format(name, column), a, b)
+    first_difference('serial time', expected.serial_time, actual.serial_time)
+    first_difference('serial text', expected.serial_text, actual.serial_text)
+
+    if expected.iterations != actual.iterations:
+        differences.append('{} loop() iterations instead of {}'.format(
+            actual.iterations, expected.iterations))
+    if expected.time_us != actual.time_us:
+        differences.append('ended at {} us instead of {} us'.format(
+            actual.time_us, expected.time_us))
+    return differences
+
+def differential(source, iterations=DEFAULT_ITERATIONS, duration_ms=None,
+    compiler=DEFAULT_COMPILER, flags=DEFAULT_FLAGS, build_dir=None,
+    **inputs):
+    '''Runs a sketch both simulated and natively and returns the
+    differences between them along with the time per loop() iteration'''
+    translated = translate(source)
+    binary = build(translated['code'], build_dir, compiler=compiler,
+        flags=flags)
+    native, native_ns = run_native(binary, iterations, duration_ms, **inputs)
+
+    start = time.perf_counter()
+    simulated = simulator.simulate(source, iterations, duration_ms,
+        board=None, **inputs)
+    simulated_ns = (time.perf_counter() - start) * 1e9 / max(
+        simulated.iterations, 1)
+
+    return {
+        'differences': compare(simulated, native),
+        'iterations': native.iterations,
+        'native_ns': native_ns,
+        'simulated_ns': simulated_ns
+    }
+
+def fixed_point_errors(fmt='Q16.16', count=DEFAULT_OPERANDS, seed=0,
+    repeat=DEFAULT_REPEAT, compiler=DEFAULT_COMPILER, flags=DEFAULT_FLAGS,
+    build_dir=None):
+    '''Runs the fixed-point helpers natively on random operands and
+    returns the maximum error of every operation against the exact
+    result of the operands, in units of the last place, and the host
+    time per operation in ns of the helpers and of the float operations'''
+    int_bits, frac_bits = fixedpoint.parse_format(fmt)
+    lsb = 1.0 / (1 << frac_bits)
+
+    # keep the results within range
+    limit = 2 ** ((int_bits - 1) / 2)
+    rng = random.Random(seed)
+    pairs = [(rng.uniform(-limit, limit), rng.uniform(-limit, limit))
+                for n in range(count)]
+    pairs = [(fixedpoint.to_raw(a, frac_bits), fixedpoint.to_raw(b, frac_bits))
+                for a, b in pairs if abs(b) > 1.0 / limit]
+
+    code = FIXED_POINT_CHECK.format(prelude=fixedpoint.prelude(fmt),
+        a=', '.join(str(a) for a, b in pairs),
+        b=', '.join(str(b) for a, b in pairs),
+        count=len(pairs), repeat=repeat, digits=fixedpoint.DEFAULT_DIGITS)
+    binary = build(code, build_dir, compiler=compiler, flags=flags)
+    recording, _ = run_native(binary, iterations=1)
+    lines = recording.serial_output().splitlines()
+    times = [line.split() for line in lines if line.startswith('time ')]
+    lines = [line for line in lines if not line.startswith('time ')]
+    if len(lines) != len(pairs):
+        raise NativeBuildError('{} results for {} operands'.format(len(lines),
+            len(pairs)))
+
+    errors = {'add': 0.0, 'mul': 0.0, 'div': 0.0, 'print': 0.0}
+    for (raw_a, raw_b), line in zip(pairs, lines):
+        add, mul, div, printed = line.split()
+        a, b = raw_a * lsb, raw_b * lsb
+        for op, raw, exact in (('add', add, a + b), ('mul', mul, a * b),
+                                ('div', div, a / b)):
+            errors[op] = max(errors[op], abs(int(raw) * lsb - exact) / lsb)
+        errors['print'] = max(errors['print'], abs(float(printed) - a)
+                                / 10 ** -fixedpoint.DEFAULT_DIGITS)
+
+    # {op: {'fixed': ns, 'float': ns}}
+    timing = {}
+    for _, kind, op, ns in times:
+        timing.setdefault(op, {})[kind] = int(ns) / (repeat * len(pairs))
+    return {'format': fmt, 'operands': len(pairs), 'errors': errors,
+            'timing': timing}
+
+def default_inputs(trace_rate=simulator.DEFAULT_TRACE_RATE, seconds=10):
+    '''A slow sine on every analog input'''
+    t = np.arange(trace_rate * seconds) / trace_rate
+    return dict(('A{}'.format(n),
+                (511.5 + 511.5 * np.sin(2 * np.pi * (n + 1) * t / seconds))
+                .round().astype(int)) for n in range(6))
+
+if __name__ == '__main__':
+    argp = ArgumentParser(description='runs sketches natively and compares '
+        'them with the simulation')
+    argp.add_argument('files', nargs='*', help='sketches (samples/ by default)')
+    argp.add_argument('-n', '--iterations', type=int, default=DEFAULT_ITERATIONS)
+    argp.add_argument('--compiler', default=DEFAULT_COMPILER)
+    argp.add_argument('--fixed-point', nargs='?', const='Q16.16', default=None,
+        metavar='FORMAT', help='check the fixed-point helpers instead')
+    args = argp.parse_args()
+
+    if args.fixed_point is not None:
+        report = fixed_point_errors(args.fixed_point, compiler=args.compiler)
+        print('{format}, {operands} random operand pairs'.format(**report))
+        for op, error in sorted(report['errors'].items()):
+            unit = 'of the last printed digit' if op == 'print' else 'LSB'
+            print('  max {} error: {:.3f} {}'.format(op, error, unit))
+        # the host has a hardware FPU, unlike the AVR boards, so this shows
+        # the cost of the helpers rather than the speedup on the board
+        print('host time per operation')
+        for op, ns in sorted(report['timing'].items()):
+            print('  {}: fixed {:.2f} ns, float {:.2f} ns, fixed/float '
+                '{:.2f}'.format(op, ns['fixed'], ns['float'],
+                ns['fixed'] / ns['float']))
+        # results should be correctly rounded
+        sys.exit(1 if max(report['errors'].values()) > 0.5 + 1e-9 else 0)
+
+    files = args.files or sorted(glob.glob(os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'samples', '*.py')))
+
+    failed = False
+    print('{:<24} {:>10} {:>14} {:>14}  {}'.format('sketch', 'loops',
+        'native ns/loop', 'python ns/loop', 'result'))
+    for path in files:
+        name = os.path.basename(path)
+        try:
+            report = differential(open(path).read(), args.iterations,
+                compiler=args.compiler, analog=default_inputs())
+        except Exception as error:
+            message = str(error).strip().splitlines()
+            print('{:<24} {:>10} {:>14} {:>14}  {}: {}'.format(name, '-', '-',
+                '-', type(error).__name__, message[0] if message else ''))
+            failed = True
+            continue
+
+        result = 'same' if not report['differences'] else \
+            '; '.join(report['differences'][:3])
+        failed = failed or bool(report['differences'])
+        print('{:<24} {:>10} {:>14.1f} {:>14.1f}  {}'.format(name,
+            report['iterations'], report['native_ns'], report['simulated_ns'],
+            result))
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,184 @@
+import ast
+
+import flashstrings
+
+# merges runs of Serial.print/println calls with constant arguments,
+# e.g. the banners and labels most sketches print, into a single
+# Serial.print of the whole text. every call costs code to set up its
+# arguments and a trip through the Print class, every literal a
+# terminating zero. constant numbers printed with a format, like
+# Serial.print(65, HEX), are formatted here instead of on the board.
+# the merged text is printed from flash on AVR like any other literal.
+
+PRINT_FUNCS = ('Serial.print', 'Serial.println')
+
+NEWLINE = '\r\n'
+
+# Serial.print(x, format) bases, Arduino prints digits above 9 uppercase
+bases = {'DEC': 10, 'HEX': 16, 'OCT': 8, 'BIN': 2}
+
+# bytes of code setting up and making one print call
+call_sizes = {'avr': 12, 'sam': 12}
+
+# Print converts to long (and to unsigned long for other bases than 10)
+LONG_MIN = -1 << 31
+ULONG_MAX = (1 << 32) - 1
+
+DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+def print_name(node):
+    '''Serial.print or Serial.println if node is a statement calling it'''
+    if (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+        and isinstance(node.value.func, ast.Attribute)
+        and isinstance(node.value.func.value, ast.Name)):
+        name = '{}.{}'.format(node.value.func.value.id, node.value.func.attr)
+        if name in PRINT_FUNCS:
+            return name
+    return None
+
+def constant_int(node):
+    if isinstance(node, ast.Num) and type(node.n) is int:
+        return node.n
+    if (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub)
+        and isinstance(node.operand, ast.Num) and type(node.operand.n) is int):
+        return -node.operand.n
+    return None
+
+def format_number(value, base):
+    '''The text Arduino's Print prints for a number in a base'''
+    if base == 10:
+        return str(value)
+    # other bases print the two's complement of negative numbers
+    value &= ULONG_MAX
+    digits = ''
+    while True:
+        value, digit = divmod(value, base)
+        digits = DIGITS[digit] + digits
+        if value == 0:
+            return digits
+
+def printed_text(node):
+    '''The text a print statement prints if it's constant, else None'''
+    name = print_name(node)
+    if name is None:
+        return None
+    call = node.value
+    if call.keywords or len(call.args) > 2:
+        return None
+
+    if not call.args:
+        text = ''
+    elif isinstance(call.args[0], ast.Str):
+        # a string has no format
+        if len(call.args) > 1:
+            return None
+        text = call.args[0].s
+    else:
+        value = constant_int(call.args[0])
+        if value is None or not LONG_MIN <= value <= ULONG_MAX:
+            return None
+        base = 10
+        if len(call.args) == 2:
+            if not (isinstance(call.args[1], ast.Name)
+                    and call.args[1].id in bases):
+                return None
+            base = bases[call.args[1].id]
+        text = format_number(value, base)
+
+    if name == 'Serial.println':
+        text += NEWLINE
+    return text
+
+def is_formatted(node):
+    '''Whether a constant print leaves formatting to the board'''
+    return any(not isinstance(arg, ast.Str) for arg in node.value.args)
+
+def string_bytes(nodes):
+    '''Bytes of the string literals printed by the nodes'''
+    return sum(len(arg.s.encode('utf-8')) + 1 for node in nodes
+                for arg in node.value.args
+                if flashstrings.is_flash_literal(arg))
+
+def merged_print(run, text):
+    call = ast.Call(func=ast.Attribute(value=ast.Name(id='Serial',
+                ctx=ast.Load()), attr='print', ctx=ast.Load()),
+            args=[ast.Str(s=text)], keywords=[])
+    return ast.copy_location(ast.Expr(value=call), run[0])
+
+class PrintMerger:
+    '''Replaces runs of constant prints in every block'''
+
+    # fields holding the statements of a block, and the except
+    # clauses and match cases, which hold blocks of their own
+    blocks = ('body', 'orelse', 'finalbody')
+    clauses = ('handlers', 'cases')
+
+    def __init__(self):
+        self.stats = {'calls': 0, 'merged_calls': 0, 'formatted': 0,
+                        'string_bytes': 0, 'merged_string_bytes': 0}
+
+    def merge(self, statements):
+        merged = []
+        run = []
+        for statement in statements + [None]:
+            text = None if statement is None else printed_text(statement)
+            if text is not None:
+                run.append((statement, text))
+                continue
+
+            nodes = [node for node, _ in run]
+            # a lone print only changes if it had a number to format
+            if len(run) > 1 or (run and is_formatted(nodes[0])):
+                replacement = merged_print(nodes, ''.join(text
+                                for _, text in run))
+                self.stats['calls'] += len(nodes)
+                self.stats['merged_calls'] += 1
+                self.stats['formatted'] += sum(1 for node in nodes
+                                                if is_formatted(node))
+                self.stats['string_bytes'] += string_bytes(nodes)
+                self.stats['merged_string_bytes'] += string_bytes([replacement])
+                # only the new nodes need a location
+                merged.append(ast.fix_missing_locations(replacement))
+            else:
+                merged += nodes
+            run = []
+
+            if statement is not None:
+                merged.append(statement)
+        return merged
+
+    def visit(self, node):
+        '''Merges the prints in the blocks of a node and of the
+        statements in them. expressions can't hold statements,
+        so they're never looked into'''
+        for field in self.blocks + self.clauses:
+            statements = getattr(node, field, None)
+            if not isinstance(statements, list):
+                continue
+            for statement in statements:
+                self.visit(statement)
+            if field in self.blocks and any(print_name(statement)
+                                            for statement in statements):
+                setattr(node, field, self.merge(statements))
+        return node
+
+def transform(parsed):
+    '''Merges the constant prints of a parsed program,
+    returns it along with what was saved'''
+    merger = PrintMerger()
+    return merger.visit(parsed), merger.stats
+
+def flash_saved(stats, arch):
+    '''Bytes of flash the merged calls and literals don't take'''
+    calls = stats['calls'] - stats['merged_calls']
+    return (calls * call_sizes[arch] + stats['string_bytes']
+            - stats['merged_string_bytes'])
+
+def format_report(stats, arch):
+    report = '{} constant Serial prints merged into {} ({} formatted at ' \
+        'compile time), {} calls saved'.format(stats['calls'],
+            stats['merged_calls'], stats['formatted'],
+            stats['calls'] - stats['merged_calls'])
+    if arch is not None:
+        report += ', about {} bytes of flash'.format(flash_saved(stats, arch))
+    return report
@@ -0,0 +1,152 @@
+import ast
+
+import boardinfo
+
+# direct port register access for digital IO on pins known at compile time.
+# the Arduino core looks the pin up in a table on every call,
+# here the lookup is done once by the translator.
+#
+# note that unlike the core digitalWrite, writing the port directly
+# does not switch off PWM on the pin, so don't mix it with analogWrite
+
+# AVR: PORTx/PINx/DDRx, a single sbi/cbi instruction for constant pins
+AVR_WRITE_HIGH = 'PORT{port} |= _BV({bit})'
+AVR_WRITE_LOW = 'PORT{port} &= ~_BV({bit})'
+AVR_READ = '((PIN{port} >> {bit}) & 1)'
+AVR_OUTPUT = 'DDR{port} |= _BV({bit})'
+AVR_INPUT = '(DDR{port} &= ~_BV({bit}), PORT{port} &= ~_BV({bit}))'
+AVR_INPUT_PULLUP = '(DDR{port} &= ~_BV({bit}), PORT{port} |= _BV({bit}))'
+
+# SAM: PIO controller set/clear registers
+SAM_WRITE_HIGH = 'PIO{port}->PIO_SODR = (1u << {bit})'
+SAM_WRITE_LOW = 'PIO{port}->PIO_CODR = (1u << {bit})'
+SAM_READ = '((PIO{port}->PIO_PDSR >> {bit}) & 1)'
+SAM_OUTPUT = '(PIO{port}->PIO_PER = (1u << {bit}), PIO{port}->PIO_OER = (1u << {bit}))'
+
+templates = {
+    'avr': {
+        'HIGH': AVR_WRITE_HIGH,
+        'LOW': AVR_WRITE_LOW,
+        'read': AVR_READ,
+        'OUTPUT': AVR_OUTPUT,
+        'INPUT': AVR_INPUT,
+        'INPUT_PULLUP': AVR_INPUT_PULLUP
+    },
+    # input modes on SAM also need the PIO peripheral clock enabled,
+    # which is left to the core pinMode
+    'sam': {
+        'HIGH': SAM_WRITE_HIGH,
+        'LOW': SAM_WRITE_LOW,
+        'read': SAM_READ,
+        'OUTPUT': SAM_OUTPUT
+    }
+}
+
+direct_funcs = ('digitalWrite', 'digitalRead', 'pinMode')
+
+level_consts = {'HIGH': 'HIGH', 'LOW': 'LOW', 'True': 'HIGH', 'False': 'LOW'}
+
+modes = ('OUTPUT', 'INPUT', 'INPUT_PULLUP')
+
+def load_pinmap(board):
+    '''Returns the pin map for a board given either by its
+    user-friendly name or its full name, or None if there is none'''
+    return boardinfo.load('pinmaps.json', board)
+
+def translation_key(board):
+    '''The same for boards whose code translates the same, that is
+    boards with the same pin map'''
+    pinmap = load_pinmap(board)
+    return None if pinmap is None else repr(sorted(pinmap.items()))
+
+def find_constants(parsed):
+    '''Finds module-level names which are assigned an integer literal
+    exactly once in the whole program, so that they can be used
+    as compile-time constants. a name that's bound anywhere else,
+    even as a parameter or loop variable shadowing it, isn't one'''
+    assigned = {}
+    for node in ast.walk(parsed):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names = [node.id]
+        elif isinstance(node, ast.arg):
+            names = [node.arg]
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+            ast.ClassDef)):
+            names = [node.name]
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names = [node.name]
+        elif isinstance(node, ast.alias):
+            names = [(node.asname or node.name).split('.')[0]]
+        else:
+            continue
+        for name in names:
+            assigned[name] = assigned.get(name, 0) + 1
+
+    constants = {}
+    for node in parsed.body:
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1
+            and isinstance(node.targets[0], ast.Name)
+            and isinstance(node.value, ast.Num)
+            and type(node.value.n) is int
+            and assigned[node.targets[0].id] == 1):
+            constants[node.targets[0].id] = node.value.n
+
+    return constants
+
+def pin_number(arg, pinmap, constants):
+    '''Returns the pin number if it is known at compile time'''
+    if isinstance(arg, ast.Num) and type(arg.n) is int:
+        return arg.n
+    if (isinstance(arg, ast.Name) and pinmap is not None
+        and arg.id in pinmap['aliases']):
+        return pinmap['aliases'][arg.id]
+    if isinstance(arg, ast.Name) and arg.id in constants:
+        return constants[arg.id]
+    return None
+
+def resolve_pin(arg, pinmap, constants):
+    pin = pin_number(arg, pinmap, constants)
+    if pin is None:
+        return None
+
+    return pinmap['pins'].get(str(pin))
+
+def direct_io(func_name, args, args_code, pinmap, constants):
+    '''Returns the register-level code for a digital IO call
+    or None if the core function has to be called instead'''
+    if func_name not in direct_funcs or pinmap is None or len(args) == 0:
+        return None
+
+    pin = resolve_pin(args[0], pinmap, constants)
+    if pin is None:
+        return None
+
+    arch_templates = templates[pinmap['arch']]
+    port, bit = pin
+
+    if func_name == 'digitalRead':
+        return arch_templates['read'].format(port=port, bit=bit)
+
+    if len(args) != 2:
+        return None
+
+    if func_name == 'digitalWrite':
+        if isinstance(args[1], ast.Name) and args[1].id in level_consts:
+            template = arch_templates[level_consts[args[1].id]]
+            return template.format(port=port, bit=bit)
+        elif isinstance(args[1], ast.Num):
+            template = arch_templates['HIGH' if args[1].n else 'LOW']
+            return template.format(port=port, bit=bit)
+        else:
+            # the level is only known at runtime
+            return '(({level}) ? ({high}) : ({low}))'.format(
+                level=args_code[1],
+                high=arch_templates['HIGH'].format(port=port, bit=bit),
+                low=arch_templates['LOW'].format(port=port, bit=bit))
+
+    if func_name == 'pinMode':
+        if (isinstance(args[1], ast.Name) and args[1].id in modes
+            and args[1].id in arch_templates):
+            return arch_templates[args[1].id].format(port=port, bit=bit)
+
+    return None
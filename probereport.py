@@ -0,0 +1,150 @@
+import json, os, sys
+from argparse import ArgumentParser
+
+import frames, instrument, logreader
+
+# host side of --instrument: reads the probe tables a sketch prints
+# (see instrument.py) from a serial port, a pty or a capture and
+# turns them into a per-function profile. the tables are cumulative,
+# so the last one sums up the whole run and the difference between
+# the last two shows the latest period only. the group after the
+# functions times empty probes, their mean is taken off every call.
+
+FIELDS = ('count', 'total', 'self', 'max')
+
+# the counters are uint32_t on the board
+COUNTER_WRAP = 1 << 32
+
+def load_names(probes):
+    '''The probed functions, from the file written next
+    to the sketch, its contents or the parsed JSON'''
+    if isinstance(probes, str):
+        if os.path.exists(probes):
+            probes = open(probes).read()
+        probes = json.loads(probes)
+    return probes
+
+def parse_dump(line, prefix=instrument.DUMP_PREFIX):
+    '''The (count, total, self, max) of every function
+    in a dumped line, or None if it isn't a dump'''
+    line = line.strip()
+    if not line.startswith(prefix):
+        return None
+    try:
+        return [tuple(int(value, 16) for value in group.split(','))
+                for group in line[len(prefix):].split()]
+    except ValueError:
+        # cut off or garbled
+        return None
+
+class ProbeReader:
+    '''Picks the dumps out of whatever else the sketch prints'''
+
+    def __init__(self, probes):
+        self.probes = load_names(probes)
+        self.prefix = self.probes.get('prefix', instrument.DUMP_PREFIX)
+        self.pending = b''
+        self.dumps = []
+
+    def feed(self, data):
+        '''Returns the dumps completed by a chunk of output'''
+        lines = (self.pending + bytes(data)).split(b'\n')
+        self.pending = lines.pop()
+
+        found = []
+        for line in lines:
+            dump = parse_dump(line.decode('latin1'), self.prefix)
+            if dump is not None and len(dump) >= len(self.probes['functions']):
+                found.append(dump)
+        # only the last two are needed
+        self.dumps = (self.dumps + found)[-2:]
+        return found
+
+    def profile(self, latest=False):
+        '''Rows of the profile of the whole run or, with latest,
+        of the period between the last two dumps'''
+        if not self.dumps:
+            return []
+        dump = self.dumps[-1]
+        if latest and len(self.dumps) > 1:
+            # a counter may have wrapped around in between
+            dump = [tuple((now - before) % COUNTER_WRAP for now, before
+                    in zip(current[:3], previous[:3])) + (current[3],)
+                    for current, previous in zip(self.dumps[-1], self.dumps[-2])]
+        # the empty probes only run before the first dump
+        return profile(dump, self.probes['functions'],
+            probe_overhead(self.dumps[-1], self.probes['functions']))
+
+def probe_overhead(dump, names):
+    '''Mean microseconds an empty probe adds to a call, 0 for dumps
+    without the calibration group'''
+    if len(dump) <= len(names):
+        return 0.0
+    count, total = dump[len(names)][:2]
+    return total / count if count else 0.0
+
+def profile(dump, names, overhead=0.0):
+    '''Rows of the profile with the probe overhead taken off every call'''
+    dump = [(count, max(total - overhead * count, 0),
+                max(self_time - overhead * count, 0),
+                max(max_time - overhead, 0))
+            for count, total, self_time, max_time in dump[:len(names)]]
+    total_self = sum(stats[2] for stats in dump) or 1
+    rows = []
+    for name, (count, total, self_time, max_time) in zip(names, dump):
+        rows.append({
+            'function': name,
+            'calls': count,
+            'total_ms': total / 1000,
+            'self_ms': self_time / 1000,
+            'mean_us': total / count if count else 0.0,
+            'max_us': max_time,
+            'share': self_time / total_self
+        })
+    return sorted(rows, key=lambda row: -row['self_ms'])
+
+def format_report(rows):
+    lines = ['{:<24} {:>10} {:>12} {:>12} {:>10} {:>10} {:>7}'.format(
+        'function', 'calls', 'total ms', 'self ms', 'mean us', 'max us',
+        'self %')]
+    for row in rows:
+        lines.append('{function:<24} {calls:>10} {total_ms:>12.3f} '
+            '{self_ms:>12.3f} {mean_us:>10.1f} {max_us:>10.1f} '
+            '{share:>7.1%}'.format(**row))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    argp = ArgumentParser(description='profile of a sketch built '
+        'with --instrument')
+    argp.add_argument('probes', help='the .probes.json written with the sketch')
+    argp.add_argument('source', help='serial device, pty or capture file '
+        '(- for stdin)')
+    argp.add_argument('-b', '--baudrate', type=int, default=None,
+        help='the rate saved with the probes (or 9600) by default')
+    argp.add_argument('--follow', action='store_true', default=False,
+        help='print the latest period after every dump')
+    args = argp.parse_args()
+
+    reader = ProbeReader(args.probes)
+    baudrate = (args.baudrate or reader.probes.get('baud_rate')
+                or instrument.BAUD_RATE)
+
+    if args.source == '-':
+        source = sys.stdin.buffer
+    elif os.path.exists(args.source) and not os.path.isfile(args.source):
+        source = logreader.open_serial(args.source, baudrate)
+    else:
+        source = args.source
+    try:
+        for chunk in frames.read_chunks(source, 1024):
+            if reader.feed(chunk) and args.follow:
+                print(format_report(reader.profile(latest=True)) + '\n')
+    except KeyboardInterrupt:
+        pass
+
+    if not reader.dumps:
+        print('no probe tables found')
+        sys.exit(1)
+    print(format_report(reader.profile()))
+    print('{:.1f} us of probe overhead taken off every call'.format(
+        probe_overhead(reader.dumps[-1], reader.probes['functions'])))
@@ -0,0 +1,152 @@
+import json, time
+
+import compiler
+
+# opt-in profiling of the translator. while a Profiler is active it's
+# the hook of its thread (see compiler.set_hook), so it sees the calls
+# of to_arduino and the helpers, recursive ones included, made by the
+# translations on that thread only. nothing is wrapped without one, so
+# translating without profiling costs nothing extra.
+#
+#   with profiler.Profiler() as prof:
+#       translate(code)
+#   print(profiler.format_report(prof))
+#   prof.save('translate.json')   # stats and a Chrome trace in one file
+
+# trace events kept at most, so that a huge sketch doesn't eat the memory
+MAX_EVENTS = 1000000
+
+class ProfilerError(Exception):
+    pass
+
+class Stats:
+    def __init__(self, kind):
+        self.kind = kind
+        self.calls = 0
+        self.cumulative = 0
+        self.self_time = 0
+
+    def as_dict(self):
+        return {
+            'kind': self.kind,
+            'calls': self.calls,
+            'cumulative_s': self.cumulative / 1e9,
+            'self_s': self.self_time / 1e9
+        }
+
+class Profiler:
+    '''Call counts, cumulative and self time of every AST node type
+    to_arduino translates and of the translator's helpers, plus how
+    many times each function was translated'''
+
+    def __init__(self, max_events=MAX_EVENTS):
+        self.stats = {}
+        self.translations = {}
+        self.events = []
+        self.max_events = max_events
+        self.stack = []
+        self.active = {}
+        self.start = None
+
+    def enter(self, key, kind):
+        if key not in self.stats:
+            self.stats[key] = Stats(kind)
+        self.active[key] = self.active.get(key, 0) + 1
+        self.stack.append([key, time.perf_counter_ns(), 0])
+
+    def exit(self):
+        end = time.perf_counter_ns()
+        key, start, children = self.stack.pop()
+        elapsed = end - start
+
+        stats = self.stats[key]
+        stats.calls += 1
+        stats.self_time += elapsed - children
+        # recursive calls are already inside the outermost one
+        self.active[key] -= 1
+        if not self.active[key]:
+            stats.cumulative += elapsed
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+        if len(self.events) < self.max_events:
+            self.events.append((key, stats.kind, start, elapsed))
+
+    def call(self, name, func, args, kwargs):
+        '''Times a call of to_arduino, by node type, or of a helper'''
+        if name == 'to_arduino':
+            obj = args[0]
+            kind = 'node'
+            if isinstance(obj, list):
+                key = 'statements'
+            else:
+                key = type(obj).__name__
+                if isinstance(obj, compiler.ast.FunctionDef):
+                    self.translations[obj.name] = self.translations.get(
+                        obj.name, 0) + 1
+        else:
+            key, kind = name, 'helper'
+        self.enter(key, kind)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.exit()
+
+    def __enter__(self):
+        if compiler.local.hook is not None:
+            raise ProfilerError('another profiler is running on this thread')
+        self.start = time.perf_counter_ns()
+        compiler.set_hook(self)
+        return self
+
+    def __exit__(self, *exc):
+        compiler.set_hook(None)
+
+    def retranslations(self):
+        '''Functions translated more than once and how many extra times'''
+        return dict((name, count - 1) for name, count in self.translations.items()
+                    if count > 1)
+
+    def as_dict(self):
+        return {
+            'stats': dict((key, stats.as_dict())
+                        for key, stats in self.stats.items()),
+            'translations': self.translations,
+            'retranslations': self.retranslations()
+        }
+
+    def chrome_trace(self):
+        '''Complete events for chrome://tracing or Perfetto'''
+        return [{'name': key, 'cat': kind, 'ph': 'X', 'pid': 0, 'tid': 0,
+                 'ts': (start - self.start) / 1000, 'dur': elapsed / 1000}
+                for key, kind, start, elapsed in self.events]
+
+    def save(self, path):
+        '''Writes the stats as JSON. The file is a Chrome trace as well,
+        trace viewers ignore everything but the traceEvents.'''
+        data = self.as_dict()
+        data['traceEvents'] = self.chrome_trace()
+        data['displayTimeUnit'] = 'ms'
+        with open(path, 'w') as trace_file:
+            json.dump(data, trace_file)
+
+def format_report(profiler, limit=None):
+    rows = sorted(profiler.stats.items(), key=lambda item: -item[1].self_time)
+    if limit is not None:
+        rows = rows[:limit]
+
+    lines = ['{:<24} {:<7} {:>8} {:>12} {:>12}'.format('name', 'kind',
+        'calls', 'cumul. ms', 'self ms')]
+    for key, stats in rows:
+        lines.append('{:<24} {:<7} {:>8} {:>12.3f} {:>12.3f}'.format(key,
+            stats.kind, stats.calls, stats.cumulative / 1e6,
+            stats.self_time / 1e6))
+
+    retranslations = profiler.retranslations()
+    if retranslations:
+        lines.append('')
+        lines.append('functions translated more than once:')
+        for name, extra in sorted(retranslations.items(),
+            key=lambda item: -item[1]):
+            lines.append('  {}: {} extra'.format(name, extra))
+    return '\n'.join(lines)
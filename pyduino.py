@@ -4,7 +4,9 @@ import os, subprocess, json
 from argparse import ArgumentParser
 
 from compiler import translate
-import config
+import config, flashstrings, instrument, peephole, portio, profiler, resources
+import telemetry, timing
+import fleet, matrix, modules, toolchain
 
 def write_translation(translated, filename, extension='ino'):
     
@@ -16,8 +18,8 @@ def write_translation(translated, filename, extension='ino'):
     filename = os.path.split(filename)[1]
 
     sketchpath = os.path.join(sketchname, (filename.split('.')[0] + '.' + extension))
-    with open(sketchpath, 'w') as sketch:
-        sketch.write(translated)
+    # unchanged files are left alone for the IDE's incremental builds
+    toolchain.write_if_changed(sketchpath, translated)
 
 def run(sketchname, upload=False):
     if upload:
@@ -47,8 +49,25 @@ def run(sketchname, upload=False):
                     run_flag,
                     sketchpath])
 
-    # delete the sketch
-    os.unlink(sketchpath)
+    # delete the sketch unless the next build is to reuse it
+    if not args.keep_sketch:
+        os.unlink(sketchpath)
+
+def run_direct(code, sketchname, upload=False, headers=None):
+    '''Builds with the toolchain and the cached core instead of the IDE'''
+    tools = toolchain.Toolchain(args.board)
+    build = tools.build(code, sketchname, headers)
+    if args.verbose:
+        print('{} in {:.2f} s ({}, {})'.format(build['image'], build['seconds'],
+            'core built' if build['core_built'] else 'cached core',
+            'sketch compiled' if build['sketch_built'] else 'sketch unchanged'))
+    if upload and args.ports is not None:
+        # one image for every board of the fleet
+        results = fleet.upload_fleet(build['image'], args.ports, args.board,
+            args.uploader, args.fleet_jobs, args.retries, args.timeout)
+        print(fleet.format_table(results))
+    elif upload:
+        tools.upload(build['image'], args.port)
 
 def main():
     global sketchname
@@ -56,11 +75,74 @@ def main():
     sketchname = os.path.split(args.file)[1].split('.py')[0]
 
     sketchfile = open(args.file)
-    translated = translate(sketchfile.read())
+    code = sketchfile.read()
+    # imported modules are next to the sketch
+    directory = os.path.dirname(args.file) or '.'
+    if args.boards is not None:
+        results = matrix.build_matrix(code, sketchname, args.boards,
+            workers=args.jobs, fixed_point=args.fixed_point,
+            directory=directory)
+        print(matrix.format_table(results))
+        return
+
+    # the imported modules become headers next to the sketch
+    module_headers, imported = modules.translate_modules(code, directory,
+        args.board, args.fixed_point)
+
+    if args.profile is not None:
+        # the sketch only, with the modules it imports translated already
+        with profiler.Profiler() as prof:
+            translated = translate(code, board=args.board,
+                fixed_point=args.fixed_point, modules=imported)
+        print(profiler.format_report(prof))
+        if args.profile:
+            prof.save(args.profile)
+        return
+
+    translated = translate(code, board=args.board,
+        fixed_point=args.fixed_point, instrument=args.instrument,
+        modules=imported)
+
+    if translated['peephole']['calls']:
+        pinmap = portio.load_pinmap(args.board)
+        print(peephole.format_report(translated['peephole'],
+            None if pinmap is None else pinmap['arch']))
+
+    if translated['flash_strings']:
+        print(flashstrings.format_report(translated['flash_strings'],
+            translated['flash_uses']))
+
+    if args.resources:
+        report = resources.estimate(code, translated, args.board)
+        print(resources.format_report(report))
+
+    if args.timing:
+        report = timing.estimate(code, translated, args.board)
+        print(timing.format_report(report))
+
+    if args.resources or args.timing:
+        return
 
     write_translation(translated['code'], sketchname)
-
-    if args.compile:
+    for name, module in module_headers.items():
+        write_translation(module['code'], name, 'hpp')
+
+    # the host decoder needs the layout of the Serial.send frames
+    if translated['telemetry']:
+        write_translation(telemetry.schema_json(translated['telemetry']),
+            sketchname, 'schema.json')
+
+    # and probereport.py the names of the probed functions
+    if args.instrument is not None:
+        write_translation(instrument.probes_json(translated['probes'],
+            translated['probe_baud_rate']), sketchname, 'probes.json')
+
+    if (args.direct or args.ports) and (args.compile or args.upload):
+        headers = dict((name + '.hpp', module['code'])
+                        for name, module in module_headers.items())
+        run_direct(translated['code'], sketchname, upload=args.upload,
+            headers=headers)
+    elif args.compile:
         run(sketchname)
     elif args.upload:
         run(sketchname, upload=True)
@@ -82,6 +164,46 @@ if __name__ == '__main__':
         help='arduino serial port')
     argp.add_argument('-u', '--upload', action='store_true', default=False, 
         help='upload the script to the board (works only if -c or --compile is specified')
+    argp.add_argument('--keep-sketch', action='store_true', default=False,
+        help='keep the translated sketch after compiling, so the next '
+        'build of unchanged code reuses the compiled objects')
+    argp.add_argument('--ports', type=str, nargs='+', default=None,
+        metavar='PORT', help='upload to all these ports at once, lists '
+        'and globs like /dev/ttyACM* work too (builds with --direct)')
+    argp.add_argument('--fleet-jobs', type=int,
+        default=fleet.DEFAULT_CONCURRENCY, help='uploads at the same time')
+    argp.add_argument('--retries', type=int, default=fleet.DEFAULT_RETRIES,
+        help='times a failed upload is tried again')
+    argp.add_argument('--timeout', type=float, default=fleet.DEFAULT_TIMEOUT,
+        help='seconds an upload may take')
+    argp.add_argument('--uploader', type=str, default=None, metavar='COMMAND',
+        help='upload command with {port} and {image} in it '
+        'instead of the one in toolchains.json')
+    argp.add_argument('--boards', type=str, default=None,
+        metavar='BOARD,BOARD|all', help='build for several boards at once '
+        'with the toolchain (see --direct), each into its own directory')
+    argp.add_argument('-j', '--jobs', type=int, default=None,
+        help='boards built at the same time (one per processor by default)')
+    argp.add_argument('--direct', action='store_true', default=False,
+        help='compile with the toolchain and a cached core instead of '
+        'the Arduino IDE (see config.py)')
+    argp.add_argument('--instrument', nargs='?', const='functions',
+        default=None, choices=instrument.MODES, help='add profiling probes '
+        'to every function (and to every loop() iteration with loop), '
+        'the profile is printed over Serial for probereport.py')
+    argp.add_argument('--fixed-point', nargs='?', const='Q16.16', default=None,
+        metavar='FORMAT', help='compile floats to fixed-point arithmetic '
+        '(Q16.16 unless another format like Q8.8 is given)')
+
+    # static analysis
+    argp.add_argument('--resources', action='store_true', default=False,
+        help='print an estimate of SRAM, stack and heap use and exit')
+    argp.add_argument('--timing', action='store_true', default=False,
+        help='print an estimate of the cycles spent per function '
+        'and per loop() iteration and exit')
+    argp.add_argument('--profile', nargs='?', const='', default=None,
+        metavar='FILE', help='profile the translation, print where the time '
+        'went and exit (the stats and a Chrome trace go to FILE if given)')
     args = argp.parse_args()
 
     if args.w:
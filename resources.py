@@ -0,0 +1,276 @@
+import ast
+from warnings import warn
+
+import ardlib, boardinfo, fixedpoint, flashstrings, peephole
+from compiler import py_consts
+
+# static estimate of the memory a translated sketch needs,
+# worked out from the translation result and the source alone
+# so that no toolchain is needed
+
+type_sizes = {
+    'avr': {'boolean': 1, 'char': 1, 'uint8_t': 1, 'uint16_t': 2,
+            'int': 2, 'long': 4,
+            'unsigned int': 2, 'unsigned long': 4,
+            'float': 4, 'double': 4, 'pointer': 2},
+    'sam': {'boolean': 1, 'char': 1, 'uint8_t': 1, 'uint16_t': 2,
+            'int': 4, 'long': 4,
+            'unsigned int': 4, 'unsigned long': 4,
+            'float': 4, 'double': 8, 'pointer': 4}
+}
+
+# bytes malloc keeps in front of every block
+malloc_overhead = {'avr': 2, 'sam': 8}
+
+REPORT = '''Resource estimate for {board}
+  globals          {globals:>7} bytes
+  string literals  {strings:>7} bytes ({flash_strings} more in flash)
+  heap             {heap:>7} bytes
+  core             {core:>7} bytes
+  stack            {stack:>7} bytes ({stack_path})
+  SRAM total       {sram_total:>7} / {sram_budget} bytes ({sram_status})
+  flash (strings)  {flash_data:>7} / {flash_budget} bytes'''
+
+class BudgetExceededWarning(Warning):
+    pass
+
+def type_size(var_type, arch, fixed_point=None):
+    sizes = type_sizes[arch]
+
+    # globals shared with interrupt handlers
+    if var_type.startswith('volatile '):
+        var_type = var_type[len('volatile '):]
+
+    # static arrays, e.g. uint16_t[256]
+    if var_type.endswith(']'):
+        elt_type, size = var_type[:-1].split('[')
+        return type_size(elt_type, arch, fixed_point) * int(size)
+
+    if var_type == 'fixed_t':
+        int_bits, frac_bits = fixedpoint.parse_format(fixed_point)
+        return (int_bits + frac_bits) // 8
+
+    if var_type.endswith('*'):
+        return sizes['pointer']
+
+    # List keeps its length and the first node inline
+    if var_type.startswith('List<'):
+        elt_size = sizes.get(var_type[len('List<'):-1], sizes['pointer'])
+        return sizes['int'] + elt_size + sizes['pointer']
+
+    # Tuple keeps a pointer to its elements and the length
+    if var_type.startswith('Tuple<'):
+        return sizes['pointer'] + sizes['int']
+
+    return sizes.get(var_type, sizes['int'])
+
+def literal_type(node):
+    if isinstance(node, ast.Num) and type(node.n) is float:
+        return 'float'
+    if isinstance(node, ast.Str):
+        return 'char' if len(node.s) == 1 else 'char *'
+    return 'int'
+
+def string_literals(parsed, exclude=()):
+    '''Returns the string literals which end up in the data segment
+    (other than the nodes in exclude). Docstrings are dropped by
+    the translator and single characters become char constants.'''
+    docstrings = set(id(node.value) for node in ast.walk(parsed)
+                    if isinstance(node, ast.Expr)
+                    and isinstance(node.value, ast.Str))
+    excluded = set(id(node) for node in exclude)
+
+    return [node.s for node in ast.walk(parsed)
+            if isinstance(node, ast.Str) and id(node) not in docstrings
+            and id(node) not in excluded
+            and len(node.s) != 1]
+
+def containers(tree):
+    '''Yields (name, kind, element type, length) for every
+    container literal assigned in a module or function body'''
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Assign)
+            and isinstance(node.value, (ast.List, ast.Tuple))
+            and isinstance(node.targets[0], ast.Name)):
+            elts = node.value.elts
+            elt_type = literal_type(elts[0]) if elts else 'int'
+            kind = 'List' if isinstance(node.value, ast.List) else 'Tuple'
+            yield node.targets[0].id, kind, elt_type, len(elts)
+
+def container_heap(kind, elt_type, length, arch):
+    sizes = type_sizes[arch]
+    elt_size = type_size(elt_type, arch)
+
+    if length == 0:
+        return 0
+
+    if kind == 'List':
+        # every node past the first one is allocated separately
+        node_size = elt_size + sizes['pointer'] + malloc_overhead[arch]
+        return (length - 1) * node_size
+
+    return elt_size * length + malloc_overhead[arch]
+
+def call_graph(parsed):
+    '''Maps every user function to the user functions it calls'''
+    func_objs = [node for node in parsed.body
+                    if isinstance(node, ast.FunctionDef)]
+    names = set(func.name for func in func_objs)
+
+    graph = {}
+    for func in func_objs:
+        graph[func.name] = set(node.func.id for node in ast.walk(func)
+                            if isinstance(node, ast.Call)
+                            and isinstance(node.func, ast.Name)
+                            and node.func.id in names)
+    return graph
+
+def frame_size(func_obj, variables, budget, fixed_point=None):
+    arch = budget['arch']
+    size = budget['call_overhead']
+
+    for var_name in variables.get(func_obj.name, {}):
+        if var_name == 'DECLARED_GLOBALS':
+            continue
+        size += type_size(variables[func_obj.name][var_name], arch,
+            fixed_point)
+
+    # tuples are built from a temporary array on the stack
+    for name, kind, elt_type, length in containers(func_obj):
+        if kind == 'Tuple':
+            size += type_size(elt_type, arch) * length
+
+    return size
+
+def stack_depth(func_name, graph, frames, path=()):
+    '''Returns the worst-case stack usage starting at a function
+    along with the call path, or None if the function can recurse'''
+    if func_name in path:
+        return None
+
+    path = path + (func_name,)
+    deepest = (0, ())
+    for callee in graph[func_name]:
+        depth = stack_depth(callee, graph, frames, path)
+        if depth is None:
+            return None
+        deepest = max(deepest, depth)
+
+    return (frames[func_name] + deepest[0], (func_name,) + deepest[1])
+
+def estimate(code, result, board='uno'):
+    '''Estimates SRAM, stack and heap use of a sketch
+    from its source and its translation result'''
+    budget = boardinfo.load('budgets.json', board)
+    if budget is None:
+        raise ValueError('No resource budget for board {}'.format(board))
+
+    arch = budget['arch']
+    # the prints as translated, see peephole.py
+    parsed, _ = peephole.transform(ast.parse(code))
+
+    # same globals as in the generated declarations
+    globals_sizes = {}
+    for global_var in result['variables']['global']:
+        if (global_var not in dir(ardlib)
+            and global_var not in py_consts):
+            var_type = result['variables']['global'][global_var]
+            globals_sizes[global_var] = type_size(var_type, arch,
+                result.get('fixed_point'))
+
+    # printed literals stay in flash on AVR, see flashstrings.py
+    in_flash = []
+    if result.get('flash_strings'):
+        in_flash = flashstrings.printed_literals(parsed)
+    flash_strings = flashstrings.sram_saved(set(node.s for node in in_flash))
+
+    # identical literals get merged by the compiler
+    strings = sum(len(s) + 1 for s in set(string_literals(parsed, in_flash)))
+
+    heap = sum(container_heap(kind, elt_type, length, arch)
+                for name, kind, elt_type, length in containers(parsed))
+
+    core = budget['core_sram']
+    uses_serial = any(isinstance(node, ast.Name) and node.id == 'Serial'
+                        for node in ast.walk(parsed))
+    if uses_serial:
+        core += budget['serial_sram']
+
+    graph = call_graph(parsed)
+    frames = dict((func.name, frame_size(func, result['variables'], budget,
+                        result.get('fixed_point')))
+                    for func in parsed.body
+                    if isinstance(func, ast.FunctionDef))
+
+    # setup() and loop() are called from main() one after another,
+    # without them (e.g. in a module) anything not called
+    # by another function is an entry point
+    roots = [name for name in graph if name in ('setup', 'loop')]
+    if not roots:
+        roots = [name for name in graph
+                    if not any(name in graph[caller] for caller in graph
+                                if caller != name)]
+    if not roots:
+        roots = list(graph)
+
+    stack = budget['core_stack']
+    stack_path = ()
+    recursive = []
+    for root in roots:
+        depth = stack_depth(root, graph, frames)
+        if depth is None:
+            recursive.append(root)
+        elif depth[0] + budget['core_stack'] > stack:
+            stack = depth[0] + budget['core_stack']
+            stack_path = depth[1]
+
+    if recursive:
+        warn('stack depth is unbounded because of recursion in {}'.format(
+            ', '.join(recursive)), BudgetExceededWarning)
+
+    sram_total = sum(globals_sizes.values()) + strings + heap + core + stack
+
+    if sram_total > budget['sram']:
+        warn('estimated SRAM use of {} bytes exceeds {} bytes on {}'.format(
+            sram_total, budget['sram'], board), BudgetExceededWarning)
+
+    return {
+        'board': board,
+        'globals': globals_sizes,
+        'strings': strings,
+        'flash_strings': flash_strings,
+        'heap': heap,
+        'core': core,
+        'stack': stack,
+        'stack_path': stack_path,
+        'recursive': recursive,
+        'sram_total': sram_total,
+        'sram_budget': budget['sram'],
+        'flash_data': strings + flash_strings,
+        'flash_budget': budget['flash']
+    }
+
+def format_report(report):
+    if report['recursive']:
+        stack_path = 'unbounded, recursion in ' + ', '.join(report['recursive'])
+    else:
+        stack_path = ' -> '.join(report['stack_path']) or 'core only'
+
+    if report['sram_total'] > report['sram_budget']:
+        sram_status = 'OVER BUDGET'
+    else:
+        sram_status = '{:.0%}'.format(report['sram_total'] / report['sram_budget'])
+
+    return REPORT.format(board=report['board'],
+        globals=sum(report['globals'].values()),
+        strings=report['strings'],
+        flash_strings=report['flash_strings'],
+        heap=report['heap'],
+        core=report['core'],
+        stack=report['stack'],
+        stack_path=stack_path,
+        sram_total=report['sram_total'],
+        sram_budget=report['sram_budget'],
+        sram_status=sram_status,
+        flash_data=report['flash_data'],
+        flash_budget=report['flash_budget'])
@@ -0,0 +1,315 @@
+import ast
+from warnings import warn
+
+import boardinfo, compiler, portio
+
+# batched ADC sampling: analogReadBlock(buffer, pins, rate) fills a static
+# buffer of samples from one or more pins (interleaved) at a steady rate.
+# on AVR the ADC interrupt stores every conversion, either with the ADC
+# running freely (one conversion every 13 ADC clocks) or with timer 1
+# starting each conversion, which makes timer 1 PWM (pins 9 and 10)
+# unavailable while sampling. other boards fall back to analogRead
+# paced with micros().
+
+AVR_PRELUDE = '''// batched ADC sampling: the ADC interrupt fills the buffer
+volatile uint16_t *_adc_buffer;
+volatile unsigned int _adc_count;
+volatile unsigned int _adc_index;
+uint8_t _adc_channels[{max_pins}];
+uint8_t _adc_nchannels;
+volatile uint8_t _adc_slot;
+boolean _adc_timed;
+volatile boolean _adc_done = true;
+
+ISR(ADC_vect) {{
+    _adc_buffer[_adc_index++] = ADC;
+    if (_adc_index >= _adc_count) {{
+        ADCSRA &= ~(_BV(ADIE) | _BV(ADATE));
+        if (_adc_timed) TCCR1B = 0;
+        _adc_done = true;
+        return;
+    }}
+    // the next conversion is only started by the timer,
+    // so there is time to switch channels
+    if (_adc_nchannels > 1) {{
+        if (++_adc_slot == _adc_nchannels) _adc_slot = 0;
+        ADMUX = (ADMUX & 0xF0) | _adc_channels[_adc_slot];
+    }}
+    if (_adc_timed) TIFR1 = _BV(OCF1B);
+}}
+
+unsigned int _adc_start(volatile uint16_t *buffer, unsigned int count,
+        uint8_t adc_prescaler, unsigned int timer_top, uint8_t timer_clock,
+        uint8_t nchannels, {channel_args}) {{
+    uint8_t channels[{max_pins}] = {{{channel_names}}};
+    for (uint8_t i = 0; i < {max_pins}; i++) _adc_channels[i] = channels[i];
+    _adc_buffer = buffer;
+    _adc_count = count;
+    _adc_index = 0;
+    _adc_nchannels = nchannels;
+    _adc_slot = 0;
+    _adc_timed = timer_clock != 0;
+    _adc_done = false;
+    ADMUX = _BV(REFS0) | c0;
+    ADCSRA = _BV(ADEN) | _BV(ADIF) | _BV(ADIE) | _BV(ADATE) | adc_prescaler;
+    if (_adc_timed) {{
+        // timer 1 compare match B starts every conversion
+        ADCSRB = _BV(ADTS2) | _BV(ADTS0);
+        TCCR1A = 0;
+        TCCR1B = 0;
+        TCNT1 = 0;
+        OCR1A = timer_top;
+        OCR1B = timer_top;
+        TIFR1 = _BV(OCF1B);
+        TCCR1B = _BV(WGM12) | timer_clock;
+    }}
+    else {{
+        ADCSRB = 0;
+        ADCSRA |= _BV(ADSC);
+    }}
+    return count;
+}}
+
+unsigned int _adc_wait(unsigned int count) {{
+    while (!_adc_done) {{}}
+    return count;
+}}
+'''
+
+GENERIC_PRELUDE = '''// batched ADC sampling: analogRead paced with micros()
+volatile boolean _adc_done = true;
+
+unsigned int _adc_start(volatile uint16_t *buffer, unsigned int count,
+        unsigned long period_us, uint8_t npins, {channel_args}) {{
+    uint8_t pins[{max_pins}] = {{{channel_names}}};
+    unsigned long due = micros();
+    _adc_done = false;
+    for (unsigned int i = 0; i < count; i++) {{
+        if (period_us) {{
+            while ((long)(micros() - due) < 0) {{}}
+            due += period_us;
+        }}
+        buffer[i] = analogRead(pins[i % npins]);
+    }}
+    _adc_done = true;
+    return count;
+}}
+
+unsigned int _adc_wait(unsigned int count) {{
+    while (!_adc_done) {{}}
+    return count;
+}}
+'''
+
+AVR_START = '_adc_start({buffer}, {count}, {adc_prescaler}, {timer_top}, {timer_clock}, {npins}, {channels})'
+GENERIC_START = '_adc_start({buffer}, {count}, {period_us}, {npins}, {channels})'
+WAIT = '_adc_wait({start})'
+DONE = '_adc_done'
+
+# the type of the samples in the buffer
+SAMPLE_TYPE = 'uint16_t'
+BUFFER_TYPE = 'volatile {type}[{size}]'
+
+MAX_PINS = 8
+
+# ADCSRA ADPS bits for every ADC clock prescaler
+adc_prescalers = {2: 1, 4: 2, 8: 3, 16: 4, 32: 5, 64: 6, 128: 7}
+# TCCR1B CS1x bits for every timer 1 clock prescaler
+timer_prescalers = {1: 1, 8: 2, 64: 3, 256: 4, 1024: 5}
+
+# full 10-bit resolution needs an ADC clock of at most 200 kHz
+MAX_ADC_CLOCK = 200000
+# ADC clocks per conversion, auto-triggered ones take half a clock more
+CONVERSION_CLOCKS = 13
+TRIGGERED_CONVERSION_CLOCKS = 13.5
+DEFAULT_PRESCALER = 128
+
+funcs = ('analogReadBlock', 'analogStartBlock', 'analogBlockDone')
+
+class SamplingWarning(Warning):
+    pass
+
+def uses_sampling(parsed):
+    return any(isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                and node.func.id in funcs + ('analogBuffer',)
+                for node in ast.walk(parsed))
+
+def is_avr(pinmap):
+    return pinmap is not None and pinmap['arch'] == 'avr'
+
+def prelude(pinmap):
+    channel_args = ', '.join(['uint8_t c0'] + ['uint8_t c{} = 0'.format(n)
+                                for n in range(1, MAX_PINS)])
+    channel_names = ', '.join('c{}'.format(n) for n in range(MAX_PINS))
+    template = AVR_PRELUDE if is_avr(pinmap) else GENERIC_PRELUDE
+    return template.format(max_pins=MAX_PINS, channel_args=channel_args,
+        channel_names=channel_names)
+
+def constant(node, constants, what):
+    if isinstance(node, ast.Num) and type(node.n) is int:
+        return node.n
+    if isinstance(node, ast.Name) and node.id in constants:
+        return constants[node.id]
+    raise compiler.UnsupportedSyntaxError(
+        '{} has to be a constant integer'.format(what), node.lineno)
+
+def buffer_type(call, constants, scope):
+    '''Returns the static array type for analogBuffer(size)'''
+    if scope != 'global':
+        raise compiler.UnsupportedSyntaxError(
+            'analogBuffer can only be used at module level', call.lineno)
+    if len(call.args) != 1:
+        raise compiler.UnsupportedSyntaxError(
+            'analogBuffer takes the number of samples', call.lineno)
+
+    size = constant(call.args[0], constants, 'the buffer size')
+    if size <= 0:
+        raise compiler.UnsupportedSyntaxError(
+            'the buffer needs room for at least one sample', call.lineno)
+    return BUFFER_TYPE.format(type=SAMPLE_TYPE, size=size)
+
+def array_size(var_type):
+    '''Returns the number of elements of a static array type or None'''
+    if not var_type.endswith(']'):
+        return None
+    return int(var_type[var_type.index('[') + 1:-1])
+
+def get_args(call):
+    '''Returns the buffer, pins, rate and prescaler arguments of a call'''
+    names = ('buffer', 'pins', 'rate', 'prescaler')
+    args = dict(zip(names, call.args))
+    for keyword in call.keywords:
+        args[keyword.arg] = keyword.value
+
+    if 'buffer' not in args or 'pins' not in args:
+        raise compiler.UnsupportedSyntaxError(
+            '{} needs a buffer and the pins to sample'.format(call.func.id),
+            call.lineno)
+    if not isinstance(args['buffer'], ast.Name):
+        raise compiler.UnsupportedSyntaxError(
+            'the buffer has to be made with analogBuffer', call.lineno)
+    return args
+
+def buffer_size(buffer, global_vars):
+    size = array_size(global_vars.get(buffer.id, ''))
+    if size is None:
+        raise compiler.UnsupportedSyntaxError(
+            '{} has to be made with analogBuffer'.format(buffer.id),
+            buffer.lineno)
+    return size
+
+def pin_nodes(pins):
+    if isinstance(pins, (ast.Tuple, ast.List)):
+        pins = pins.elts
+    else:
+        pins = [pins]
+
+    if not 0 < len(pins) <= MAX_PINS:
+        raise compiler.UnsupportedSyntaxError(
+            'between 1 and {} pins can be sampled at once'.format(MAX_PINS),
+            pins[0].lineno if pins else -1)
+    return pins
+
+def adc_channel(node, pinmap, constants):
+    '''ADC channel of an analog pin, given as A0 or as its pin number'''
+    pin = portio.pin_number(node, pinmap, constants)
+    analog_pins = dict((number, int(alias[1:]))
+                        for alias, number in pinmap['aliases'].items()
+                        if alias.startswith('A'))
+    if pin in analog_pins:
+        return analog_pins[pin]
+    # analogRead(0) reads A0 as well
+    if pin is not None and 0 <= pin < len(analog_pins):
+        return pin
+    raise compiler.UnsupportedSyntaxError(
+        'analog pins have to be known at compile time', node.lineno)
+
+def timer_settings(rate, clock, prescaler, lineno):
+    '''Timer 1 prescaler bits and top value for a sample rate'''
+    period = clock / rate
+    if period < TRIGGERED_CONVERSION_CLOCKS * prescaler:
+        raise compiler.UnsupportedSyntaxError(
+            '{} Hz is too fast for an ADC prescaler of {}, '
+            'the most is {:.0f} Hz'.format(rate, prescaler,
+                clock / (TRIGGERED_CONVERSION_CLOCKS * prescaler)), lineno)
+
+    for timer_prescaler in sorted(timer_prescalers):
+        top = round(period / timer_prescaler) - 1
+        if top <= 0xFFFF:
+            return timer_prescalers[timer_prescaler], top
+
+    raise compiler.UnsupportedSyntaxError(
+        '{} Hz is too slow for timer 1'.format(rate), lineno)
+
+def call_code(func_name, call, global_vars, pinmap, constants, board):
+    '''Returns the code for a call to one of the sampling functions'''
+    if func_name == 'analogBlockDone':
+        return DONE
+
+    args = get_args(call)
+    count = buffer_size(args['buffer'], global_vars)
+    pins = pin_nodes(args['pins'])
+    rate = 0
+    if 'rate' in args:
+        rate = constant(args['rate'], constants, 'the sample rate')
+    prescaler = DEFAULT_PRESCALER
+    if 'prescaler' in args:
+        prescaler = constant(args['prescaler'], constants, 'the prescaler')
+
+    if is_avr(pinmap):
+        if prescaler not in adc_prescalers:
+            raise compiler.UnsupportedSyntaxError(
+                'the ADC prescaler has to be one of {}'.format(
+                    ', '.join(str(n) for n in sorted(adc_prescalers))),
+                call.lineno)
+
+        clock = boardinfo.load('cycles.json', board)['clock']
+        if clock / prescaler > MAX_ADC_CLOCK:
+            warn('an ADC clock of {:.0f} kHz (line {}) gives less than '
+                '10 bits of resolution'.format(clock / prescaler / 1000,
+                    call.lineno), SamplingWarning)
+
+        timer_clock, timer_top = 0, 0
+        if rate:
+            timer_clock, timer_top = timer_settings(rate, clock, prescaler,
+                call.lineno)
+        elif len(pins) > 1:
+            # in free running mode the next conversion has already started
+            # by the time the channel could be switched
+            raise compiler.UnsupportedSyntaxError(
+                'sampling several pins needs a rate', call.lineno)
+
+        code = AVR_START.format(buffer=args['buffer'].id, count=count,
+            adc_prescaler=adc_prescalers[prescaler], timer_top=timer_top,
+            timer_clock=timer_clock, npins=len(pins),
+            channels=', '.join(str(adc_channel(pin, pinmap, constants))
+                                for pin in pins))
+    else:
+        period_us = round(1e6 / rate) if rate else 0
+        channels = [str(compiler.to_arduino(pin, newline=False)['code']).strip()
+                    for pin in pins]
+        code = GENERIC_START.format(buffer=args['buffer'].id, count=count,
+            period_us=period_us, npins=len(pins), channels=', '.join(channels))
+
+    if func_name == 'analogReadBlock':
+        code = WAIT.format(start=code)
+    return code
+
+def block_cycles(call, global_vars, clock):
+    '''Cycles analogReadBlock waits for the buffer to fill up,
+    or None if that isn't known statically'''
+    try:
+        args = get_args(call)
+        count = buffer_size(args['buffer'], global_vars)
+    except compiler.CompilationError:
+        return None
+
+    rate = args.get('rate')
+    if isinstance(rate, ast.Num) and rate.n:
+        return int(count * clock / rate.n)
+
+    if rate is None:
+        prescaler = args.get('prescaler')
+        prescaler = prescaler.n if isinstance(prescaler, ast.Num) else DEFAULT_PRESCALER
+        return count * CONVERSION_CLOCKS * prescaler
+    return None
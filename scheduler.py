@@ -0,0 +1,75 @@
+import ast
+from warnings import warn
+
+import compiler
+
+# functions decorated with @every(ms) are run from a cooperative
+# scheduler at the top of loop(). every task keeps its next deadline
+# and a counter of the deadlines it missed, nothing ever waits
+
+DISPATCH = '''{indent}if ((long)(millis() - _{name}_due) >= 0) {{
+{indent}    {name}();
+{indent}    _{name}_due += {period};
+{indent}    if ((long)(millis() - _{name}_due) >= 0) {{
+{indent}        {name}_overruns++;
+{indent}        _{name}_due = millis() + {period};
+{indent}    }}
+{indent}}}
+'''
+START = '{indent}_{name}_due = millis()\n'
+
+class BlockingTaskWarning(Warning):
+    pass
+
+def find_tasks(parsed):
+    '''Returns (name, period) for every function decorated with @every(ms)'''
+    tasks = []
+    for func in parsed.body:
+        if not isinstance(func, ast.FunctionDef):
+            continue
+
+        for decorator in func.decorator_list:
+            if not (isinstance(decorator, ast.Call)
+                and isinstance(decorator.func, ast.Name)
+                and decorator.func.id == 'every'):
+                continue
+
+            if (len(decorator.args) != 1
+                or not isinstance(decorator.args[0], ast.Num)
+                or type(decorator.args[0].n) is not int
+                or decorator.args[0].n <= 0):
+                raise compiler.UnsupportedSyntaxError(
+                    '@every needs a constant period in milliseconds',
+                    decorator.lineno)
+
+            if func.args.args:
+                raise compiler.UnsupportedSyntaxError(
+                    'task {} cannot take arguments'.format(func.name),
+                    func.lineno)
+
+            for node in ast.walk(func):
+                if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                    and node.func.id == 'delay'):
+                    warn('delay() in task {} (line {}) blocks all the other tasks'.format(
+                        func.name, node.lineno), BlockingTaskWarning)
+
+            tasks.append((func.name, decorator.args[0].n))
+
+    return tasks
+
+def task_variables(tasks):
+    '''Global variables of the scheduler and their types.
+    <task>_overruns can be read by the sketch.'''
+    variables = {}
+    for name, period in tasks:
+        variables['_{}_due'.format(name)] = 'unsigned long'
+        variables['{}_overruns'.format(name)] = 'unsigned int'
+    return variables
+
+def dispatch_code(tasks, indent):
+    return ''.join(DISPATCH.format(indent=indent, name=name, period=period)
+                    for name, period in tasks)
+
+def start_code(tasks, indent):
+    return ''.join(START.format(indent=indent, name=name)
+                    for name, period in tasks)
@@ -0,0 +1,339 @@
+import asyncio, hashlib, inspect, json, os, sys, time, warnings
+from argparse import ArgumentParser
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import compiler, resources
+
+# a long-running translation server for editors and CI, so they don't
+# start an interpreter (and load ardlib) for every translation. it
+# speaks JSON-RPC 2.0, one request or response per line, on stdin and
+# stdout or on a localhost TCP port:
+#
+#   python server.py              # stdio
+#   python server.py --port 8765
+#
+#   {"jsonrpc": "2.0", "id": 1, "method": "translate",
+#    "params": {"code": "...", "board": "uno"}}
+#
+# the calls are translate, check, resources and stats. translations run
+# in a pool of worker processes which have translated a sketch already
+# when the first request comes, and answers are cached by a hash of
+# the call, so an unchanged file is answered at once. requests are
+# answered as they finish, which need not be the order they came in.
+# a worker that dies fails its call and the pool is started again.
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_HOST = '127.0.0.1'
+
+# latencies kept per method for the stats
+LATENCY_SAMPLES = 10000
+
+WARM_UP_SKETCH = '''def setup():
+    pinMode(13, OUTPUT)
+
+def loop():
+    digitalWrite(13, analogRead(0) > 512)
+'''
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+TRANSLATION_ERROR = -32000
+WORKER_ERROR = -32001
+
+class RPCError(Exception):
+    def __init__(self, code, message, data=None):
+        self.code = code
+        self.message = message
+        self.data = data
+
+    def as_dict(self):
+        error = {'code': self.code, 'message': self.message}
+        if self.data is not None:
+            error['data'] = self.data
+        return error
+
+def translation_error(error):
+    '''The JSON-RPC error for an exception raised by the translator'''
+    return RPCError(TRANSLATION_ERROR, str(error), {
+        'type': type(error).__name__,
+        'line': getattr(error, 'line', None)})
+
+# the calls, run in the worker processes
+
+def translate(code, board=None, fixed_point=None, instrument=None):
+    result = compiler.translate(code, board=board, fixed_point=fixed_point,
+        instrument=instrument)
+    return dict((key, result[key]) for key in ('code', 'telemetry', 'probes',
+        'probe_baud_rate', 'flash_strings', 'includes'))
+
+def check(code, board=None, fixed_point=None):
+    '''Only whether the code translates, and the error if it doesn't'''
+    try:
+        compiler.translate(code, board=board, fixed_point=fixed_point)
+    except Exception as error:
+        return {'ok': False, 'error': translation_error(error).as_dict()}
+    return {'ok': True}
+
+def resource_report(code, board='uno', fixed_point=None):
+    result = compiler.translate(code, board=board, fixed_point=fixed_point)
+    report = resources.estimate(code, result, board)
+    return {'report': report, 'text': resources.format_report(report)}
+
+methods = {'translate': translate, 'check': check, 'resources': resource_report}
+
+def warm_up():
+    '''Runs in every worker as it starts'''
+    # stdout carries the responses
+    sys.stdout = sys.stderr
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        compiler.translate(WARM_UP_SKETCH)
+
+def ready():
+    '''A job for starting a worker'''
+    return os.getpid()
+
+def call(method, params):
+    '''Runs a call in a worker, returns (result, None) or (None, error)
+    along with the warnings of the translation'''
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        try:
+            result, error = methods[method](**params), None
+        except Exception as exception:
+            result, error = None, translation_error(exception).as_dict()
+    if result is not None:
+        result['warnings'] = [str(warning.message) for warning in caught]
+    return result, error
+
+class ResultCache:
+    '''The answers to the last calls, least recently used ones go first'''
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, method, params):
+        call = json.dumps([method, params], sort_keys=True)
+        return hashlib.sha1(call.encode()).hexdigest()
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, answer):
+        self.entries[key] = answer
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Server:
+    '''Answers JSON-RPC requests, each on a worker unless cached'''
+
+    def __init__(self, workers=None, cache_size=DEFAULT_CACHE_SIZE):
+        self.workers = workers or os.cpu_count()
+        self.pool = self.start_pool()
+        self.restarts = 0
+        self.cache = ResultCache(cache_size)
+        self.running = {}
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+        self.counts = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.start = time.time()
+
+    def start_pool(self, wait=True):
+        '''A pool with all its workers started and warming up (and,
+        with wait, warmed up). the pool only starts a worker for a job
+        which finds none idle, so a job per worker starts them all'''
+        pool = ProcessPoolExecutor(self.workers, initializer=warm_up)
+        jobs = [pool.submit(ready) for n in range(self.workers)]
+        if wait:
+            for job in jobs:
+                job.result()
+        return pool
+
+    def restart_pool(self, broken):
+        '''Replaces a pool a worker died in, it can't run anything else'''
+        if self.pool is broken:
+            # not waiting, the cached answers can still be given meanwhile
+            self.pool = self.start_pool(wait=False)
+            self.restarts += 1
+            broken.shutdown(wait=False)
+
+    def check_params(self, method, params):
+        if not isinstance(params, dict):
+            raise RPCError(INVALID_PARAMS, 'params must be an object')
+        try:
+            inspect.signature(methods[method]).bind(**params)
+        except TypeError as error:
+            raise RPCError(INVALID_PARAMS, str(error))
+
+    async def run(self, method, params):
+        if method == 'stats':
+            return self.stats()
+        if method not in methods:
+            raise RPCError(METHOD_NOT_FOUND, 'no method {}'.format(method))
+        self.check_params(method, params)
+
+        # the same call coming again while it's running waits for it
+        key = self.cache.key(method, params)
+        answer = self.cache.get(key)
+        pool = self.pool
+        try:
+            if answer is None and key in self.running:
+                answer = await asyncio.shield(self.running[key])
+            elif answer is None:
+                self.running[key] = asyncio.get_running_loop().run_in_executor(
+                    pool, call, method, params)
+                try:
+                    answer = await asyncio.shield(self.running[key])
+                finally:
+                    del self.running[key]
+                self.cache.put(key, answer)
+        except BrokenProcessPool:
+            # killed, out of memory or crashed in C
+            self.restart_pool(pool)
+            raise RPCError(WORKER_ERROR, 'the worker running the call died')
+
+        result, error = answer
+        if error is not None:
+            raise RPCError(**error)
+        return result
+
+    async def handle(self, line):
+        '''The response to a request line, None for notifications'''
+        start = time.perf_counter()
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            return {'jsonrpc': '2.0', 'id': None,
+                    'error': RPCError(PARSE_ERROR, str(error)).as_dict()}
+        if not isinstance(request, dict) or not isinstance(
+            request.get('method'), str):
+            return {'jsonrpc': '2.0', 'id': None, 'error': RPCError(
+                INVALID_REQUEST, 'not a JSON-RPC request').as_dict()}
+
+        method = request['method']
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        try:
+            response['result'] = await self.run(method,
+                request.get('params', {}))
+        except RPCError as error:
+            response['error'] = error.as_dict()
+            self.errors[method] += 1
+
+        if method in methods:
+            self.counts[method] += 1
+            self.latencies[method].append(time.perf_counter() - start)
+        return response if 'id' in request else None
+
+    def stats(self):
+        '''Requests, errors and latencies in ms per method'''
+        stats = {
+            'uptime': time.time() - self.start,
+            'workers': self.workers,
+            'pool_restarts': self.restarts,
+            'cache': {'entries': len(self.cache.entries),
+                      'hits': self.cache.hits, 'misses': self.cache.misses},
+            'methods': {}
+        }
+        for method, latencies in self.latencies.items():
+            ms = [latency * 1000 for latency in latencies]
+            stats['methods'][method] = {
+                'requests': self.counts[method],
+                'errors': self.errors[method],
+                'mean_ms': sum(ms) / len(ms),
+                'p50_ms': percentile(ms, 0.5),
+                'p95_ms': percentile(ms, 0.95),
+                'max_ms': max(ms)
+            }
+        return stats
+
+    async def serve_lines(self, reader, write):
+        '''Answers the requests from a stream, several at a time'''
+        tasks = set()
+
+        async def answer(line):
+            response = await self.handle(line)
+            if response is not None:
+                await write((json.dumps(response) + '\n').encode())
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                task = asyncio.ensure_future(answer(line.decode()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def serve_stdio(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=1 << 24)
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+        async def write(data):
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+
+        await self.serve_lines(reader, write)
+
+    async def serve_tcp(self, host, port):
+        async def connection(reader, writer):
+            async def write(data):
+                writer.write(data)
+                await writer.drain()
+            try:
+                await self.serve_lines(reader, write)
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(connection, host, port,
+            limit=1 << 24)
+        print('serving on {}:{}'.format(host, port), file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.pool.shutdown()
+
+if __name__ == '__main__':
+    argp = ArgumentParser(description='translation server speaking '
+        'JSON-RPC on stdio or a TCP port')
+    argp.add_argument('--port', type=int, default=None,
+        help='listen on this port instead of stdio')
+    argp.add_argument('--host', default=DEFAULT_HOST)
+    argp.add_argument('-j', '--workers', type=int, default=None,
+        help='translations at the same time (one per processor by default)')
+    argp.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+        help='answers kept for repeated requests')
+    args = argp.parse_args()
+
+    server = Server(args.workers, args.cache_size)
+    try:
+        if args.port is None:
+            asyncio.run(server.serve_stdio())
+        else:
+            asyncio.run(server.serve_tcp(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,560 @@
+import array, ast, inspect, os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ardlib, peephole, portio
+
+# runs a Python sketch on the host against recorded inputs instead of
+# translating it. the ardlib functions get a simulated board behind them:
+# virtual time that only moves when the sketch spends it, pin state,
+# analogRead/digitalRead driven by NumPy traces and every output recorded
+# into arrays. the sketch runs with Python semantics, so int overflow and
+# integer division differ from the board.
+#
+#   recording = simulate(open('sketch.py').read(), iterations=10 ** 6,
+#                        analog={'A0': trace}, trace_rate=1000)
+#   recording.digital  # time_us, pin, level of every digitalWrite
+
+# microseconds the board spends in every library call
+DEFAULT_COSTS = {
+    'pinMode': 4,
+    'digitalWrite': 4,
+    'digitalRead': 4,
+    'analogRead': 112,
+    'analogWrite': 8,
+    'millis': 1,
+    'micros': 1,
+    'Serial': 2,
+    'loop': 4
+}
+
+DEFAULT_TRACE_RATE = 1000
+DEFAULT_BAUDRATE = 9600
+ADC_MAX = 1023
+
+# Arduino prints floats with two decimals
+FLOAT_DIGITS = 2
+
+formats = {'DEC': '{:d}', 'HEX': '{:X}', 'OCT': '{:o}', 'BIN': '{:b}'}
+
+class SimulationError(Exception):
+    pass
+
+class Trace:
+    '''Input values sampled at a fixed rate, looked up by virtual time.
+    The last value holds once the trace runs out.'''
+
+    def __init__(self, values, rate):
+        self.values = np.asarray(values)
+        self.rate = rate
+        if len(self.values) == 0:
+            raise SimulationError('input traces cannot be empty')
+
+    def index(self, time_us):
+        return np.minimum(np.asarray(time_us) * self.rate // 1000000,
+                            len(self.values) - 1)
+
+    def at(self, time_us):
+        return self.values[self.index(time_us)]
+
+    def duration_us(self):
+        return len(self.values) * 1000000 // self.rate
+
+    def time_us(self, index):
+        '''When the sample at an index starts'''
+        return (index * 1000000 + self.rate - 1) // self.rate
+
+class Recorder:
+    '''Collects events in compact typed arrays'''
+
+    def __init__(self, *typecodes):
+        self.columns = [array.array(typecode) for typecode in typecodes]
+
+    def add(self, *values):
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def arrays(self):
+        return [np.frombuffer(column, dtype=column.typecode).copy()
+                if len(column) else np.array([], dtype=column.typecode)
+                for column in self.columns]
+
+class Recording:
+    '''Everything a simulated sketch did'''
+
+    def __init__(self, board):
+        self.digital_time, self.digital_pin, self.digital_level = \
+            board.digital_writes.arrays()
+        self.analog_time, self.analog_pin, self.analog_value = \
+            board.analog_writes.arrays()
+        self.serial_time = np.array(board.serial_times, dtype=np.int64)
+        self.serial_text = np.array(board.serial_texts, dtype=str)
+        self.sent_time = np.array(board.sent_times, dtype=np.int64)
+        self.sent = board.sent
+        self.iterations = board.iterations
+        self.time_us = board.time_us
+
+    @property
+    def digital(self):
+        return self.digital_time, self.digital_pin, self.digital_level
+
+    @property
+    def analog(self):
+        return self.analog_time, self.analog_pin, self.analog_value
+
+    def serial_output(self):
+        return ''.join(self.serial_text)
+
+    def pin_levels(self, pin):
+        '''Times and levels of the digitalWrites to a pin'''
+        written = self.digital_pin == pin
+        return self.digital_time[written], self.digital_level[written]
+
+class SerialPort:
+    def __init__(self, board):
+        self.board = board
+
+    def begin(self, baudrate):
+        self.board.baudrate = baudrate
+        self.board.spend('Serial')
+
+    def available(self):
+        self.board.spend('Serial')
+        return len(self.board.serial_input) - self.board.serial_read
+
+    def read(self):
+        self.board.spend('Serial')
+        if self.board.serial_read >= len(self.board.serial_input):
+            return -1
+        value = self.board.serial_input[self.board.serial_read]
+        self.board.serial_read += 1
+        return value
+
+    def print(self, value, format=None):
+        self.board.write_serial(format_value(value, format))
+
+    def println(self, value='', format=None):
+        self.board.write_serial(format_value(value, format) + '\r\n')
+
+    def write(self, value):
+        self.board.write_serial(chr(value) if isinstance(value, int) else value)
+
+    def send(self, *values):
+        self.board.sent_times.append(self.board.time_us)
+        self.board.sent.append(values)
+        self.board.spend('Serial')
+
+def format_value(value, format=None):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        digits = FLOAT_DIGITS if format is None else format
+        return '{:.{}f}'.format(value, digits)
+    if isinstance(value, int):
+        if isinstance(format, ardlib.Format):
+            return formats[format.format].format(value)
+        return str(value)
+    return str(value)
+
+class Board:
+    '''The simulated board a sketch runs on'''
+
+    def __init__(self, board='uno', analog=None, digital=None,
+        trace_rate=DEFAULT_TRACE_RATE, serial_input=b'', costs=None):
+        self.pinmap = portio.load_pinmap(board)
+        self.aliases = dict(self.pinmap['aliases']) if self.pinmap else dict(
+            ('A{}'.format(n), 14 + n) for n in range(6))
+
+        self.analog = dict((self.pin(pin), Trace(values, trace_rate))
+                            for pin, values in (analog or {}).items())
+        self.digital = dict((self.pin(pin), Trace(values, trace_rate))
+                            for pin, values in (digital or {}).items())
+
+        self.costs = dict(DEFAULT_COSTS)
+        self.costs.update(costs or {})
+
+        self.time_us = 0
+        self.iterations = 0
+        self.modes = {}
+        self.levels = {}
+        self.handlers = []
+        self.tasks = []
+
+        self.baudrate = DEFAULT_BAUDRATE
+        self.serial_input = bytes(serial_input)
+        self.serial_read = 0
+        self.serial_times = []
+        self.serial_texts = []
+        self.sent_times = []
+        self.sent = []
+
+        self.digital_writes = Recorder('q', 'h', 'h')
+        self.analog_writes = Recorder('q', 'h', 'l')
+
+        self.sampling_done = True
+
+    def pin(self, pin):
+        if isinstance(pin, str):
+            return self.aliases[pin]
+        return pin
+
+    def inputs_end_us(self):
+        traces = list(self.analog.values()) + list(self.digital.values())
+        if not traces:
+            return None
+        return max(trace.duration_us() for trace in traces)
+
+    # time
+
+    def advance(self, us):
+        '''Moves virtual time on, running interrupt handlers
+        for any edges on the digital inputs in between'''
+        start = self.time_us
+        self.time_us += int(us)
+        if self.handlers and self.time_us > start:
+            self.run_handlers(start, self.time_us)
+
+    def spend(self, call):
+        self.advance(self.costs.get(call, 1))
+
+    def run_handlers(self, start, end):
+        for handler in self.handlers:
+            pin, mode, func, debounce = handler[:4]
+            trace = self.digital.get(pin)
+            if trace is None:
+                continue
+            if debounce:
+                self.run_debounced(handler, trace, start, end)
+                continue
+            first, last = trace.index(start), trace.index(end)
+            if first == last:
+                continue
+
+            levels = trace.values[first:last + 1].astype(bool)
+            changes = np.flatnonzero(levels[1:] != levels[:-1])
+            for change in changes:
+                rising = levels[change + 1]
+                if (mode == 'CHANGE' or (mode == 'RISING' and rising)
+                    or (mode == 'FALLING' and not rising)):
+                    func()
+
+    def run_debounced(self, handler, trace, start, end):
+        '''Every edge only restarts the debounce time, the 1 ms timer
+        runs the handler once the pin has been stable for debounce ms
+        and is at a new level, see interrupts.DEBOUNCE_CONFIRM'''
+        pin, mode, func, debounce = handler[:4]
+        first, last = trace.index(start), trace.index(end)
+        levels = trace.values[first:last + 1].astype(bool)
+        edges = [trace.time_us(first + change + 1)
+                    for change in np.flatnonzero(levels[1:] != levels[:-1])]
+
+        for edge in edges + [None]:
+            # level and millis() of the last edge, None once confirmed
+            level, since = handler[4:]
+            # the timer tick confirming the last edge comes before the next
+            if since is not None:
+                tick = (since + debounce) * 1000
+                if tick <= (end if edge is None else edge):
+                    handler[5] = None
+                    if int(bool(trace.at(tick))) != level:
+                        handler[4] = level = 1 - level
+                        if (mode == 'CHANGE' or (mode == 'RISING' and level)
+                            or (mode == 'FALLING' and not level)):
+                            func()
+            if edge is not None:
+                handler[5] = edge // 1000
+
+    # IO
+
+    def level(self, pin):
+        if pin in self.digital:
+            return int(bool(self.digital[pin].at(self.time_us)))
+        if pin in self.levels:
+            return self.levels[pin]
+        return 1 if self.modes.get(pin) == 'INPUT_PULLUP' else 0
+
+    def write_serial(self, text):
+        self.serial_times.append(self.time_us)
+        self.serial_texts.append(text)
+        # ten bits on the wire for every character
+        self.advance(self.costs['Serial'] + len(text) * 10000000 // self.baudrate)
+
+    def analog_value(self, pin):
+        pin = self.pin(pin)
+        # analogRead(0) reads A0 as well
+        if pin not in self.analog and pin < len(self.aliases):
+            pin = self.aliases.get('A{}'.format(pin), pin)
+        trace = self.analog.get(pin)
+        if trace is None:
+            return 0
+        return int(trace.at(self.time_us))
+
+    def api(self):
+        '''The functions and constants of ardlib, acting on this board'''
+        board = self
+        namespace = {}
+
+        # the constants as they are
+        for name in dir(ardlib):
+            value = getattr(ardlib, name)
+            if not name.startswith('__') and not callable(value):
+                namespace[name] = value
+        for name in ('Mode', 'Format'):
+            namespace[name] = getattr(ardlib, name)
+        namespace.update(self.aliases)
+        namespace['Serial'] = SerialPort(self)
+
+        def pinMode(pin, mode):
+            board.modes[board.pin(pin)] = mode.mode
+            board.spend('pinMode')
+
+        def digitalWrite(pin, level):
+            pin = board.pin(pin)
+            level = int(bool(level))
+            board.levels[pin] = level
+            board.digital_writes.add(board.time_us, pin, level)
+            board.spend('digitalWrite')
+
+        def digitalRead(pin):
+            board.spend('digitalRead')
+            return board.level(board.pin(pin))
+
+        def analogRead(pin):
+            board.spend('analogRead')
+            return board.analog_value(pin)
+
+        def analogWrite(pin, value):
+            board.analog_writes.add(board.time_us, board.pin(pin), int(value))
+            board.spend('analogWrite')
+
+        def analogBuffer(size):
+            return np.zeros(size, dtype=np.uint16)
+
+        def analogStartBlock(buffer, pins, rate=0, prescaler=128):
+            pins = pins if isinstance(pins, (tuple, list)) else (pins,)
+            if not rate:
+                # free running, 13 ADC clocks per conversion at 16 MHz
+                rate = 16000000 // prescaler // 13
+            # every sample is read from the traces at once
+            times = board.time_us + np.arange(len(buffer)) * 1000000 // rate
+            for n, pin in enumerate(pins):
+                trace = board.analog.get(board.pin(pin))
+                if trace is not None:
+                    buffer[n::len(pins)] = trace.at(times[n::len(pins)])
+                else:
+                    buffer[n::len(pins)] = 0
+            board.sampling_done = False
+            board.sampling_end = int(times[-1]) + 1000000 // rate
+            return len(buffer)
+
+        def analogReadBlock(buffer, pins, rate=0, prescaler=128):
+            count = analogStartBlock(buffer, pins, rate, prescaler)
+            board.advance(board.sampling_end - board.time_us)
+            board.sampling_done = True
+            return count
+
+        def analogBlockDone():
+            if not board.sampling_done and board.time_us >= board.sampling_end:
+                board.sampling_done = True
+            return board.sampling_done
+
+        def millis():
+            board.spend('millis')
+            return board.time_us // 1000
+
+        def micros():
+            board.spend('micros')
+            return board.time_us
+
+        def delay(ms):
+            board.advance(ms * 1000)
+
+        def every(ms):
+            def task(func):
+                # function, period and next deadline in ms
+                board.tasks.append([func, ms, 0])
+                return func
+            return task
+
+        def handler(mode):
+            def decorator(pin, debounce=0):
+                def register(func):
+                    # pin, edge, function, debounce time in ms and
+                    # the debounce state, see Board.run_debounced
+                    pin_number = board.pin(pin)
+                    board.handlers.append([pin_number, mode, func, debounce,
+                        board.level(pin_number), None])
+                    return func
+                return register
+            return decorator
+
+        class Sleep:
+            def __init__(self, ms):
+                self.ms = ms
+
+            def __await__(self):
+                yield ('sleep', self.ms)
+
+        class Until:
+            def __init__(self, condition):
+                self.condition = condition
+
+            def __await__(self):
+                # a function checking the condition, see ConditionWrapper
+                yield ('until', self.condition)
+
+        for func in (pinMode, digitalWrite, digitalRead, analogRead,
+                    analogWrite, analogBuffer, analogStartBlock,
+                    analogReadBlock, analogBlockDone, millis, micros, delay,
+                    every):
+            namespace[func.__name__] = func
+        namespace['on_change'] = handler('CHANGE')
+        namespace['on_rising'] = handler('RISING')
+        namespace['on_falling'] = handler('FALLING')
+        namespace['sleep'] = Sleep
+        namespace['until'] = Until
+
+        return namespace
+
+class ConditionWrapper(ast.NodeTransformer):
+    '''await until(x > 3) becomes await until(lambda: x > 3), Python
+    would evaluate the condition only once but the generated state
+    machine checks it again on every poll'''
+
+    def visit_Await(self, node):
+        self.generic_visit(node)
+        call = node.value
+        if (isinstance(call, ast.Call) and isinstance(call.func, ast.Name)
+            and call.func.id == 'until' and len(call.args) == 1
+            and not isinstance(call.args[0], ast.Lambda)):
+            condition = ast.parse('lambda: 0', mode='eval').body
+            condition.body = call.args[0]
+            call.args[0] = ast.copy_location(condition, call.args[0])
+        return node
+
+class Coroutine:
+    '''Polls an async def function like the generated state machine'''
+
+    def __init__(self, func, board):
+        self.coroutine = func()
+        self.board = board
+        self.waiting = None
+        self.done = False
+
+    def ready(self):
+        if self.waiting is None:
+            return True
+        kind, value, since = self.waiting
+        if kind == 'sleep':
+            return self.board.time_us - since >= value * 1000
+        return bool(value())
+
+    def poll(self):
+        if self.done or not self.ready():
+            return
+        try:
+            kind, value = self.coroutine.send(None)
+            self.waiting = (kind, value, self.board.time_us)
+        except StopIteration:
+            self.done = True
+
+def elapsed_ms(now, deadline):
+    '''(long)(now - deadline) of two unsigned long millis() values'''
+    return (now - deadline + (1 << 31)) % (1 << 32) - (1 << 31)
+
+class Simulator:
+    '''Loads a sketch onto a simulated board and runs it'''
+
+    def __init__(self, source, params=None, **board_options):
+        self.board = Board(**board_options)
+        self.namespace = self.board.api()
+        self.millis = self.namespace['millis']
+        # with the prints merged as on the board, see peephole.py
+        parsed, _ = peephole.transform(ast.parse(source))
+        parsed = ast.fix_missing_locations(ConditionWrapper().visit(parsed))
+        exec(compile(parsed, '<sketch>', 'exec'), self.namespace)
+
+        # parameters replace module-level values of the sketch
+        self.namespace.update(params or {})
+
+        self.coroutines = [Coroutine(func, self.board)
+                            for func in self.namespace.values()
+                            if inspect.iscoroutinefunction(func)
+                            and getattr(func, '__module__', None) is None
+                            and func.__code__.co_filename == '<sketch>']
+        self.setup = self.namespace.get('setup')
+        self.loop = self.namespace.get('loop')
+        for func, period, due in self.board.tasks:
+            self.namespace[func.__name__ + '_overruns'] = 0
+
+    def start_tasks(self):
+        '''The end of setup(), see scheduler.start_code'''
+        for task in self.board.tasks:
+            task[2] = self.millis()
+
+    def dispatch_tasks(self):
+        '''The top of loop(), see scheduler.dispatch_code. a task that
+        falls behind runs once and its next deadline is a period away'''
+        for task in self.board.tasks:
+            func, period, due = task
+            if elapsed_ms(self.millis(), task[2]) >= 0:
+                func()
+                task[2] += period
+                if elapsed_ms(self.millis(), task[2]) >= 0:
+                    self.namespace[func.__name__ + '_overruns'] += 1
+                    task[2] = self.millis() + period
+
+    def iteration(self):
+        board = self.board
+        self.dispatch_tasks()
+        for coroutine in self.coroutines:
+            coroutine.poll()
+        if self.loop is not None:
+            self.loop()
+        board.spend('loop')
+        board.iterations += 1
+
+    def run(self, iterations=None, duration_ms=None):
+        '''Runs setup() and then loop() until the iterations are done,
+        the virtual time is up or, without either, the input traces end'''
+        board = self.board
+        end_us = None
+        if duration_ms is not None:
+            end_us = duration_ms * 1000
+        elif iterations is None:
+            end_us = board.inputs_end_us()
+            if end_us is None:
+                raise SimulationError('give a number of iterations '
+                    'or a duration without input traces')
+
+        if self.setup is not None:
+            self.setup()
+        self.start_tasks()
+
+        while ((iterations is None or board.iterations < iterations)
+            and (end_us is None or board.time_us < end_us)):
+            self.iteration()
+
+        return Recording(board)
+
+def simulate(source, iterations=None, duration_ms=None, params=None,
+    **board_options):
+    '''Runs a sketch once and returns its recording'''
+    simulator = Simulator(source, params, **board_options)
+    return simulator.run(iterations, duration_ms)
+
+def run_job(job):
+    source, iterations, duration_ms, options = job
+    options = dict(options)
+    params = options.pop('params', None)
+    return simulate(source, iterations, duration_ms, params, **options)
+
+def simulate_many(source, jobs, iterations=None, duration_ms=None,
+    processes=None):
+    '''Runs a sketch against many sets of inputs and parameters
+    (each a dict of simulate() keyword arguments) in parallel processes
+    and returns the recordings in the same order'''
+    work = [(source, iterations, duration_ms, job) for job in jobs]
+    with ProcessPoolExecutor(processes or os.cpu_count()) as executor:
+        return list(executor.map(run_job, work))
@@ -0,0 +1,104 @@
+import glob, os, random, sys, time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from warnings import simplefilter
+
+import compiler
+from benchmark import SketchGenerator
+
+# checks that translations running on many threads at once don't
+# interfere with each other: thousands of generated sketches (and the
+# samples) are translated one after another, then all at once on a
+# thread pool in a shuffled order, and every output has to match.
+# threads get switched very often meanwhile to mix the translations up.
+#
+#   python stresstest.py -n 2000 -t 16
+
+DEFAULT_SKETCHES = 1000
+DEFAULT_THREADS = 8
+SWITCH_INTERVAL = 1e-6
+
+SAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'samples')
+
+def jobs(count, seed=0):
+    '''(name, code, board, fixed point format) to translate'''
+    rng = random.Random(seed)
+    samples = [(os.path.basename(path), open(path).read())
+                for path in sorted(glob.glob(os.path.join(SAMPLES_PATH, '*.py')))]
+
+    result = []
+    for n in range(count):
+        # the samples use pins, strings and floats,
+        # whose code depends on the board and the options
+        if n % 2 == 0:
+            name, code = samples[n // 2 % len(samples)]
+        else:
+            name = 'sketch{}'.format(n)
+            code = SketchGenerator(functions=rng.randint(1, 8),
+                statements=rng.randint(1, 10), depth=rng.randint(1, 3),
+                call_density=rng.random(), seed=n).sketch()
+        result.append((name, code, rng.choice([None, 'uno', 'due']),
+            rng.choice([None, None, 'Q16.16'])))
+    return result
+
+def translate_job(job, translator=None):
+    '''The translated code or the error, which has to be the same too'''
+    name, code, board, fixed_point = job
+    translator = translator or compiler.Translator()
+    try:
+        return translator.translate(code, board=board,
+            fixed_point=fixed_point)['code']
+    except Exception as error:
+        return '{}: {}'.format(type(error).__name__, error)
+
+def run(count=DEFAULT_SKETCHES, threads=DEFAULT_THREADS, seed=0):
+    '''Returns the jobs whose concurrent translation differed
+    and the seconds both runs took'''
+    todo = jobs(count, seed)
+
+    # one translator for all, it has to start afresh every time
+    start = time.perf_counter()
+    translator = compiler.Translator()
+    sequential = [translate_job(job, translator) for job in todo]
+    sequential_time = time.perf_counter() - start
+
+    order = list(range(len(todo)))
+    random.Random(seed).shuffle(order)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(SWITCH_INTERVAL)
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            outputs = executor.map(translate_job, [todo[n] for n in order])
+            concurrent = dict(zip(order, outputs))
+        concurrent_time = time.perf_counter() - start
+    finally:
+        sys.setswitchinterval(interval)
+
+    differing = [todo[n] for n in range(len(todo))
+                if concurrent[n] != sequential[n]]
+    return differing, sequential_time, concurrent_time
+
+if __name__ == '__main__':
+    argp = ArgumentParser(description='translates sketches concurrently '
+        'and checks the outputs against sequential translations')
+    argp.add_argument('-n', '--sketches', type=int, default=DEFAULT_SKETCHES)
+    argp.add_argument('-t', '--threads', type=int, default=DEFAULT_THREADS)
+    argp.add_argument('--seed', type=int, default=0)
+    args = argp.parse_args()
+
+    # the translator warns about things like missing annotations
+    simplefilter('ignore')
+
+    differing, sequential_time, concurrent_time = run(args.sketches,
+        args.threads, args.seed)
+    print('{} sketches on {} threads: sequential {:.2f} s, concurrent '
+        '{:.2f} s'.format(args.sketches, args.threads, sequential_time,
+            concurrent_time))
+    for name, code, board, fixed_point in differing:
+        print('differs: {} (board {}, fixed point {})'.format(name, board,
+            fixed_point))
+    print('{} of {} outputs identical'.format(args.sketches - len(differing),
+        args.sketches))
+    sys.exit(1 if differing else 0)
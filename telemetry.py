@@ -0,0 +1,177 @@
+import ast, json
+
+import compiler, fixedpoint
+
+# Serial.send(a, b, ...) sends its arguments as one binary frame
+# instead of formatting them as text:
+#
+#   0xA5 0x5A | schema | payload length | payload | checksum
+#
+# the payload is the packed little-endian values, laid out by a schema
+# worked out from the argument types at compile time. every distinct
+# call gets its own schema number, the schemas are saved next to the
+# sketch for the host decoder in frames.py. the checksum is the sum of
+# the schema, length and payload bytes modulo 256.
+
+SYNC = (0xA5, 0x5A)
+HEADER_SIZE = 4
+CHECKSUM_SIZE = 1
+MAX_PAYLOAD = 255
+
+FRAME_PRELUDE = '''// binary telemetry frames: 0xA5 0x5A, schema, payload length, payload, checksum
+void _send_frame(uint8_t schema, const uint8_t *payload, uint8_t length) {{
+    uint8_t checksum = schema + length;
+    for (uint8_t i = 0; i < length; i++) checksum += payload[i];
+    Serial.write((uint8_t){sync0});
+    Serial.write((uint8_t){sync1});
+    Serial.write(schema);
+    Serial.write(length);
+    Serial.write(payload, length);
+    Serial.write(checksum);
+}}
+'''
+SEND_FUNC = '''void _send_{id}({args}) {{
+    uint8_t payload[{size}];
+{packing}    _send_frame({id}, payload, {size});
+}}
+'''
+PACK = '    memcpy(payload + {offset}, &v{n}, {size});\n'
+SEND_CALL = '_send_{id}({args})'
+
+# the type every translator type is sent as
+wire_types = {
+    'avr': {'boolean': 'uint8_t', 'char': 'uint8_t', 'uint8_t': 'uint8_t',
+            'int': 'int16_t', 'unsigned int': 'uint16_t', 'uint16_t': 'uint16_t',
+            'long': 'int32_t', 'unsigned long': 'uint32_t',
+            'float': 'float', 'double': 'float'},
+    'sam': {'boolean': 'uint8_t', 'char': 'uint8_t', 'uint8_t': 'uint8_t',
+            'int': 'int32_t', 'unsigned int': 'uint32_t', 'uint16_t': 'uint16_t',
+            'long': 'int32_t', 'unsigned long': 'uint32_t',
+            'float': 'float', 'double': 'double'}
+}
+
+# NumPy dtypes of the wire types
+dtypes = {
+    'uint8_t': 'u1',
+    'int16_t': '<i2',
+    'uint16_t': '<u2',
+    'int32_t': '<i4',
+    'uint32_t': '<u4',
+    'float': '<f4',
+    'double': '<f8'
+}
+
+def arg_type(node, result):
+    '''The translator type of a Serial.send argument'''
+    if isinstance(node, ast.Str):
+        raise compiler.UnsupportedSyntaxError(
+            'Serial.send only sends numbers, use Serial.print for text',
+            node.lineno)
+    if isinstance(node, ast.NameConstant):
+        return 'boolean'
+    if isinstance(node, ast.Num):
+        return compiler.get_arduino_type(node.n)
+    if isinstance(node, ast.Name):
+        var_type = compiler.get_variable_type(node, result)
+    elif isinstance(node, ast.BinOp):
+        var_type = compiler.get_binop_type(node, result)
+    elif isinstance(node, ast.UnaryOp):
+        var_type = compiler.get_unaryop_type(node, result)
+    elif isinstance(node, ast.Subscript):
+        var_type = compiler.get_subscript_type(node, result)
+    elif isinstance(node, ast.Call):
+        var_type = result['funcs'].get(compiler.get_func_name(node.func, result),
+            'int')
+    elif isinstance(node, (ast.Compare, ast.BoolOp)):
+        var_type = 'boolean'
+    else:
+        var_type = 'int'
+    return var_type.replace('volatile ', '')
+
+def field_name(node, n, taken):
+    if isinstance(node, ast.Name):
+        name = node.id
+    elif isinstance(node, ast.Attribute):
+        name = node.attr
+    elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        name = node.func.id
+    else:
+        name = 'f{}'.format(n)
+
+    while name in taken:
+        name += '_'
+    return name
+
+def wire_type(var_type, arch, fixed_point, lineno):
+    if var_type == 'fixed_t':
+        int_bits, frac_bits = fixedpoint.parse_format(fixed_point)
+        return 'int{}_t'.format(int_bits + frac_bits)
+    if var_type not in wire_types[arch]:
+        raise compiler.UnsupportedSyntaxError(
+            'values of type {} cannot be sent'.format(var_type), lineno)
+    return wire_types[arch][var_type]
+
+def send_code(call, args_codes, result, schemas, arch, fixed_point):
+    '''Returns the code for a Serial.send call and adds
+    its schema to the schemas if it's a new one'''
+    if call.keywords or not call.args:
+        raise compiler.UnsupportedSyntaxError(
+            'Serial.send takes the values to send', call.lineno)
+
+    fields = []
+    for n, arg in enumerate(call.args):
+        var_type = arg_type(arg, result)
+        name = field_name(arg, n, [field[0] for field in fields])
+        fields.append((name, wire_type(var_type, arch, fixed_point,
+            call.lineno)))
+
+    if sum(wire_size(field[1]) for field in fields) > MAX_PAYLOAD:
+        raise compiler.UnsupportedSyntaxError(
+            'a frame carries at most {} bytes'.format(MAX_PAYLOAD), call.lineno)
+
+    for schema in schemas:
+        if schema['fields'] == fields:
+            break
+    else:
+        if len(schemas) > 0xFF:
+            raise compiler.UnsupportedSyntaxError(
+                'at most 256 different Serial.send calls are supported',
+                call.lineno)
+        schema = {'id': len(schemas), 'fields': fields, 'line': call.lineno}
+        if fixed_point is not None:
+            schema['fixed_point'] = fixed_point
+        schemas.append(schema)
+
+    return SEND_CALL.format(id=schema['id'], args=', '.join(args_codes))
+
+def wire_size(c_type):
+    '''Size of a wire type in bytes'''
+    return int(dtypes[c_type][-1])
+
+def prelude(schemas):
+    '''The frame sender and a packing function for every schema'''
+    code = FRAME_PRELUDE.format(sync0=hex(SYNC[0]), sync1=hex(SYNC[1]))
+
+    for schema in schemas:
+        args = []
+        packing = ''
+        offset = 0
+        for n, (name, c_type) in enumerate(schema['fields']):
+            size = wire_size(c_type)
+            args.append('{} v{}'.format(c_type, n))
+            packing += PACK.format(offset=offset, n=n, size=size)
+            offset += size
+
+        code += '\n' + SEND_FUNC.format(id=schema['id'], args=', '.join(args),
+            size=offset, packing=packing)
+
+    return code
+
+def schema_json(schemas):
+    '''The schemas as saved next to the sketch for frames.py'''
+    return json.dumps({
+        'sync': list(SYNC),
+        'schemas': [dict(schema, fields=[[name, dtypes[c_type]]
+                                for name, c_type in schema['fields']])
+                    for schema in schemas]
+    }, indent=2)
@@ -0,0 +1,183 @@
+import io, json, os, sys, time
+
+import pytest
+
+import fleet
+
+# uploads to pseudo-terminals with a fake uploader command. the fake
+# writes the image to the port, logs when it ran and can be told per
+# port (by a file next to the log) to fail a number of times or hang
+
+FAKE_UPLOADER = '''#!{python}
+import json, os, sys, time
+
+port, image, log = sys.argv[1:4]
+start = time.time()
+behaviour = os.path.join(os.path.dirname(log),
+    os.path.basename(port) + '.behaviour')
+failures = 0
+if os.path.exists(behaviour):
+    kind, count = open(behaviour).read().split()
+    if kind == 'hang':
+        time.sleep(60)
+    failures = int(count)
+
+attempt_file = behaviour + '.attempts'
+attempts = int(open(attempt_file).read()) + 1 if os.path.exists(attempt_file) else 1
+open(attempt_file, 'w').write(str(attempts))
+
+print('writing {{}} to {{}}'.format(image, port))
+time.sleep({duration})
+status = 1 if attempts <= failures else 0
+if status == 0:
+    with open(port, 'wb', buffering=0) as tty:
+        tty.write(open(image, 'rb').read())
+with open(log, 'a') as log_file:
+    log_file.write(json.dumps([port, start, time.time(), status]) + '\\n')
+sys.exit(status)
+'''
+
+@pytest.fixture
+def rack(tmp_path, monkeypatch):
+    '''Pty ports, an image and the fake uploader command'''
+    # no need to wait between the attempts here
+    monkeypatch.setattr(fleet, 'RETRY_DELAY', 0.01)
+
+    image = tmp_path / 'sketch.hex'
+    image.write_bytes(b':00000001FF\n')
+    log = tmp_path / 'uploads.log'
+
+    ptys = []
+
+    def ports(count):
+        for n in range(count):
+            master, slave = os.openpty()
+            ptys.append((master, slave))
+            # named links, so that they can be globbed
+            link = tmp_path / 'ttyFAKE{}'.format(n)
+            link.symlink_to(os.ttyname(slave))
+        return [str(tmp_path / 'ttyFAKE{}'.format(n)) for n in range(count)]
+
+    def command(duration=0.2):
+        script = tmp_path / 'fake-upload'
+        script.write_text(FAKE_UPLOADER.format(python=sys.executable,
+            duration=duration))
+        script.chmod(0o755)
+        return '{} {{port}} {{image}} {}'.format(script, log)
+
+    def behave(port, kind, count=0):
+        (tmp_path / (os.path.basename(port) + '.behaviour')).write_text(
+            '{} {}'.format(kind, count))
+
+    def uploads():
+        if not log.exists():
+            return []
+        return [json.loads(line) for line in log.read_text().splitlines()]
+
+    def received(n):
+        '''What the fake wrote to the nth port'''
+        master = ptys[n][0]
+        os.set_blocking(master, False)
+        try:
+            return os.read(master, 1024)
+        except BlockingIOError:
+            return b''
+
+    rack = type('Rack', (), {})()
+    rack.image, rack.ports, rack.command = str(image), ports, command
+    rack.behave, rack.uploads, rack.received = behave, uploads, received
+    yield rack
+
+    for master, slave in ptys:
+        os.close(master)
+        os.close(slave)
+
+def most_at_once(uploads):
+    '''The most uploads running at the same time'''
+    events = sorted([(start, 1) for port, start, end, status in uploads]
+                    + [(end, -1) for port, start, end, status in uploads])
+    running = most = 0
+    for when, change in events:
+        running += change
+        most = max(most, running)
+    return most
+
+def test_expand_ports_globs_and_lists(rack, tmp_path):
+    ports = rack.ports(3)
+    assert fleet.expand_ports(str(tmp_path / 'ttyFAKE*')) == ports
+    assert fleet.expand_ports([ports[1] + ',' + ports[0], ports[1]]) == [
+        ports[1], ports[0]]
+    with pytest.raises(fleet.FleetError):
+        fleet.expand_ports(str(tmp_path / 'ttyNONE*'))
+
+def test_uploads_image_to_every_port(rack, tmp_path):
+    ports = rack.ports(4)
+    results = fleet.upload_fleet(rack.image, str(tmp_path / 'ttyFAKE*'),
+        command=rack.command(), stream=io.StringIO())
+
+    assert [result['port'] for result in results] == ports
+    assert all(result['status'] == 'ok' for result in results)
+    assert all(result['attempts'] == 1 for result in results)
+    for n in range(len(ports)):
+        assert rack.received(n).replace(b'\r', b'') == b':00000001FF\n'
+
+def test_concurrency_limit(rack):
+    ports = rack.ports(6)
+    results = fleet.upload_fleet(rack.image, ports, command=rack.command(0.3),
+        concurrency=2, stream=io.StringIO())
+
+    assert all(result['status'] == 'ok' for result in results)
+    uploads = rack.uploads()
+    assert len(uploads) == 6
+    assert most_at_once(uploads) == 2
+
+def test_failed_uploads_are_retried(rack):
+    ports = rack.ports(3)
+    rack.behave(ports[0], 'fail', 1)
+    rack.behave(ports[1], 'fail', 5)
+    stream = io.StringIO()
+    results = fleet.upload_fleet(rack.image, ports, command=rack.command(0.05),
+        retries=2, stream=stream)
+
+    assert [(result['status'], result['attempts']) for result in results] == [
+        ('ok', 2), ('failed (1)', 3), ('ok', 1)]
+    # the uploader's output is kept for the summary
+    assert 'writing' in results[1]['output']
+    assert 'trying again' in stream.getvalue()
+    assert '2 of 3 uploads succeeded' in fleet.format_table(results)
+
+def test_hung_uploads_time_out(rack):
+    ports = rack.ports(2)
+    rack.behave(ports[0], 'hang')
+    start = time.perf_counter()
+    results = fleet.upload_fleet(rack.image, ports, command=rack.command(0.05),
+        retries=1, timeout=0.5, stream=io.StringIO())
+
+    assert [(result['status'], result['attempts']) for result in results] == [
+        ('timed out', 2), ('ok', 1)]
+    # killed rather than waited for
+    assert time.perf_counter() - start < 10
+
+def test_missing_uploader_fails_the_port(rack, tmp_path):
+    ports = rack.ports(1)
+    results = fleet.upload_fleet(rack.image, ports,
+        command='{} {{port}} {{image}}'.format(tmp_path / 'no-such-uploader'),
+        retries=0, stream=io.StringIO())
+    assert results[0]['status'] == 'failed (-1)'
+
+def test_missing_image_raises(rack, tmp_path):
+    with pytest.raises(fleet.FleetError):
+        fleet.upload_fleet(str(tmp_path / 'none.hex'), rack.ports(1),
+            command=rack.command())
+
+def test_waiting_to_retry_frees_the_slot(rack, monkeypatch):
+    ports = rack.ports(2)
+    rack.behave(ports[0], 'fail', 1)
+    monkeypatch.setattr(fleet, 'RETRY_DELAY', 1.0)
+    results = fleet.upload_fleet(rack.image, ports, command=rack.command(0.05),
+        concurrency=1, retries=1, stream=io.StringIO())
+
+    assert [result['status'] for result in results] == ['ok', 'ok']
+    # the second port goes while the first one waits to try again
+    order = [port for port, start, end, status in rack.uploads()]
+    assert order == [ports[0], ports[1], ports[0]]
@@ -0,0 +1,164 @@
+import json, os, sys
+
+import pytest
+
+import toolchain
+
+# builds against a stand-in compiler script passed through tools=,
+# which logs every call, creates the outputs it's asked for and fails
+# like a compiler would on a missing include or an #error
+
+FAKE_COMPILER = '''#!{python}
+import json, os, sys
+
+args = sys.argv[1:]
+with open({log!r}, 'a') as log:
+    log.write(json.dumps(args) + '\\n')
+
+if args == ['--version']:
+    print(open({version!r}).read())
+    sys.exit(0)
+
+if '-c' in args:
+    source = args[args.index('-c') + 1]
+    text = open(source).read()
+    if '#error' in text:
+        print('{{}}: #error'.format(source))
+        sys.exit(1)
+    for line in text.splitlines():
+        if line.startswith('#include "'):
+            header = os.path.join(os.path.dirname(source), line.split('"')[1])
+            if not os.path.exists(header):
+                print('{{}}: no {{}}'.format(source, header))
+                sys.exit(1)
+
+# -o for the compiler and linker, the archive for ar rcs,
+# the image last for objcopy
+if '-o' in args:
+    output = args[args.index('-o') + 1]
+elif args[0] == 'rcs':
+    output = args[1]
+else:
+    output = args[-1]
+open(output, 'w').close()
+'''
+
+@pytest.fixture
+def fake(tmp_path):
+    '''A hardware directory with a tiny core and the stand-in compiler'''
+    core = tmp_path / 'hardware' / 'arduino' / 'avr' / 'cores' / 'arduino'
+    variant = tmp_path / 'hardware' / 'arduino' / 'avr' / 'variants' / 'standard'
+    core.mkdir(parents=True)
+    variant.mkdir(parents=True)
+    (core / 'wiring.c').write_text('void init() {}\n')
+    (core / 'main.cpp').write_text('int main() { return 0; }\n')
+    (variant / 'pins_arduino.h').write_text('\n')
+
+    log = tmp_path / 'calls.log'
+    version = tmp_path / 'version'
+    version.write_text('fake-gcc 1.0')
+    script = tmp_path / 'fake-cc'
+    script.write_text(FAKE_COMPILER.format(python=sys.executable,
+        log=str(log), version=str(version)))
+    script.chmod(0o755)
+    tool = str(script)
+
+    def make():
+        return toolchain.Toolchain('uno',
+            hardware_path=str(tmp_path / 'hardware'), toolchain_path='',
+            cache_path=str(tmp_path / 'cache'),
+            tools={'cc': tool, 'cxx': tool, 'ar': tool, 'objcopy': tool})
+
+    def calls():
+        if not log.exists():
+            return []
+        calls = [json.loads(line) for line in log.read_text().splitlines()]
+        log.write_text('')
+        return calls
+
+    make.calls = calls
+    make.version = version
+    return make
+
+def compiled(calls):
+    '''The sources compiled by the logged calls'''
+    return sorted(os.path.basename(call[call.index('-c') + 1])
+                    for call in calls if '-c' in call)
+
+def test_first_build_compiles_core_and_sketch(fake):
+    result = fake().build('void setup() {}\nvoid loop() {}\n', 'blink')
+    assert result['core_built'] and result['sketch_built']
+    assert os.path.exists(result['image'])
+    assert result['image'].endswith('blink.hex')
+    assert compiled(fake.calls()) == ['blink.cpp', 'main.cpp', 'wiring.c']
+
+def test_unchanged_sketch_only_links(fake):
+    code = 'void setup() {}\nvoid loop() {}\n'
+    fake().build(code, 'blink')
+    fake.calls()
+
+    result = fake().build(code, 'blink')
+    assert not result['core_built'] and not result['sketch_built']
+    calls = fake.calls()
+    assert compiled(calls) == []
+    # linked and converted all the same
+    assert any('-o' in call and call[call.index('-o') + 1] == result['elf']
+                for call in calls)
+    assert calls[-1][-1] == result['image']
+
+def test_changed_sketch_reuses_core(fake):
+    fake().build('void setup() {}\nvoid loop() {}\n', 'blink')
+    fake.calls()
+
+    result = fake().build('int x;\nvoid setup() {}\nvoid loop() {}\n', 'blink')
+    assert not result['core_built'] and result['sketch_built']
+    assert compiled(fake.calls()) == ['blink.cpp']
+    # only the object of the current code is kept
+    objects = [name for name in os.listdir(os.path.dirname(result['image']))
+                if name.endswith('.o')]
+    assert len(objects) == 1
+
+def test_new_compiler_version_rebuilds_core(fake):
+    code = 'void setup() {}\nvoid loop() {}\n'
+    first = fake().build(code, 'blink')
+    fake.version.write_text('fake-gcc 2.0')
+    fake.calls()
+
+    second = fake().build(code, 'blink')
+    assert second['core_built'] and second['sketch_built']
+    assert os.path.dirname(first['image']) != os.path.dirname(second['image'])
+
+def test_changed_core_source_rebuilds_core(fake, tmp_path):
+    code = 'void setup() {}\nvoid loop() {}\n'
+    fake().build(code, 'blink')
+    wiring = tmp_path / 'hardware' / 'arduino' / 'avr' / 'cores' / 'arduino' / 'wiring.c'
+    wiring.write_text('void init() { /* changed */ }\n')
+
+    assert fake().build(code, 'blink')['core_built']
+
+def test_headers_are_written_next_to_the_sketch(fake):
+    code = '#include "helper.hpp"\nvoid setup() {}\nvoid loop() {}\n'
+    with pytest.raises(toolchain.ToolchainError):
+        fake().build(code, 'main')
+
+    result = fake().build(code, 'main', {'helper.hpp': 'int helper;\n'})
+    assert result['sketch_built']
+    header = os.path.join(os.path.dirname(result['image']), 'helper.hpp')
+    assert open(header).read() == 'int helper;\n'
+
+    # a changed header is a changed build, even with the same code
+    result = fake().build(code, 'main', {'helper.hpp': 'long helper;\n'})
+    assert result['sketch_built']
+
+def test_compiler_errors_raise(fake):
+    with pytest.raises(toolchain.ToolchainError) as error:
+        fake().build('#error broken\n', 'broken')
+    assert '#error' in str(error.value)
+
+def test_missing_compiler_raises(fake, tmp_path):
+    missing = toolchain.Toolchain('uno',
+        hardware_path=str(tmp_path / 'hardware'),
+        cache_path=str(tmp_path / 'cache'),
+        tools={'cxx': str(tmp_path / 'no-such-cc')})
+    with pytest.raises(toolchain.ToolchainError):
+        missing.build('void setup() {}\nvoid loop() {}\n', 'blink')
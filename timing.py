@@ -0,0 +1,367 @@
+import ast
+
+import boardinfo, fixedpoint, peephole, portio, sampling, scheduler, telemetry
+
+# static best/worst case cycle count of the translated program.
+# every operation gets a per-board cost from cycles.json,
+# loops without a known bound and recursion make the worst case unbounded
+
+UNBOUNDED = float('inf')
+
+SERIAL_PRINTS = ('Serial.print', 'Serial.println', 'Serial.write')
+
+# default baudrate if Serial.begin isn't called with a constant
+DEFAULT_BAUDRATE = 9600
+
+operators = {
+    ast.Add: 'add',
+    ast.Sub: 'sub',
+    ast.Mult: 'mul',
+    ast.Div: 'div',
+    ast.Mod: 'mod',
+    ast.Pow: 'pow'
+}
+
+REPORT_HEADER = '''Timing estimate for {board} ({mhz:g} MHz)
+  {function:<20} {best:>14} {worst:>14} {best_us:>12} {worst_us:>12}'''
+REPORT_LINE = '  {function:<20} {best:>14} {worst:>14} {best_us:>12} {worst_us:>12}'
+REPORT_LOOP = 'loop() iteration: best {best} us, worst {worst} us'
+REPORT_HOT_SPOT = '  line {line} in {function}: {message} ({cycles} cycles)'
+
+def add(*costs):
+    return (sum(cost[0] for cost in costs), sum(cost[1] for cost in costs))
+
+def get_call_name(call):
+    if isinstance(call.func, ast.Name):
+        return call.func.id
+    if (isinstance(call.func, ast.Attribute)
+        and isinstance(call.func.value, ast.Name)):
+        return '{}.{}'.format(call.func.value.id, call.func.attr)
+    return None
+
+def get_baudrate(parsed):
+    for node in ast.walk(parsed):
+        if (isinstance(node, ast.Call)
+            and get_call_name(node) == 'Serial.begin'
+            and node.args and isinstance(node.args[0], ast.Num)):
+            return node.args[0].n
+    return DEFAULT_BAUDRATE
+
+class Analysis:
+    '''Keeps the state of one timing analysis: the costs,
+    the translation result for types and the costs found so far'''
+
+    def __init__(self, parsed, result, board, costs):
+        self.result = result
+        self.costs = costs
+        self.pinmap = portio.load_pinmap(board)
+        self.constants = portio.find_constants(parsed)
+        self.func_objs = dict((node.name, node) for node in parsed.body
+                            if isinstance(node, ast.FunctionDef))
+        self.func_costs = {}
+        self.hot_spots = []
+        self.stack = []
+
+        # cycles to send one character once the transmit buffer is full
+        self.char_wire = costs['clock'] * 10 // get_baudrate(parsed)
+
+    def flag(self, node, message, cycles):
+        spot = (node.lineno, self.stack[-1], message, cycles)
+        if spot not in self.hot_spots:
+            self.hot_spots.append(spot)
+
+    def var_type(self, name):
+        scope = self.result['variables'].get(self.stack[-1], {})
+        if name in scope:
+            return scope[name]
+        var_type = self.result['variables']['global'].get(name, 'int')
+        # globals shared with interrupt handlers
+        return var_type.replace('volatile ', '')
+
+    def expr_type(self, node):
+        if isinstance(node, ast.Num):
+            return 'float' if type(node.n) is float else 'int'
+        if isinstance(node, ast.Name):
+            return self.var_type(node.id)
+        if isinstance(node, ast.BinOp):
+            # division always results in a float, as in get_binop_type
+            if isinstance(node.op, ast.Div):
+                return 'float'
+            if 'float' in (self.expr_type(node.left),
+                            self.expr_type(node.right)):
+                return 'float'
+            return 'int'
+        if isinstance(node, ast.UnaryOp):
+            return self.expr_type(node.operand)
+        if isinstance(node, ast.Call):
+            return self.result['funcs'].get(get_call_name(node), 'int')
+        if isinstance(node, (ast.Compare, ast.BoolOp)):
+            return 'boolean'
+        return 'int'
+
+    def op_cost(self, node, op, op_type, operand_types=()):
+        arith = 'float' if op_type == 'float' else 'int'
+        cycles = self.costs[arith][op]
+
+        # ints get converted before float operations
+        if arith == 'float':
+            cycles += self.costs['float']['convert'] * sum(
+                1 for operand in operand_types if operand != 'float')
+
+            if self.costs['soft_float'] and op in ('div', 'mod'):
+                self.flag(node, 'float division', cycles)
+            elif self.costs['soft_float'] and op != 'bool':
+                self.flag(node, 'software float ' + op, cycles)
+
+        return (cycles, cycles)
+
+    def expr(self, node):
+        if node is None:
+            return (0, 0)
+
+        if isinstance(node, ast.BinOp):
+            operand_types = (self.expr_type(node.left),
+                                self.expr_type(node.right))
+            return add(self.expr(node.left), self.expr(node.right),
+                self.op_cost(node, operators[type(node.op)],
+                    self.expr_type(node), operand_types))
+
+        if isinstance(node, ast.UnaryOp):
+            return add(self.expr(node.operand),
+                self.op_cost(node, 'unary', self.expr_type(node.operand)))
+
+        if isinstance(node, ast.Compare):
+            operand_types = [self.expr_type(node.left)] + [
+                self.expr_type(comparator) for comparator in node.comparators]
+            cmp_type = 'float' if 'float' in operand_types else 'int'
+            costs = [self.expr(node.left)]
+            costs += [self.expr(comparator) for comparator in node.comparators]
+            costs += [self.op_cost(node, 'cmp', cmp_type, operand_types)
+                        for op in node.ops]
+            return add(*costs)
+
+        if isinstance(node, ast.BoolOp):
+            # short-circuiting: at best only the first value is evaluated
+            values = [self.expr(value) for value in node.values]
+            bool_op = self.costs['int']['bool']
+            return (values[0][0] + bool_op,
+                    sum(value[1] for value in values)
+                    + bool_op * (len(values) - 1))
+
+        if isinstance(node, ast.Call):
+            return self.call(node)
+
+        return (0, 0)
+
+    def serial_print(self, node, name):
+        serial = self.costs['serial']
+        best = serial['call']
+        chars = 0
+
+        for arg in node.args[:1]:
+            if isinstance(arg, ast.Str):
+                chars = len(arg.s)
+                best += serial['char'] * chars
+            elif self.expr_type(arg) == 'float':
+                chars = 6
+                best += serial['float']
+                self.flag(node, 'float formatting', serial['float'])
+            else:
+                chars = 6
+                best += serial['int']
+
+        if name == 'Serial.println':
+            chars += 2
+            best += serial['newline']
+
+        # at worst the transmit buffer is full and every character
+        # has to wait for the wire
+        worst = best + chars * self.char_wire
+
+        return (best, worst)
+
+    def serial_send(self, node):
+        '''Serial.send writes a binary frame, no formatting involved'''
+        arch = self.pinmap['arch'] if self.pinmap is not None else 'avr'
+        arch_types = telemetry.wire_types[arch]
+        chars = telemetry.HEADER_SIZE + telemetry.CHECKSUM_SIZE + sum(
+            telemetry.wire_size(arch_types.get(self.expr_type(arg),
+                arch_types['int']))
+            for arg in node.args)
+
+        serial = self.costs['serial']
+        best = serial['call'] + serial['char'] * chars
+        return (best, best + chars * self.char_wire)
+
+    def call(self, node):
+        name = get_call_name(node)
+        args = add((0, 0), *[self.expr(arg) for arg in node.args])
+        call = self.costs['call']
+
+        if name in self.func_objs:
+            if name in self.stack:
+                self.flag(node, 'recursion', call)
+                return add(args, (call, UNBOUNDED))
+            return add(args, (call, call), self.function(name))
+
+        if name == 'delay':
+            if node.args and isinstance(node.args[0], ast.Num):
+                cycles = node.args[0].n * self.costs['clock'] // 1000
+                self.flag(node, 'blocking delay', cycles)
+                return add(args, (cycles, cycles))
+            self.flag(node, 'blocking delay of unknown length', UNBOUNDED)
+            return add(args, (0, UNBOUNDED))
+
+        if name == 'analogReadBlock':
+            cycles = sampling.block_cycles(node,
+                self.result['variables']['global'], self.costs['clock'])
+            if cycles is None:
+                self.flag(node, 'blocking block ADC read of unknown length',
+                    UNBOUNDED)
+                return add(args, (0, UNBOUNDED))
+            self.flag(node, 'blocking block ADC read', cycles)
+            return add(args, (cycles, cycles))
+
+        if name in SERIAL_PRINTS:
+            return add(args, self.serial_print(node, name))
+
+        if name == 'Serial.send':
+            return add(args, self.serial_send(node))
+
+        # fixed-point prints format with integer arithmetic,
+        # but wait for the wire like any other print
+        if name in fixedpoint.SERIAL_PRINTS.values():
+            cycles = self.costs['builtins'][name]
+            chars = 8 if name == 'fix_println' else 6
+            return add(args, (cycles, cycles + chars * self.char_wire))
+
+        # calls which get turned into port register access
+        direct_code = portio.direct_io(name, node.args,
+            ['x'] * len(node.args), self.pinmap, self.constants)
+        if direct_code is not None:
+            cycles = self.costs['port_io']
+            return add(args, (cycles, cycles))
+
+        cycles = self.costs['builtins'].get(name, call)
+        if name == 'analogRead':
+            self.flag(node, 'blocking ADC conversion', cycles)
+        return add(args, (cycles, cycles))
+
+    def body(self, statements):
+        return add((0, 0), *[self.statement(stmt) for stmt in statements])
+
+    def statement(self, node):
+        if isinstance(node, ast.Expr):
+            return self.expr(node.value)
+
+        if isinstance(node, ast.Assign):
+            assign = self.costs['assign']
+            return add(self.expr(node.value), (assign, assign))
+
+        if isinstance(node, ast.AugAssign):
+            # buf[i] += x and obj.attr += x as well as names
+            target_type = var_type = self.expr_type(node.target)
+            op = operators[type(node.op)]
+            # /= makes the variable a float
+            if op == 'div' or self.expr_type(node.value) == 'float':
+                target_type = 'float'
+            assign = self.costs['assign']
+            return add(self.expr(node.value),
+                self.op_cost(node, op, target_type,
+                    (var_type, self.expr_type(node.value))),
+                (assign, assign))
+
+        if isinstance(node, ast.If):
+            branch = self.costs['branch']
+            body = self.body(node.body)
+            orelse = self.body(node.orelse)
+            return add(self.expr(node.test), (branch, branch),
+                (min(body[0], orelse[0]), max(body[1], orelse[1])))
+
+        if isinstance(node, ast.While):
+            # the number of iterations is not known statically
+            self.flag(node, 'loop with no static bound', UNBOUNDED)
+            self.body(node.body)
+            return add(self.expr(node.test), (0, UNBOUNDED))
+
+        if isinstance(node, ast.Return):
+            return self.expr(node.value)
+
+        return (0, 0)
+
+    def function(self, name):
+        if name not in self.func_costs:
+            self.stack.append(name)
+            self.func_costs[name] = self.body(self.func_objs[name].body)
+            self.stack.pop()
+        return self.func_costs[name]
+
+def estimate(code, result, board='uno'):
+    '''Estimates the best and worst case number of cycles
+    of every function and of one loop() iteration'''
+    costs = boardinfo.load('cycles.json', board)
+    if costs is None:
+        raise ValueError('No cycle costs for board {}'.format(board))
+
+    parsed = ast.parse(code)
+    # the floats as the fixed-point helper calls they were translated to
+    if result.get('fixed_point') is not None:
+        parsed = fixedpoint.transform(parsed, result['fixed_point'])
+    # the prints as translated, see peephole.py
+    parsed, _ = peephole.transform(parsed)
+    analysis = Analysis(parsed, result, board, costs)
+
+    for name in analysis.func_objs:
+        analysis.function(name)
+
+    loop = analysis.func_costs.get('loop', (0, 0))
+    # main() calls loop() over and over
+    loop = add(loop, (costs['call'], costs['call']))
+
+    # the scheduler checks every @every task on each iteration,
+    # at worst all of them are due at once
+    check = (costs['builtins']['millis'] + costs['int']['cmp']
+                + costs['branch'])
+    for name, period in scheduler.find_tasks(parsed):
+        task = analysis.func_costs[name]
+        loop = add(loop, (check, check + costs['call'] + task[1]))
+
+    return {
+        'board': board,
+        'clock': costs['clock'],
+        'functions': analysis.func_costs,
+        'loop': loop,
+        'hot_spots': sorted(analysis.hot_spots, key=lambda spot: spot[0])
+    }
+
+def to_us(cycles, clock):
+    if cycles == UNBOUNDED:
+        return 'unbounded'
+    return '{:.1f}'.format(cycles * 1e6 / clock)
+
+def format_cycles(cycles):
+    if cycles == UNBOUNDED:
+        return 'unbounded'
+    return str(cycles)
+
+def format_report(report):
+    clock = report['clock']
+    lines = [REPORT_HEADER.format(board=report['board'], mhz=clock / 1e6,
+        function='function', best='best (cycles)', worst='worst (cycles)',
+        best_us='best (us)', worst_us='worst (us)')]
+
+    for name, (best, worst) in sorted(report['functions'].items()):
+        lines.append(REPORT_LINE.format(function=name,
+            best=format_cycles(best), worst=format_cycles(worst),
+            best_us=to_us(best, clock), worst_us=to_us(worst, clock)))
+
+    lines.append(REPORT_LOOP.format(best=to_us(report['loop'][0], clock),
+        worst=to_us(report['loop'][1], clock)))
+
+    if report['hot_spots']:
+        lines.append('hot spots:')
+        for line, function, message, cycles in report['hot_spots']:
+            lines.append(REPORT_HOT_SPOT.format(line=line, function=function,
+                message=message, cycles=format_cycles(cycles)))
+
+    return '\n'.join(lines)
@@ -0,0 +1,219 @@
+import hashlib, json, os, subprocess, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import boardinfo, config
+
+# builds sketches by calling the compiler directly instead of going
+# through the Arduino IDE, which starts a JVM and rebuilds the core
+# on every verify. the core is compiled once into an archive kept in
+# a cache keyed by the board, the compiler version, the flags and the
+# core sources, so after the first build only the sketch itself is
+# compiled (and only when its code changed) before linking.
+#
+# the commands and flags per board are in toolchains.json, {core},
+# {variant} and {system} in them stand for the directories under
+# config.arduino_hardware_path. any command can be swapped out,
+# e.g. for a stand-in script when testing:
+#
+#   Toolchain('uno', tools={'cxx': './fake-cc', 'cc': './fake-cc'})
+
+SOURCE_EXTENSIONS = ('.c', '.cpp', '.S')
+LIBS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libs')
+
+SKETCH = '''#include <Arduino.h>
+{code}'''
+
+class ToolchainError(Exception):
+    pass
+
+def run_command(args):
+    '''Runs a build command, raising ToolchainError with its output if it fails'''
+    try:
+        process = subprocess.run(args, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True)
+    except OSError as error:
+        raise ToolchainError('{}: {}'.format(args[0], error))
+    if process.returncode != 0:
+        raise ToolchainError('{}\n{}'.format(' '.join(args), process.stdout))
+    return process.stdout
+
+def write_if_changed(path, text):
+    '''Writes a file unless it already holds the text, returns whether
+    it was written. An unchanged file keeps its modification time, so
+    builds depending on it stay incremental, and a changed one is
+    replaced at once, nothing ever reads it half-written.'''
+    data = text.encode('utf-8')
+    try:
+        with open(path, 'rb') as existing:
+            if existing.read() == data:
+                return False
+    except OSError:
+        pass
+
+    # next to the file, so the rename can't cross file systems
+    temp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return True
+
+class Toolchain:
+    '''The compiler, core and build cache of a board'''
+
+    def __init__(self, board, hardware_path=None, toolchain_path=None,
+        cache_path=None, tools=None, jobs=None):
+        self.board = boardinfo.short_name(board)
+        self.settings = boardinfo.load('toolchains.json', self.board)
+        if self.settings is None:
+            raise ToolchainError('No toolchain settings for board {}'.format(board))
+
+        self.hardware_path = os.path.expanduser(hardware_path
+            or config.arduino_hardware_path)
+        self.toolchain_path = os.path.expanduser(toolchain_path
+            if toolchain_path is not None else config.toolchain_path)
+        self.cache_path = os.path.expanduser(cache_path or config.build_cache_path)
+        self.tools = tools or {}
+        self.jobs = jobs or os.cpu_count()
+        self._version = None
+
+        self.dirs = dict((name, os.path.join(self.hardware_path,
+                            self.settings[name]))
+                        for name in ('core', 'variant', 'system')
+                        if name in self.settings)
+
+    def tool(self, name):
+        if name in self.tools:
+            return self.tools[name]
+        return os.path.join(self.toolchain_path, self.settings[name])
+
+    def expand(self, args):
+        return [arg.format(**self.dirs) for arg in args]
+
+    def flags(self, kind):
+        return self.expand(self.settings['flags'] + self.settings[kind])
+
+    def includes(self):
+        return ['-I' + self.dirs['core'], '-I' + self.dirs['variant'],
+                '-I' + LIBS_PATH]
+
+    def version(self):
+        '''First line of the compiler's --version, part of the cache key'''
+        if self._version is None:
+            output = run_command([self.tool('cxx'), '--version'])
+            self._version = (output.splitlines() or [''])[0].strip()
+        return self._version
+
+    def core_sources(self):
+        sources = []
+        for name in ('core', 'variant'):
+            for root, dirs, files in os.walk(self.dirs[name]):
+                dirs.sort()
+                sources += [os.path.join(root, filename)
+                            for filename in sorted(files)
+                            if filename.endswith(SOURCE_EXTENSIONS)]
+        return sources
+
+    def core_key(self, sources):
+        '''Changes whenever the core has to be rebuilt'''
+        stamps = []
+        for source in sources:
+            stat = os.stat(source)
+            stamps.append([source, stat.st_size, stat.st_mtime_ns])
+        key = json.dumps([self.board, self.version(), self.settings, stamps])
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def compile(self, source, obj):
+        if source.endswith('.c'):
+            command = [self.tool('cc')] + self.flags('cflags')
+        elif source.endswith('.S'):
+            command = [self.tool('cc')] + self.flags('asflags')
+        else:
+            command = [self.tool('cxx')] + self.flags('cxxflags')
+        run_command(command + self.includes() + ['-c', source, '-o', obj])
+        return obj
+
+    def core_archive(self):
+        '''The compiled core, built unless it's in the cache.
+        Returns its path and whether it was built.'''
+        sources = self.core_sources()
+        core_dir = os.path.join(self.cache_path, 'core-{}-{}'.format(
+            self.board, self.core_key(sources)))
+        archive = os.path.join(core_dir, 'core.a')
+        if os.path.exists(archive):
+            return archive, False
+
+        os.makedirs(core_dir, exist_ok=True)
+        objects = [os.path.join(core_dir, os.path.relpath(source,
+                    self.hardware_path).replace(os.sep, '_') + '.o')
+                    for source in sources]
+        with ThreadPoolExecutor(self.jobs) as executor:
+            list(executor.map(self.compile, sources, objects))
+
+        # a build interrupted halfway must not look like a cached core
+        temp_archive = archive + '.{}.tmp'.format(os.getpid())
+        run_command([self.tool('ar'), 'rcs', temp_archive] + objects)
+        os.replace(temp_archive, archive)
+        return archive, True
+
+    def build(self, code, sketchname, headers=None):
+        '''Compiles translated code (and the headers it includes,
+        {filename: text}) into a firmware image, returns the paths
+        of the image and the build steps taken'''
+        start = time.perf_counter()
+        archive, core_built = self.core_archive()
+
+        # one build directory per sketch and core
+        build_dir = os.path.join(self.cache_path, 'sketches', sketchname,
+            os.path.basename(os.path.dirname(archive)))
+        os.makedirs(build_dir, exist_ok=True)
+
+        source = SKETCH.format(code=code)
+        source_path = os.path.join(build_dir, sketchname + '.cpp')
+        write_if_changed(source_path, source)
+        # the headers of imported modules go next to the sketch
+        headers = headers or {}
+        for filename, text in headers.items():
+            write_if_changed(os.path.join(build_dir, filename), text)
+
+        # the object is named after the code, so unchanged
+        # code links the object from the last build
+        key = json.dumps([source, sorted(headers.items())])
+        obj = os.path.join(build_dir, '{}-{}.o'.format(sketchname,
+            hashlib.sha1(key.encode()).hexdigest()[:16]))
+        sketch_built = not os.path.exists(obj)
+        if sketch_built:
+            self.compile(source_path, obj + '.tmp')
+            os.replace(obj + '.tmp', obj)
+            # objects of older code won't be linked again
+            for filename in os.listdir(build_dir):
+                path = os.path.join(build_dir, filename)
+                if (filename.startswith(sketchname + '-')
+                    and filename.endswith('.o') and path != obj):
+                    os.unlink(path)
+
+        elf = os.path.join(build_dir, sketchname + '.elf')
+        image = os.path.join(build_dir, sketchname + '.' + self.settings['image'])
+        run_command([self.tool('cc')] + self.expand(self.settings['ldflags'])
+            + ['-o', elf, obj, archive] + self.expand(self.settings['libs']))
+        run_command([self.tool('objcopy')] + self.settings['objcopy_flags']
+            + [elf, image])
+
+        return {
+            'image': image,
+            'elf': elf,
+            'core_built': core_built,
+            'sketch_built': sketch_built,
+            'seconds': time.perf_counter() - start
+        }
+
+    def upload(self, image, port):
+        command = [arg.format(port=port, image=image)
+                    for arg in self.settings['upload']]
+        if 'upload' in self.tools:
+            command[0] = self.tools['upload']
+        return run_command(command)